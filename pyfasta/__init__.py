@@ -2,7 +2,7 @@ from __future__ import print_function
 import sys
 from fasta import Fasta, complement, DuplicateHeaderException
 from records import *
-from split_fasta import split
+from split_fasta import split, record_sizes
 import optparse
 
 def main():
@@ -48,43 +48,86 @@ def info(args):
     >chr1 length:80
     <BLANKLINE>
     3760 basepairs in 3 sequences
+
+    >>> info(['--format', 'tsv', 'tests/data/three_chrs.fasta']) # doctest: +NORMALIZE_WHITESPACE
+    file seqid length A C G T N other lower gc
+    tests/data/three_chrs.fasta chr1 80 20 20 20 20 0 0 0 0.5000
+    tests/data/three_chrs.fasta chr2 80 78 0 0 2 0 0 0 0.0000
+    tests/data/three_chrs.fasta chr3 3600 1000 1400 600 600 0 0 0 0.5556
     """
     parser = optparse.OptionParser("""\
    print headers and lengths of the given fasta file in order of length. e.g.:
-        pyfasta info --gc some.fasta""")
+        pyfasta info --gc some.fasta
+   or the full base composition of every record as tsv or json (one object
+   per file) in the order of the file:
+        pyfasta info --format tsv -j 4 some.fasta""")
 
     parser.add_option("-n", "--n", type="int", dest="nseqs",
-                      help="max number of records to print. use -1 for all",
-                      default=20)
+                      help="max number of records to print. use -1 for all."
+                      " default 20 (all for tsv and json)", default=None)
     parser.add_option("--gc", dest="gc", help="show gc content",
                       action="store_true", default=False)
+    parser.add_option("--format", dest="format", default="text",
+                      choices=("text", "tsv", "json"),
+                      help="text (default), tsv or json. tsv and json have"
+                      " the counts of A, C, G, T, N, other (e.g. IUPAC) and"
+                      " lower-case (soft-masked) bases")
+    parser.add_option("-j", "--jobs", type="int", dest="workers", default=1,
+                      help="number of processes used to count bases")
     options, fastas = parser.parse_args(args)
     if not (fastas):
         sys.exit(parser.print_help())
     import operator
+    from composition import fasta_composition, COLUMNS
+
+    text = options.format == "text"
+    limit = options.nseqs
+    if limit is None:
+        limit = 20 if text else -1
 
+    if options.format == "tsv":
+        print("\t".join(("file", "seqid") + COLUMNS))
     for fasta in fastas:
         f = Fasta(fasta)
+        if not text:
+            # in the order of the file, not of the index.
+            keys = [k for k, _ in record_sizes(f)[0]]
+            if limit > -1:
+                keys = keys[:limit]
+            comps = fasta_composition(f, keys, workers=options.workers)
+            if options.format == "tsv":
+                for k, comp in comps:
+                    print("\t".join([fasta, k] +
+                                    ["%i" % comp[c] for c in COLUMNS[:-1]] +
+                                    ["%.4f" % comp['gc']]))
+            else:
+                import json
+                print(json.dumps({"file": fasta, "records":
+                                  [dict(comp, seqid=k) for k, comp in comps]},
+                                 sort_keys=True))
+            continue
+
         info = [(k, len(seq)) for k, seq in f.iteritems()]
 
         total_len = sum(l for k, l in info)
         nseqs = len(f)
-        if options.nseqs > -1:
+        if limit > -1:
             info = sorted(info,  key=operator.itemgetter(1, 0), reverse=True)
-            info = info[:options.nseqs]
+            info = info[:limit]
         else:
             info.sort()
 
+        gcs = {}
+        if options.gc:
+            gcs = dict(fasta_composition(f, [k for k, l in info],
+                                         workers=options.workers))
+
         print("\n" + fasta)
         print("=" * len(fasta))
         for k, l in info:
             gc = ""
             if options.gc:
-                seq = str(f[k]).upper()
-                g = seq.count('G')
-                c = seq.count('C')
-                gc = 100.0 * (g + c) / float(l)
-                gc = "gc:%.2f%%" % gc
+                gc = "gc:%.2f%%" % (100.0 * gcs[k]['gc'])
             print((">%s length:%i" % (k, l)) + gc)
 
         if total_len > 1000000:
@@ -97,9 +140,11 @@ def flatten(args):
     >>> flatten(['tests/data/three_chrs.fasta'])
     """
     parser = optparse.OptionParser("""flatten a fasta file *inplace* so all later access by pyfasta will use that flattend (but still viable) fasta file""")
-    _, fasta = parser.parse_args(args)
+    parser.add_option("-j", "--jobs", type="int", dest="workers", default=1,
+                      help="number of processes to use for flattening")
+    options, fasta = parser.parse_args(args)
     for fa in fasta:
-        f = Fasta(fa, flatten_inplace=True)
+        f = Fasta(fa, flatten_inplace=True, workers=options.workers)
 
 def extract(args):
     """
@@ -108,7 +153,9 @@ def extract(args):
     """
 
     parser = optparse.OptionParser("""extract some sequences from a fasta file. e.g.:
-               pyfasta extract --fasta some.fasta --header at2g26540 at3g45640""")
+               pyfasta extract --fasta some.fasta --header at2g26540 at3g45640
+   or the regions in a BED file, or the (spliced) transcripts of a GFF/GTF:
+               pyfasta extract --fasta some.fasta --bed regions.bed""")
     parser.add_option("--fasta", dest="fasta", help="path to the fasta file")
     parser.add_option("--header", dest="header", help="include headers", action="store_true", default=False)
     parser.add_option("--exclude", dest="exclude", help="extract all sequences EXCEPT those listed", action="store_true", default=False)
@@ -119,12 +166,43 @@ def extract(args):
     parser.add_option("--space", dest="space", action="store_true", help=\
                       "use the fasta identifier only up to the space as the key",
                       default=False)
+    parser.add_option("--bed", dest="bed", help="extract the regions in this"
+                      " BED file (blocks of BED12 lines are spliced), in"
+                      " order, on their strand")
+    parser.add_option("--gff", dest="gff", help="extract the transcripts in"
+                      " this GFF3 or GTF file: the --feature records joined"
+                      " by transcript_id (GTF) or Parent (GFF3)")
+    parser.add_option("--feature", dest="feature", default="exon",
+                      help="the feature type to join for --gff. default exon")
+    parser.add_option("--format", dest="format", default="fasta",
+                      choices=("fasta", "tsv"), help="output for --bed and"
+                      " --gff: fasta (default) or tsv of name and sequence")
     options, seqs = parser.parse_args(args)
-    if not (options.fasta and len(seqs)):
+    if not (options.fasta and (len(seqs) or options.bed or options.gff)):
         sys.exit(parser.print_help())
+    if options.bed and options.gff:
+        parser.error("use only one of --bed and --gff")
 
     key_fn = (lambda k: k.split()[0]) if options.space else None
     f = Fasta(options.fasta, key_fn=key_fn)
+
+    if options.bed or options.gff:
+        from intervals import read_bed, read_gff, write_regions
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        try:
+            if options.bed:
+                with open(options.bed) as fh:
+                    write_regions(f, read_bed(fh), out, options.format)
+            else:
+                with open(options.gff) as fh:
+                    regions = read_gff(fh, options.feature)
+                write_regions(f, regions, out, options.format)
+        except KeyError as e:
+            sys.exit("pyfasta extract: %s%s" % (e.args[0], "" if options.space
+                     else " (use --space to match on the first word of"
+                          " the headers)"))
+        return
+
     if options.file:
         seqs = (x.strip() for x in open(seqs[0]))
     if options.exclude:
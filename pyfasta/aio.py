@@ -0,0 +1,176 @@
+"""
+asyncio access to a Fasta, for use from an event loop (e.g. a web service)
+without blocking it on disk reads or page faults. python 3 only.
+
+    fa = AsyncFasta('some.fasta', max_workers=8)
+    seq = await fa.fetch('chr1', 1000, 2000)
+    seqs = await fa.fetch_many([('chr1', 0, 10), ('chr2', 5, 20, '-')])
+
+the reads run on a bounded thread pool. requests made in the same
+iteration of the loop are merged: overlapping (or adjacent) regions of
+a chromosome are read once, and a request that is covered by a read
+already in flight waits for that read instead of making another.
+cancelling a request only cancels the read when no other request is
+waiting for it.
+"""
+from operator import itemgetter
+
+from fasta import Fasta, _is_minus, _complement_table
+from records import _as_str
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2. the module still imports (e.g. for nose's doctest
+    # collection) but AsyncFasta can't be made.
+    asyncio = None
+
+_complement_bytes = _complement_table.tostring()
+
+
+def _merge(reqs):
+    """Internal: group the (start, stop, ...) requests of a chromosome
+    into [start, stop, requests] reads, merging any that overlap or
+    touch.
+
+        >>> _merge([(10, 20, 'a'), (0, 5, 'b'), (5, 8, 'c'), (15, 30, 'd')])
+        [[0, 8, [(0, 5, 'b'), (5, 8, 'c')]], [10, 30, [(10, 20, 'a'), (15, 30, 'd')]]]
+    """
+    groups = []
+    for req in sorted(reqs, key=itemgetter(0, 1)):
+        if groups and req[0] <= groups[-1][1]:
+            groups[-1][1] = max(groups[-1][1], req[1])
+            groups[-1][2].append(req)
+        else:
+            groups.append([req[0], req[1], [req]])
+    return groups
+
+
+class _Read(object):
+    """Internal: a read of flat[start:stop] of chrom on the executor,
+    and the (waiter, start, stop, strand) requests it answers."""
+    def __init__(self, owner, chrom, start, stop, future):
+        self.owner = owner
+        self.chrom, self.start, self.stop = chrom, start, stop
+        self.future = future
+        self.waiters = []
+        owner._reads.setdefault(chrom, []).append(self)
+        future.add_done_callback(self._done)
+
+    def add(self, waiter, start, stop, strand):
+        self.waiters.append((waiter, start, stop, strand))
+        waiter.add_done_callback(self._waiter_done)
+
+    def _forget(self):
+        reads = self.owner._reads.get(self.chrom, [])
+        if self in reads:
+            reads.remove(self)
+            if not reads:
+                del self.owner._reads[self.chrom]
+
+    def _waiter_done(self, waiter):
+        if self.future.done() or not waiter.cancelled():
+            return
+        if all(w.done() for w, _, _, _ in self.waiters):
+            # nobody is left waiting: don't let new requests join it.
+            self._forget()
+            self.future.cancel()
+
+    def _done(self, future):
+        self._forget()
+        for waiter, start, stop, strand in self.waiters:
+            if waiter.done():
+                continue
+            if future.cancelled():
+                waiter.cancel()
+            elif future.exception() is not None:
+                waiter.set_exception(future.exception())
+            else:
+                waiter.set_result(self.owner._result(future.result(),
+                                                     start - self.start,
+                                                     stop - self.start,
+                                                     strand))
+
+
+class AsyncFasta(object):
+    """
+    wraps a Fasta (or the path to one, with `kwargs` passed to Fasta)
+    so that fetch() and fetch_many() return awaitables. reads run on
+    `executor`, by default a ThreadPoolExecutor of `max_workers` threads
+    that is shut down by close(). results are str or, with
+    output='bytes', bytes.
+    """
+    def __init__(self, fasta, max_workers=4, executor=None, output='str',
+                 **kwargs):
+        if asyncio is None:
+            raise RuntimeError("AsyncFasta needs asyncio (python 3)")
+        if output not in ('str', 'bytes'):
+            raise ValueError("output must be 'str' or 'bytes'")
+        if not isinstance(fasta, Fasta):
+            fasta = Fasta(fasta, **kwargs)
+        self.fasta = fasta
+        self.output = output
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers)
+        # requests not yet read, by chrom, and the reads in flight.
+        self._pending = {}
+        self._reads = {}
+        self._flush_handle = None
+        # the number of reads made (fewer than requests when merged).
+        self.nreads = 0
+
+    def fetch(self, chrom, start, stop, strand=None):
+        """
+        an awaitable of the sequence of chrom[start:stop] (python,
+        0-based coordinates), reverse complemented if `strand` is minus
+        (-1, '-1' or '-').
+        """
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        start, stop = max(int(start), 0), max(int(stop), 0)
+        for read in self._reads.get(chrom, ()):
+            if read.start <= start and stop <= read.stop:
+                read.add(waiter, start, stop, strand)
+                return waiter
+        self._pending.setdefault(chrom, []).append((start, stop, strand,
+                                                    waiter))
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_soon(self._flush, loop)
+        return waiter
+
+    def fetch_many(self, regions):
+        """
+        an awaitable of the list of sequences of `regions`, each
+        (chrom, start, stop) or (chrom, start, stop, strand) as for
+        fetch(). cancelling it cancels all of the requests.
+        """
+        return asyncio.gather(*[self.fetch(*r) for r in regions])
+
+    def _flush(self, loop):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        for chrom, reqs in pending.items():
+            for start, stop, group in _merge(r for r in reqs
+                                             if not r[3].done()):
+                future = loop.run_in_executor(self.executor, self._read,
+                                              chrom, start, stop)
+                self.nreads += 1
+                read = _Read(self, chrom, start, stop, future)
+                for s, e, strand, waiter in group:
+                    read.add(waiter, s, e, strand)
+
+    def _read(self, chrom, start, stop):
+        # copy to bytes here so any page faults are on the executor.
+        return self.fasta._slice(chrom, start, stop).tostring()
+
+    def _result(self, data, start, stop, strand):
+        d = data[start:stop]
+        if strand is not None and _is_minus(strand):
+            d = d.translate(_complement_bytes)[::-1]
+        return d if self.output == 'bytes' else _as_str(d)
+
+    def close(self):
+        "shut down the executor, if it was made by this AsyncFasta."
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
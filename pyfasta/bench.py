@@ -0,0 +1,348 @@
+"""
+benchmarks of pyfasta on synthetic genomes:
+
+    python -m pyfasta.bench [--shape chroms|contigs] [-o results.json]
+                            [--baseline baseline.json --threshold 0.25]
+
+a genome is made (reproducibly, from --seed) in one of two shapes: a few
+large chromosomes ('chroms') or many small contigs ('contigs', --contigs
+of them). for each record class it times:
+
+    build       Fasta() with no index: parsing and writing the sidecars
+    open_cold   Fasta() in a new process, after the sidecars are evicted
+                from the page cache where the os allows it
+    open_warm   Fasta() again in this process
+    random      slices of 100-2000 bases at random positions
+    sequential  each record read from start to end, 1Mb at a time
+    revcomp     sequence() of the random slices on the minus strand
+    sequences   the random slices by a single sequences() call
+
+and, once for each genome, `pyfasta info` and `pyfasta split -n 4`.
+
+the results are the best time in seconds of --repeat runs, as JSON keyed
+by shape/record_class/benchmark. given a --baseline (earlier results), the
+benchmarks more than --threshold slower are reported and the exit status
+is 1. tests/bench_baseline.json is such a baseline, made with the default
+options by
+
+    python -m pyfasta.bench -o tests/bench_baseline.json
+
+times depend on the machine, so to compare against it elsewhere make it
+again there (from the commit to compare to) and commit it when the
+reference changes.
+"""
+from __future__ import print_function
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+import pyfasta
+from pyfasta import records
+from pyfasta.fasta import Fasta
+from pyfasta.split_fasta import _write_seq
+
+RECORD_CLASSES = ('NpyFastaRecord', 'MemoryRecord', 'FastaRecord',
+                  'FaidxRecord', 'TwoBitRecord')
+
+SHAPES = ('chroms', 'contigs')
+
+_cold_open = """\
+import sys, time
+from pyfasta import Fasta, records
+t = time.time()
+f = Fasta(sys.argv[1], record_class=getattr(records, sys.argv[2]))
+f[sys.argv[3]][:10]
+print(time.time() - t)
+"""
+
+
+def make_genome(path, shape, size, ncontigs=100000, seed=0, width=60):
+    """
+    write a random fasta of about `size` bases to `path`: 5 chromosomes
+    for shape 'chroms' or `ncontigs` contigs of varying length for
+    'contigs', each wrapped to lines of `width`. returns the list of
+    (name, length) of its records.
+    """
+    rng = np.random.RandomState(seed)
+    if shape == 'chroms':
+        lens = np.full(5, size // 5, dtype=np.int64)
+        names = ["chr%i" % (i + 1) for i in range(len(lens))]
+    else:
+        mean = max(size // ncontigs, 2)
+        lens = rng.randint(mean // 2, mean * 3 // 2 + 1, size=ncontigs)
+        names = ["contig%i" % i for i in range(ncontigs)]
+    seq = np.frombuffer(b"ACGT", dtype='S1')[rng.randint(0, 4,
+                                                         size=lens.sum())]
+    # a run of N at the start of each chromosome, soft-masked repeats.
+    if shape == 'chroms':
+        for start in (np.cumsum(lens) - lens).tolist():
+            seq[start:start + 1000] = b'N'
+    u = seq.view(np.uint8)
+    for start in rng.randint(0, len(seq), size=len(seq) // 10000).tolist():
+        u[start:start + 300] |= 0x20
+    pos = 0
+    with open(path, 'wb') as fh:
+        for name, n in zip(names, lens.tolist()):
+            fh.write(b">" + name.encode() + b"\n")
+            _write_seq(fh, lambda a, b: seq[pos + a:pos + b], n, width)
+            pos += n
+    return list(zip(names, lens.tolist()))
+
+
+def _regions(recs, n, seed=0):
+    "n random (chrom, start, stop) of 100-2000 bases from `recs`."
+    rng = np.random.RandomState(seed)
+    lens = np.array([l for _, l in recs], dtype=np.int64)
+    idx = rng.choice(len(recs), size=n, p=lens / float(lens.sum()))
+    sizes = rng.randint(100, 2001, size=n)
+    starts = (rng.random_sample(n) * np.maximum(lens[idx] - sizes, 1)).astype(np.int64)
+    return [(recs[i][0], s, s + l) for i, s, l in
+            zip(idx.tolist(), starts.tolist(), sizes.tolist())]
+
+
+def _best(fn, repeat, setup=None):
+    "the least time of `repeat` calls of fn(), each after setup()."
+    times = []
+    for _ in range(repeat):
+        if setup is not None: setup()
+        t = time.time()
+        fn()
+        times.append(time.time() - t)
+    return min(times)
+
+
+def _sidecars(path):
+    d = os.path.dirname(path) or "."
+    base = os.path.basename(path)
+    return [os.path.join(d, x) for x in os.listdir(d)
+            if x.startswith(base + ".")]
+
+
+def _remove_sidecars(path):
+    for f in _sidecars(path):
+        os.unlink(f)
+
+
+def _evict(path):
+    # drop the sidecars from the page cache (python 3.3+ on posix).
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is None: return
+    for f in _sidecars(path) + [path]:
+        fd = os.open(f, os.O_RDONLY)
+        try:
+            fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _quiet(fn, *args):
+    # info and split print to stdout / stderr.
+    out, err = sys.stdout, sys.stderr
+    with open(os.devnull, 'w') as null:
+        sys.stdout = sys.stderr = null
+        try:
+            fn(*args)
+        finally:
+            sys.stdout, sys.stderr = out, err
+
+
+def bench_record_class(path, recs, klass, regions, repeat=3):
+    "time each of the benchmarks of one record class. returns a dict."
+    res = {}
+    res['build'] = _best(lambda: Fasta(path, record_class=klass), repeat,
+                         lambda: _remove_sidecars(path))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(pyfasta.__file__)))]
+        + [p for p in [env.get('PYTHONPATH')] if p])
+    cold = []
+    for _ in range(repeat):
+        _evict(path)
+        out = subprocess.check_output([sys.executable, '-c', _cold_open, path,
+                                       klass.__name__, recs[0][0]], env=env)
+        cold.append(float(out.decode().strip().split()[-1]))
+    res['open_cold'] = min(cold)
+    res['open_warm'] = _best(lambda: Fasta(path, record_class=klass)[recs[0][0]],
+                             repeat)
+
+    f = Fasta(path, record_class=klass)
+
+    def random():
+        for chrom, start, stop in regions:
+            str(f[chrom][start:stop])
+
+    def sequential():
+        step = 1 << 20
+        for chrom, n in recs:
+            rec = f[chrom]
+            for start in range(0, n, step):
+                rec[start:start + step]
+
+    def revcomp():
+        for chrom, start, stop in regions:
+            f.sequence({'chr': chrom, 'start': start, 'stop': stop,
+                        'strand': '-'}, one_based=False)
+
+    chroms, starts, stops = zip(*regions)
+
+    def sequences():
+        f.sequences(chroms, starts, stops, ['-'] * len(starts),
+                    one_based=False)
+
+    for name, fn in (('random', random), ('sequential', sequential),
+                     ('revcomp', revcomp), ('sequences', sequences)):
+        res[name] = _best(fn, repeat)
+    return res
+
+
+def bench_cli(path, repeat=3):
+    "time `pyfasta info` and `pyfasta split -n 4` of the fasta `path`."
+    d = tempfile.mkdtemp(dir=os.path.dirname(path) or ".")
+    copy = os.path.join(d, os.path.basename(path))
+    shutil.copyfile(path, copy)
+    try:
+        Fasta(copy)
+        return {'info': _best(lambda: _quiet(pyfasta.info, [copy]), repeat),
+                'split': _best(lambda: _quiet(pyfasta.split, ['-n', '4', copy]),
+                               repeat)}
+    finally:
+        shutil.rmtree(d)
+
+
+def run(workdir, shapes=SHAPES, record_classes=RECORD_CLASSES,
+        size=20000000, ncontigs=100000, nreads=10000, repeat=3, seed=0):
+    """
+    make the genome of each of `shapes` in `workdir` (or use the one left
+    there by an earlier run with the same parameters) and run all the
+    benchmarks. returns the results as a dict of
+    'shape/record_class/benchmark' (or 'shape/benchmark') => seconds.
+    """
+    results = {}
+    for shape in shapes:
+        base = os.path.join(workdir, "%s-%i-%i-%i" % (shape, size,
+                                                     ncontigs, seed))
+        path, listing = base + ".fa", base + ".json"
+        if os.path.exists(listing):
+            with open(listing) as fh:
+                recs = [tuple(r) for r in json.load(fh)]
+        else:
+            recs = make_genome(path, shape, size, ncontigs, seed)
+            with open(listing, 'w') as fh:
+                json.dump(recs, fh)
+        regions = _regions(recs, nreads, seed)
+        for name in record_classes:
+            res = bench_record_class(path, recs, getattr(records, name),
+                                     regions, repeat)
+            _remove_sidecars(path)
+            for k, v in res.items():
+                results["%s/%s/%s" % (shape, name, k)] = v
+        for k, v in bench_cli(path, repeat).items():
+            results["%s/%s" % (shape, k)] = v
+    return results
+
+
+def compare(results, baseline, threshold=0.25, min_time=0.01):
+    """
+    the benchmarks in both `results` and `baseline` that are slower by
+    more than `threshold` (a fraction of the baseline) as a sorted list of
+    (name, baseline, result, ratio). times under `min_time` seconds in
+    both are too noisy to compare.
+
+        >>> compare({'a': 1.5, 'b': 1.1, 'c': 0.004, 'd': 1.0},
+        ...         {'a': 1.0, 'b': 1.0, 'c': 0.001})
+        [('a', 1.0, 1.5, 1.5)]
+    """
+    slower = []
+    for name in sorted(set(results) & set(baseline)):
+        old, new = baseline[name], results[name]
+        if max(old, new) < min_time:
+            continue
+        ratio = new / max(old, 1e-9)
+        if ratio > 1 + threshold:
+            slower.append((name, old, new, ratio))
+    return slower
+
+
+def main(args=None):
+    parser = optparse.OptionParser("""\
+   benchmark pyfasta on synthetic genomes and write the results as JSON.
+        python -m pyfasta.bench -o results.json
+   and later compare to them:
+        python -m pyfasta.bench --baseline results.json""")
+    parser.add_option("--shape", dest="shapes", action="append",
+                      choices=SHAPES, default=None,
+                      help="'chroms' (a few large chromosomes) or 'contigs'"
+                      " (many small ones). may be repeated. default both")
+    parser.add_option("--records", dest="records", default=",".join(
+                      RECORD_CLASSES), help="comma separated record classes"
+                      " (default %default)")
+    parser.add_option("--size", type="int", dest="size", default=20000000,
+                      help="bases in each genome (default %default)")
+    parser.add_option("--contigs", type="int", dest="ncontigs",
+                      default=100000, help="number of contigs of the"
+                      " 'contigs' genome (default %default)")
+    parser.add_option("--reads", type="int", dest="nreads", default=10000,
+                      help="number of random slices (default %default)")
+    parser.add_option("--repeat", type="int", dest="repeat", default=3,
+                      help="runs of each benchmark, the best is kept"
+                      " (default %default)")
+    parser.add_option("--seed", type="int", dest="seed", default=0)
+    parser.add_option("--dir", dest="workdir", default=None,
+                      help="keep the genomes in this directory to reuse"
+                      " them. default a temporary directory")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="write the JSON here instead of to stdout")
+    parser.add_option("--baseline", dest="baseline", default=None,
+                      help="JSON of earlier results to compare to")
+    parser.add_option("--threshold", type="float", dest="threshold",
+                      default=0.25, help="fraction slower than the baseline"
+                      " that is a regression (default %default)")
+    options, _ = parser.parse_args(args)
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="pyfasta-bench")
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    try:
+        results = run(workdir, options.shapes or SHAPES,
+                      options.records.split(","), options.size,
+                      options.ncontigs, options.nreads, options.repeat,
+                      options.seed)
+    finally:
+        if options.workdir is None:
+            shutil.rmtree(workdir)
+
+    doc = {'results': results,
+           'config': dict(size=options.size, contigs=options.ncontigs,
+                          reads=options.nreads, repeat=options.repeat,
+                          seed=options.seed),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'platform': platform.platform()}
+    out = open(options.output, 'w') if options.output else sys.stdout
+    json.dump(doc, out, indent=1, sort_keys=True, separators=(',', ': '))
+    out.write("\n")
+    if options.output: out.close()
+
+    if options.baseline:
+        with open(options.baseline) as fh:
+            baseline = json.load(fh)['results']
+        slower = compare(results, baseline, options.threshold)
+        for name, old, new, ratio in slower:
+            print("%-40s %9.4fs -> %9.4fs (%.2fx)" % (name, old, new, ratio),
+                  file=sys.stderr)
+        print("%i of %i benchmarks more than %i%% slower than %s"
+              % (len(slower), len(set(results) & set(baseline)),
+                 100 * options.threshold, options.baseline), file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
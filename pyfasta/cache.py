@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    a dict-like that keeps at most `maxsize` items, dropping the least
+    recently used. get() counts hits and misses.
+
+        >>> c = LRUCache(2)
+        >>> c['a'] = 1; c['b'] = 2
+        >>> c.get('a')
+        1
+        >>> c['c'] = 3
+        >>> sorted(c.keys()), c.get('b'), c.hits, c.misses
+        (['a', 'c'], None, 1, 1)
+
+    with `maxbytes`, the total len() of the values is kept under that
+    budget instead (or as well). a value larger than the budget is not
+    kept at all. `maxsize` of None is unbounded.
+    get() and setting items can be called from many threads.
+
+        >>> c = LRUCache(None, maxbytes=6)
+        >>> c['a'] = 'ACGT'; c['b'] = 'AC'
+        >>> c['c'] = 'GG'
+        >>> sorted(c.keys()), c.nbytes
+        (['b', 'c'], 4)
+        >>> c['d'] = 'ACGTACGT'
+        >>> 'd' in c
+        False
+    """
+    def __init__(self, maxsize, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.data = OrderedDict()
+        self.lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.data:
+                del self[key]
+            if self.maxbytes is not None:
+                size = len(value)
+                if size > self.maxbytes: return
+                self.nbytes += size
+            self.data[key] = value
+            while self.maxsize is not None and len(self.data) > self.maxsize:
+                self.popitem()
+            while self.maxbytes is not None and self.nbytes > self.maxbytes:
+                self.popitem()
+
+    def __delitem__(self, key):
+        with self.lock:
+            value = self.data.pop(key)
+            if self.maxbytes is not None:
+                self.nbytes -= len(value)
+
+    def popitem(self):
+        "remove and return the least recently used (key, value)"
+        with self.lock:
+            key, value = self.data.popitem(last=False)
+            if self.maxbytes is not None:
+                self.nbytes -= len(value)
+            return key, value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def keys(self):
+        return self.data.keys()
+
+    def values(self):
+        return self.data.values()
+
+    def items(self):
+        return self.data.items()
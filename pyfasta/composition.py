@@ -0,0 +1,347 @@
+"""
+base composition of the records in a fasta file.
+
+the bytes of each record are counted with np.bincount in chunks, so no
+record is ever held in memory as a string. records can be counted in
+parallel by a process pool (the Fasta is pickled by file name).
+"""
+from __future__ import print_function
+import os
+import numpy as np
+
+from fasta import _getdata, _gather_index
+from records import _as_str
+
+CHUNK = 1 << 22
+
+# the columns of composition(). 'other' is any byte that is not
+# ACGTN (e.g. IUPAC codes), 'lower' is the count of lower-case
+# (soft-masked) bases, which are also included in the other columns.
+COLUMNS = ('length', 'A', 'C', 'G', 'T', 'N', 'other', 'lower', 'gc')
+
+
+def byte_counts(rec, chunk=CHUNK):
+    """
+    return an array of the count of each of the 256 byte values in
+    the record.
+
+        >>> from pyfasta import Fasta
+        >>> f = Fasta('tests/data/three_chrs.fasta')
+        >>> c = byte_counts(f['chr1'], chunk=7)
+        >>> int(c[ord('A')]), int(c.sum())
+        (20, 80)
+    """
+    counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, len(rec), chunk):
+        d = _getdata(rec, slice(start, start + chunk))
+        counts += np.bincount(d.view(np.uint8), minlength=256)
+    return counts
+
+
+def composition(counts):
+    """
+    summarize the byte counts from byte_counts() as a dict with the
+    keys in COLUMNS. gc is the fraction of G + C in the whole length.
+
+        >>> c = np.bincount(np.frombuffer(b'ACGTNnacRY', dtype=np.uint8),
+        ...                 minlength=256)
+        >>> comp = composition(c)
+        >>> [comp[k] for k in COLUMNS]
+        [10, 2, 2, 1, 1, 2, 2, 3, 0.3]
+    """
+    comp = {'length': int(counts.sum())}
+    for base in 'ACGTN':
+        comp[base] = int(counts[ord(base)] + counts[ord(base.lower())])
+    comp['other'] = comp['length'] - sum(comp[b] for b in 'ACGTN')
+    comp['lower'] = int(counts[ord('a'):ord('z') + 1].sum())
+    comp['gc'] = (comp['G'] + comp['C']) / float(comp['length']) \
+                    if comp['length'] else 0.0
+    return comp
+
+
+_fasta = None
+
+def _init_worker(fasta):
+    global _fasta
+    _fasta = fasta
+
+def _worker_counts(args):
+    key, chunk = args
+    return byte_counts(_fasta[key], chunk)
+
+
+def fasta_composition(f, keys=None, workers=1, chunk=CHUNK):
+    """
+    generate (key, composition dict) for each of `keys` (default all) in
+    order. with `workers` > 1, the records are counted by that many
+    processes.
+
+        >>> from pyfasta import Fasta
+        >>> f = Fasta('tests/data/three_chrs.fasta')
+        >>> for k, comp in fasta_composition(f, sorted(f.keys())):
+        ...     print(k, comp['length'], '%.3f' % comp['gc'])
+        chr1 80 0.500
+        chr2 80 0.000
+        chr3 3600 0.556
+    """
+    keys = list(f.keys()) if keys is None else list(keys)
+    if workers <= 1 or len(keys) < 2:
+        for k in keys:
+            yield k, composition(byte_counts(f[k], chunk))
+        return
+
+    from multiprocessing import Pool
+    pool = Pool(min(workers, len(keys)), _init_worker, (f,))
+    try:
+        for k, counts in zip(keys, pool.imap(_worker_counts,
+                                             [(k, chunk) for k in keys])):
+            yield k, composition(counts)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# columns of the counts kept by GCIndex: G or C, N, lower-case.
+GCX_COLUMNS = ('gc', 'N', 'lower')
+_gcx_table = np.zeros((256, 3), dtype=np.int32)
+_gcx_table[[ord(b) for b in 'GCgc'], 0] = 1
+_gcx_table[[ord(b) for b in 'Nn'], 1] = 1
+_gcx_table[ord('a'):ord('z') + 1, 2] = 1
+# one row per column, used to count a column at a time.
+_gcx_rows = _gcx_table.T.astype(np.uint8)
+
+
+class GCIndex(object):
+    """
+    cumulative counts of G+C, N and lower-case bases in a flat (memmap)
+    file sampled every `step` (default 256) bases and saved as .npy (the
+    .gcx sidecar). a smaller step makes a larger file and shorter scans.
+    the counts up to any position are the sample before it plus a scan
+    of at most step - 1 bases, so the count in any window takes two
+    lookups (and two short scans) however long the window.
+
+    the first row of the .gcx is (step, length of the flat file, 0).
+    """
+    ext = ".gcx"
+
+    def __init__(self, flat, filename, step=None, chunk=CHUNK):
+        self.flat = flat.view(np.ndarray).view(np.uint8)
+        cum = None
+        if os.path.exists(filename):
+            cum = np.load(filename, mmap_mode='r')
+            if cum[0, 1] != len(self.flat) or step not in (None, cum[0, 0]):
+                cum = None
+        if cum is None:
+            self.write(self.flat, filename, step or 256, chunk)
+            cum = np.load(filename, mmap_mode='r')
+        self.step = int(cum[0, 0])
+        self.cum = cum[1:]
+
+    @classmethod
+    def write(klass, flat, filename, step=256, chunk=CHUNK):
+        chunk = max(chunk // step, 1) * step
+        nsamples = (len(flat) + step - 1) // step + 1
+        tmp = filename + ".tmp%i.npy" % os.getpid()
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int64,
+                                        shape=(nsamples + 1, 3))
+        out[0] = (step, len(flat), 0)
+        out[1] = 0
+        total = np.zeros(3, dtype=np.int64)
+        row = 2
+        for start in range(0, len(flat), chunk):
+            data = flat[start:start + chunk]
+            nblocks = (len(data) + step - 1) // step
+            if len(data) % step:
+                # pad with a byte that isn't counted.
+                data = np.append(data, np.zeros(nblocks * step - len(data),
+                                                dtype=np.uint8))
+            sums = np.column_stack([row_table[data].reshape(nblocks, step)
+                                    .sum(axis=1, dtype=np.int64)
+                                    for row_table in _gcx_rows])
+            np.cumsum(sums, axis=0, out=out[row:row + nblocks])
+            out[row:row + nblocks] += total
+            total = out[row + nblocks - 1].copy()
+            row += nblocks
+        out.flush()
+        del out
+        os.rename(tmp, filename)
+
+    def counts(self, positions, batch=4096):
+        """
+        the (gc, N, lower) counts in flat[0:p] for each p in `positions`
+        as an array of shape (len(positions), 3).
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        samples = positions // self.step
+        res = np.array(self.cum[samples])
+        # then scan from the sample to each position, in batches so at
+        # most batch * step bases are gathered at once.
+        for i in range(0, len(positions), batch):
+            base = samples[i:i + batch] * self.step
+            lens = positions[i:i + batch] - base
+            data = self.flat[_gather_index(base, lens)]
+            ends = np.cumsum(lens)
+            for j, row_table in enumerate(_gcx_rows):
+                cs = np.zeros(len(data) + 1, dtype=np.int64)
+                np.cumsum(row_table[data], out=cs[1:])
+                res[i:i + batch, j] += cs[ends] - cs[ends - lens]
+        return res
+
+
+# 2-bit codes of the bases for k-mers, 4 for anything that isn't ACGT.
+_kmer_code = np.empty(256, dtype=np.uint8)
+_kmer_code.fill(4)
+for _i, _b in enumerate('ACGT'):
+    _kmer_code[ord(_b)] = _kmer_code[ord(_b.lower())] = _i
+del _i, _b
+
+
+def _rolling_codes(b, k):
+    """Internal: the codes of all the windows of length k of the 2-bit
+    codes in `b`, built by doubling so there are O(log k) passes."""
+    res, reslen = None, 0
+    cur, curlen = b.astype(np.uint64), 1
+    while k:
+        if k & 1:
+            if res is None:
+                res, reslen = cur, curlen
+            else:
+                n = len(b) - reslen - curlen + 1
+                res = (res[:n] << np.uint64(2 * curlen)) \
+                        | cur[reslen:reslen + n]
+                reslen += curlen
+        k >>= 1
+        if k:
+            n = len(b) - 2 * curlen + 1
+            cur = (cur[:n] << np.uint64(2 * curlen)) | cur[curlen:curlen + n]
+            curlen *= 2
+    return res
+
+
+def _chunk_kmers(d, k, canonical):
+    """Internal: the codes of the k-mers in the uint8 sequence `d` that
+    contain only ACGT (either case)."""
+    b = _kmer_code[d]
+    bad = np.zeros(len(b) + 1, dtype=np.int64)
+    np.cumsum(b == 4, out=bad[1:])
+    ok = bad[k:] == bad[:-k]
+    b[b == 4] = 0
+    codes = _rolling_codes(b, k)
+    if canonical:
+        # the reverse complement of each window is a window of the
+        # reversed complement, read backwards.
+        rc = _rolling_codes(3 - b[::-1], k)[::-1]
+        codes = np.minimum(codes, rc)
+    return codes[ok]
+
+
+def _merge_counts(codes, counts):
+    codes = np.concatenate(codes)
+    counts = np.concatenate(counts)
+    u, inv = np.unique(codes, return_inverse=True)
+    return u, np.bincount(inv, weights=counts,
+                          minlength=len(u)).astype(np.int64)
+
+
+class _KmerCounter(object):
+    """Internal: accumulates (codes, counts), merging them once the
+    unmerged parts are larger than what has been merged."""
+    def __init__(self):
+        self.codes = [np.zeros(0, dtype=np.uint64)]
+        self.counts = [np.zeros(0, dtype=np.int64)]
+        self.pending = 0
+
+    def add(self, codes, counts):
+        self.codes.append(codes)
+        self.counts.append(counts)
+        self.pending += len(codes)
+        if self.pending > len(self.codes[0]):
+            self.result()
+
+    def result(self):
+        if len(self.codes) > 1:
+            u, c = _merge_counts(self.codes, self.counts)
+            self.codes, self.counts, self.pending = [u], [c], 0
+        return self.codes[0], self.counts[0]
+
+
+def kmer_counts(rec, k, canonical=True, chunk=CHUNK):
+    """
+    count the k-mers (k <= 32) of the record. k-mers with any base other
+    than ACGT (e.g. N) are skipped; case is ignored. returns the sorted
+    array of the 2-bit codes of the k-mers seen (A=0, C=1, G=2, T=3, the
+    first base in the high bits; see decode_kmers) and their counts.
+    with `canonical`, a k-mer and its reverse complement are counted
+    together as the smaller of the two codes.
+
+        >>> from pyfasta import Fasta
+        >>> f = Fasta('tests/data/three_chrs.fasta')
+        >>> codes, counts = kmer_counts(f['chr1'], 3, canonical=False)
+        >>> list(zip(decode_kmers(codes, 3), counts.tolist()))
+        [('ACT', 20), ('CTG', 20), ('GAC', 19), ('TGA', 19)]
+        >>> codes, counts = kmer_counts(f['chr1'], 3)
+        >>> list(zip(decode_kmers(codes, 3), counts.tolist()))
+        [('ACT', 20), ('CAG', 20), ('GAC', 19), ('TCA', 19)]
+    """
+    if not 1 <= k <= 32:
+        raise ValueError("k must be between 1 and 32")
+    counter = _KmerCounter()
+    chunk = max(chunk, k)
+    for start in range(0, max(len(rec) - k + 1, 0), chunk):
+        d = _getdata(rec, slice(start, start + chunk + k - 1))
+        codes = _chunk_kmers(d.view(np.uint8), k, canonical)
+        counter.add(*np.unique(codes, return_counts=True))
+    return counter.result()
+
+
+def decode_kmers(codes, k):
+    """
+    the k-mers of the codes from kmer_counts() as a list of strings.
+
+        >>> decode_kmers(np.array([0, 7], dtype=np.uint64), 3)
+        ['AAA', 'ACT']
+    """
+    codes = np.asarray(codes, dtype=np.uint64)
+    shifts = np.arange(2 * (k - 1), -1, -2).astype(np.uint64)
+    b = (codes[:, None] >> shifts) & np.uint64(3)
+    s = np.frombuffer(b'ACGT', dtype='S1')[b.astype(np.intp)]
+    return [_as_str(x) for x in
+            np.ascontiguousarray(s).view('S%i' % k).ravel().tolist()]
+
+
+def _worker_kmers(args):
+    key, k, canonical, chunk = args
+    return kmer_counts(_fasta[key], k, canonical, chunk)
+
+
+def fasta_kmer_counts(f, k, keys=None, canonical=True, workers=1,
+                      chunk=CHUNK):
+    """
+    the k-mer counts (as from kmer_counts()) over all of `keys` (default
+    all records) of the Fasta. with `workers` > 1, the records are
+    counted by that many processes.
+
+        >>> from pyfasta import Fasta
+        >>> f = Fasta('tests/data/three_chrs.fasta')
+        >>> codes, counts = fasta_kmer_counts(f, 2, ['chr1', 'chr2'])
+        >>> list(zip(decode_kmers(codes, 2), counts.tolist()))
+        [('AA', 77), ('AC', 20), ('AG', 20), ('AT', 1), ('CA', 20), ('GA', 19), ('TA', 1)]
+    """
+    keys = list(f.keys()) if keys is None else list(keys)
+    counter = _KmerCounter()
+    if workers <= 1 or len(keys) < 2:
+        for key in keys:
+            counter.add(*kmer_counts(f[key], k, canonical, chunk))
+        return counter.result()
+
+    from multiprocessing import Pool
+    pool = Pool(min(workers, len(keys)), _init_worker, (f,))
+    try:
+        for res in pool.imap_unordered(_worker_kmers,
+                                       [(key, k, canonical, chunk)
+                                        for key in keys]):
+            counter.add(*res)
+    finally:
+        pool.terminate()
+        pool.join()
+    return counter.result()
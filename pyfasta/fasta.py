@@ -3,9 +3,14 @@ import string
 import os.path
 from collections import Mapping
 import sys
+from itertools import groupby
+from operator import itemgetter
 import numpy as np
 
-from records import NpyFastaRecord
+from records import NpyFastaRecord, _as_str, _as_bytes, _ref, _deref
+from records import is_up_to_date
+from cache import LRUCache
+from stats import _now
 
 # string.maketrans is bytes.maketrans in Python 3, but
 # we want to deal with strings instead of bytes
@@ -33,6 +38,113 @@ if sys.version_info[0] < 3:
     _complement = _complement.decode('latin-1')
 complement = lambda s: s.translate(_complement)
 
+# the same mapping as _complement as a 256-entry lookup table so that
+# whole uint8 views of the sequence can be complemented by numpy at once.
+_complement_table = np.arange(256, dtype=np.uint8)
+_complement_table[np.frombuffer(b'ATCGatcgNnXx', dtype=np.uint8)] = \
+        np.frombuffer(b'TAGCtagcNnXx', dtype=np.uint8)
+
+def _is_minus(strand):
+    return strand in (-1, '-1', '-')
+
+def _gather_index(starts, lens, reverse=None):
+    """Internal:
+    return the array of positions that concatenates the intervals
+    starting at `starts` with lengths `lens`. where `reverse` is True,
+    that interval is read from its last position backwards.
+
+        >>> _gather_index(np.array([10, 0]), np.array([3, 2]))
+        array([10, 11, 12,  0,  1])
+        >>> _gather_index(np.array([10, 0]), np.array([3, 2]),
+        ...               reverse=np.array([True, False]))
+        array([12, 11, 10,  0,  1])
+    """
+    offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+    np.cumsum(lens, out=offsets[1:])
+    within = np.arange(offsets[-1], dtype=np.int64) \
+            - np.repeat(offsets[:-1], lens)
+    if reverse is None:
+        return np.repeat(starts, lens) + within
+    base = np.where(reverse, starts + lens - 1, starts)
+    sign = np.where(reverse, -1, 1)
+    return np.repeat(base, lens) + np.repeat(sign, lens) * within
+
+# above this mean interval length, sequences() copies each interval
+# rather than gathering every base with one fancy-index.
+GATHER_MAX_MEAN = 64
+
+# bytes read at a time when parsing the fasta file.
+BLOCKSIZE = 1 << 22
+
+_whitespace = b" \t\r\n\x0b\x0c"
+
+def _gen_blocks(fh, blocksize=BLOCKSIZE):
+    """Internal:
+    parse the fasta in binary file-handle `fh` one block at a time.
+    generates (header, None) at the start of each record, then
+    (header, seq) for each chunk of its sequence with whitespace
+    removed. any sequence before the first header is generated with a
+    header of None. only the current block (plus at most a partial
+    header line) is held in memory.
+
+        >>> from io import BytesIO
+        >>> fh = BytesIO(b">a x\\nAC\\nG\\n>b\\n\\n>c\\r\\nTT\\r\\n")
+        >>> for header, seq in _gen_blocks(fh, 8):
+        ...     print(header.decode(), seq and seq.decode())
+        a x None
+        a x AC
+        a x G
+        b None
+        c None
+        c TT
+    """
+    header = None
+    in_header = False
+    # start as if just after a newline so a '>' at the very start of the
+    # file is found as the start of a header.
+    rest = b"\n"
+    while True:
+        block = fh.read(blocksize)
+        eof = not block
+        data = rest + block
+        n = len(data)
+        pos = 0
+        while pos < n or (eof and in_header):
+            if in_header:
+                nl = data.find(b"\n", pos)
+                if nl == -1:
+                    if not eof: break
+                    nl = n
+                header = data[pos:nl].strip()
+                yield header, None
+                in_header = False
+                # keep the newline so a following '>' is found.
+                pos = nl
+                continue
+
+            gt = data.find(b"\n>", pos)
+            # hold back the last byte, it could be a newline before a '>'.
+            end = n if eof else n - 1
+            if gt != -1: end = gt
+            if end > pos:
+                seq = data[pos:end].translate(None, _whitespace)
+                if seq: yield header, seq
+            if gt == -1:
+                pos = end
+                break
+            pos = gt + 2
+            in_header = True
+
+        rest = data[pos:]
+        if eof: break
+
+def _getdata(rec, islice):
+    """the sequence in `islice` of a record as an 'S1' array. records
+    that have a getdata() method return it without decoding to str."""
+    if hasattr(rec, 'getdata'):
+        return rec.getdata(islice)
+    return np.frombuffer(_as_bytes(rec[islice]), dtype='S1')
+
 class FastaNotFound(Exception): pass
 
 class DuplicateHeaderException(Exception):
@@ -41,7 +153,9 @@ class DuplicateHeaderException(Exception):
 
 class Fasta(Mapping):
     def __init__(self, fasta_name, record_class=NpyFastaRecord,
-                flatten_inplace=False, key_fn=None):
+                flatten_inplace=False, key_fn=None, workers=1,
+                record_cache=None, slice_cache_bytes=0, output='str',
+                stats=None):
         """
             >>> from pyfasta import Fasta, FastaRecord
 
@@ -62,17 +176,138 @@ class Fasta(Mapping):
             >>> print(f['chr1'][0:10:3])
             AGTC
 
+        when the file needs to be flattened, `workers` > 1 splits the
+        work across that many processes. the result is the same.
+
+        record objects are kept in `self.chr` as they are requested. by
+        default all are kept, `record_cache`=N keeps only the N most
+        recently used. with `slice_cache_bytes` > 0, the sequence
+        fetched by sequence() is cached (up to that many bytes) so hot
+        regions are not decoded again. see cache_info().
+
+        slices of records are returned as `output`: 'str' or, for record
+        classes that support it, 'bytes' or 'memoryview' (a read-only
+        view of the file where possible). see record_class.outputs.
+
+        with `stats` (True, or a pyfasta.stats.Stats to pass a callback),
+        the time to build or load the index and of each phase of
+        prepare(), the slices and bytes served by the records and the
+        calls to sequence() are counted, see stats_info(). without it
+        nothing is added to those calls.
         """
         if not os.path.exists(fasta_name):
             raise FastaNotFound('"' + fasta_name + '"')
+        if output not in record_class.outputs:
+            raise ValueError("%s does not support output=%r, use one of %s"
+                             % (record_class.__name__, output,
+                                record_class.outputs))
         self.fasta_name = fasta_name
         self.record_class = record_class
+        self.output = output
         self.key_fn = key_fn
-        self.index, self.prepared = self.record_class.prepare(self,
-                                              self.gen_seqs_with_headers(key_fn),
+        self.workers = workers
+        if stats is True:
+            from stats import Stats
+            stats = Stats()
+        self.stats = stats
+        self._record_class = record_class
+        if stats is not None:
+            built = not record_class.is_current(fasta_name) \
+                    if record_class.on_disk else None
+            t = _now()
+        # some record classes index the full header and apply key_fn later.
+        gen = self.gen_blocks_with_headers(None if record_class.full_headers
+                                           else key_fn)
+        self.index, self.prepared = self.record_class.prepare(self, gen,
                                               flatten_inplace)
+        if stats is not None:
+            t = _now() - t
+            stats.index = {'built': built, 'seconds': t}
+            stats.add_time(record_class.__name__ + '.prepare', t)
+            self._record_class = stats.instrument(record_class)
+            self.sequence = stats.timed('Fasta.sequence', self.sequence)
+
+        self.chr = LRUCache(record_cache)
+        self._gc_index = None
+        self.slice_cache = LRUCache(None, maxbytes=slice_cache_bytes) \
+                              if slice_cache_bytes else None
+
+    def __getstate__(self):
+        """
+        a Fasta is pickled as the path, record class and index file (if
+        any), memmaps are mapped again when it's unpickled, so sending
+        it to a worker process is cheap. the caches start out empty and
+        key_fn is not kept (it has already been applied to the index).
 
-        self.chr = {}
+            >>> import pickle
+            >>> f = Fasta('tests/data/three_chrs.fasta')
+            >>> g = pickle.loads(pickle.dumps(f, -1))
+            >>> print(g['chr1'][:4])
+            ACTG
+        """
+        state = dict(self.__dict__)
+        state['key_fn'] = None
+        # stats stay with this process.
+        state.pop('sequence', None)
+        state['stats'] = None
+        state['_record_class'] = self.record_class
+        state['_gc_index'] = None
+        state['prepared'] = _ref(self.prepared)
+        state['chr'] = self.chr.maxsize
+        state['slice_cache'] = self.slice_cache.maxbytes \
+                                if self.slice_cache is not None else None
+        return state
+
+    def __setstate__(self, state):
+        state['prepared'] = _deref(state['prepared'])
+        state['chr'] = LRUCache(state['chr'])
+        if state['slice_cache'] is not None:
+            state['slice_cache'] = LRUCache(None, maxbytes=state['slice_cache'])
+        self.__dict__.update(state)
+
+    def cache_info(self):
+        """
+        hits, misses and size of the record and slice caches.
+
+            >>> f = Fasta('tests/data/three_chrs.fasta', record_cache=1,
+            ...           slice_cache_bytes=1000)
+            >>> for i in range(2):
+            ...     s = f.sequence({'chr': 'chr1', 'start': 1, 'stop': 4})
+            >>> r = f['chr2']
+            >>> sorted(f.cache_info().items())
+            [('record_hits', 2), ('record_misses', 2), ('records', 1), ('slice_bytes', 4), ('slice_hits', 1), ('slice_misses', 1)]
+        """
+        info = {'record_hits': self.chr.hits,
+                'record_misses': self.chr.misses,
+                'records': len(self.chr)}
+        sc = self.slice_cache
+        info['slice_hits'] = sc.hits if sc is not None else 0
+        info['slice_misses'] = sc.misses if sc is not None else 0
+        info['slice_bytes'] = sc.nbytes if sc is not None else 0
+        return info
+
+    def stats_info(self):
+        """
+        the counters of `stats` (see pyfasta.stats.Stats.info()) and the
+        cache_info() with the hit ratio of each cache (None before any
+        lookup). None if the Fasta was made without stats.
+
+            >>> f = Fasta('tests/data/three_chrs.fasta', stats=True)
+            >>> r, r = f['chr1'], f['chr1']
+            >>> info = f.stats_info()
+            >>> info['index']['built'], info['record_hit_ratio']
+            (False, 0.5)
+        """
+        if self.stats is None:
+            return None
+        info = self.stats.info()
+        cache = self.cache_info()
+        for c in ('record', 'slice'):
+            n = cache[c + '_hits'] + cache[c + '_misses']
+            info[c + '_hit_ratio'] = cache[c + '_hits'] / float(n) if n \
+                                       else None
+        info['cache'] = cache
+        return info
 
     @classmethod
     def as_kmers(klass, seq, k, overlap=0):
@@ -83,37 +318,88 @@ class Fasta(Mapping):
             yield i, seq[i:i + k]
             i += k - overlap
 
-    def gen_seqs_with_headers(self, key_fn=None):
+    def windows(self, chrom, size, step=None, chunk=None):
+        """
+        every window of `size` bases, starting every `step` (default
+        `size`) bases, of the record `chrom` as a read-only 2-d 'S1'
+        array with one window per row. windows that would run past the
+        end of the record are not included.
+
+            >>> f = Fasta('tests/data/three_chrs.fasta')
+            >>> w = f.windows('chr1', 4, step=2)
+            >>> w.shape
+            (39, 4)
+            >>> w[1].tostring(), w[-1].tostring()
+            ('TGAC', 'ACTG')
+
+        for the memmap record classes the array is a strided view of the
+        file, so no sequence is read until it is used. other classes read
+        the record once. with `chunk`, generate (start, windows) for at
+        most `chunk` windows at a time instead, where start is the start
+        of the first window in the record; the other classes then only
+        read a chunk at a time.
+
+            >>> [(start, len(w)) for start, w in f.windows('chr1', 4, 2, chunk=16)]
+            [(0, 16), (32, 16), (64, 7)]
+        """
+        step = step or size
+        if size < 1 or step < 1:
+            raise ValueError("size and step must be positive")
+        rec = self[chrom]
+        n = max((len(rec) - size) // step + 1, 0)
+        if chunk is None:
+            return self._windows(rec, 0, n, size, step)
+        return ((i * step, self._windows(rec, i, min(i + chunk, n), size, step))
+                for i in range(0, n, chunk))
+
+    def _windows(self, rec, i, j, size, step):
+        """Internal: windows i..j of rec as a strided view."""
+        from numpy.lib.stride_tricks import as_strided
+        if j <= i:
+            w = np.zeros((0, size), dtype='S1')
+        else:
+            start = i * step
+            d = _getdata(rec, slice(start, start + (j - i - 1) * step + size))
+            d = d.view(np.ndarray)
+            w = as_strided(d, shape=(j - i, size),
+                           strides=(step * d.strides[0], d.strides[0]))
+        w.flags.writeable = False
+        return w
+
+    def gen_seqs_with_headers(self, key_fn=None, blocksize=BLOCKSIZE):
         """remove all newlines from the sequence in a fasta file
-        and generate starts, stops to be used by the record class"""
-        fh = open(self.fasta_name, 'r')
-        # do the flattening (remove newlines)
+        and generate (header, sequence) for each record. this holds
+        an entire sequence in memory, see gen_blocks_with_headers()
+        for the streaming version used to flatten the file.
+
+            >>> f = Fasta('tests/data/three_chrs.fasta')
+            >>> [(h, len(s)) for h, s in f.gen_seqs_with_headers()]
+            [('chr1', 80), ('chr2', 80), ('chr3', 3600)]
+        """
+        for header, blocks in groupby(self.gen_blocks_with_headers(key_fn,
+                                                  blocksize), itemgetter(0)):
+            yield header, _as_str(b"".join(b for _, b in blocks))
+
+    def gen_blocks_with_headers(self, key_fn=None, blocksize=BLOCKSIZE):
+        """read the fasta file in blocks of `blocksize` bytes and generate
+        (header, block) where the blocks of a record are consecutive and
+        have all whitespace removed. each record generates at least one
+        (possibly empty) block so that empty records are kept.
+        this is what is sent to record_class.prepare()"""
         # check of unique-ness of headers.
         seen_headers = set()
-        header = None
-        seqs = None
-        for line in fh:
-            line = line.rstrip()
-            if not line: continue
-            if line[0] == ">":
-                if seqs is not None:
-                    if header in seen_headers:
-                        raise DuplicateHeaderException(header)
-                    seen_headers.add(header)
-                    yield header, "".join(seqs)
-
-                header = line[1:].strip()
-                if key_fn is not None:
-                    header = key_fn(header)
-                seqs = []
-            else:
-                seqs.append(line)
-
-        if seqs:
-            if header in seen_headers:
-                raise DuplicateHeaderException(header)
-            yield header, "".join(seqs)
-        fh.close()
+        with open(self.fasta_name, 'rb') as fh:
+            for header, block in _gen_blocks(fh, blocksize):
+                if header is None: continue
+                if block is None:
+                    key = _as_str(header)
+                    if key_fn is not None:
+                        key = key_fn(key)
+                    if key in seen_headers:
+                        raise DuplicateHeaderException(key)
+                    seen_headers.add(key)
+                    block = b""
+                yield key, block
 
     def __len__(self):
         # might not work for all backends?
@@ -123,20 +409,37 @@ class Fasta(Mapping):
         return iter(self.index)
 
     def __getitem__(self, i):
-        if i in self.chr:
-            return self.chr[i]
-        c = self.index[i]
-        self.chr[i] = self.record_class(self.prepared, c[0], c[1])
-        return self.chr[i]
+        rec = self.chr.get(i)
+        if rec is None:
+            c = self.index[i]
+            rec = self.chr[i] = self._record_class(self.prepared, *c)
+            if self.output != 'str':
+                rec.output = self.output
+        return rec
+
+    def _slice(self, chrom, start, stop):
+        """Internal: self[chrom][start:stop] as an 'S1' array, without
+        decoding to a string, via the slice cache. the array may be a
+        view of the file or of the cache and should not be modified."""
+        if self.slice_cache is None:
+            return _getdata(self[chrom], slice(start, stop))
+        key = (chrom, start, stop)
+        d = self.slice_cache.get(key)
+        if d is None:
+            d = np.array(_getdata(self[chrom], slice(start, stop)))
+            d.flags.writeable = False
+            self.slice_cache[key] = d
+        return d
 
     def sequence(self, f, asstring=True, auto_rc=True
-            , exon_keys=None, one_based=True):
+            , exon_keys=None, one_based=True, output=None):
         """
         take a feature and use the start/stop or exon_keys to return
         the sequence from the assocatied fasta file:
         f: a feature
         asstring: if true, return the sequence as a string
                 : if false, return as a numpy array
+        output: one of 'str', 'bytes' or 'array' (overrides asstring)
         auto_rc : if True and the strand of the feature == -1, return
                   the reverse complement of the sequence
         one_based: if true, query is using 1 based closed intervals, if false
@@ -193,27 +496,336 @@ class Fasta(Mapping):
         the feature:
             >>> print(f.sequence(feat, exon_keys=('fake', 'also_fake')))
             ACTGACTGACT
+
+        the sequence is read as bytes and the reverse complement is done
+        with a lookup table on the (reversed) array so nothing is decoded
+        until the output is made.
+            >>> f.sequence({'start':10, 'stop':12, 'strand': -1, 'chr': 'chr3'},
+            ...            output='bytes') == b'TGC'
+            True
+            >>> f.sequence({'start':10, 'stop':12, 'strand': -1, 'chr': 'chr3'},
+            ...            output='array').tolist() == [b'T', b'G', b'C']
+            True
         """
         assert 'chr' in f and f['chr'] in self, (f, f['chr'], self.keys())
-        fasta    = self[f['chr']]
-        sequence = None
+        if output is None:
+            output = 'str' if asstring else 'array'
+        assert output in ('str', 'bytes', 'array'), output
+        d = None
         if not exon_keys is None:
-            sequence = self._seq_from_keys(f, fasta, exon_keys, one_based=one_based)
+            d = self._seq_from_keys(f, f['chr'], exon_keys, one_based=one_based)
 
-        if sequence is None:
+        if d is None:
             start = f['start'] - int(one_based)
-            sequence = fasta[start: f['stop']]
+            d = self._slice(f['chr'], start, f['stop'])
+
+        if auto_rc and _is_minus(f.get('strand')):
+            d = _complement_table[d.view(np.uint8)[::-1]].view('S1')
+
+        if output == 'array':
+            # slices can be views of the file (or the cache), copy those.
+            return d if d.flags.owndata and d.flags.writeable else d.copy()
+        d = d.tostring()
+        return d if output == 'bytes' else _as_str(d)
+
+    def sequences(self, chroms, starts, stops, strands=None, one_based=True,
+                  packed=False):
+        """
+        fetch many intervals at once. `chroms`, `starts`, `stops` and
+        (optionally) `strands` are parallel sequences with the same
+        meaning as the keys of the feature sent to `sequence()`.
+        intervals are clipped to the bounds of their record, so unlike
+        `sequence()`, where a negative (0-based) start counts back from
+        the end of the record as in a python slice, a start before the
+        record is read from position 0:
+
+            >>> f = Fasta('tests/data/three_chrs.fasta')
+            >>> print(f.sequences(['chr1'], [-1], [3], one_based=False)[0])
+            ACT
+            >>> f.sequence({'chr': 'chr1', 'start': -1, 'stop': 3},
+            ...            one_based=False)
+            ''
+
+        returns a list of strings, or, if `packed` is True, a tuple of
+        (buf, offsets) where `buf` is a numpy array of all the sequences
+        concatenated and sequence i is buf[offsets[i]:offsets[i + 1]].
+
+            >>> for s in f.sequences(['chr1', 'chr3', 'chr1'], [1, 10, 1],
+            ...                      [2, 12, 2], strands=[1, -1, '-']):
+            ...     print(s)
+            AC
+            TGC
+            GT
 
-        if auto_rc and f.get('strand') in (-1, '-1', '-'):
-            sequence = complement(sequence)[::-1]
+            >>> buf, offsets = f.sequences(['chr1', 'chr3'], [0, 10],
+            ...                    [2, 12], one_based=False, packed=True)
+            >>> print(buf.tostring().decode())
+            ACCA
+            >>> offsets.tolist()
+            [0, 2, 4]
+
+        with the default NpyFastaRecord, the offsets of all intervals
+        are resolved in one pass and the sequence is gathered from the
+        memmap with a single fancy-index, other record classes fall
+        back to slicing each interval. either way the file is read in
+        order of position, whatever the order of the intervals.
+        """
+        starts = np.asarray(starts, dtype=np.int64) - int(one_based)
+        stops = np.asarray(stops, dtype=np.int64)
+        if strands is None:
+            minus = np.zeros(len(starts), dtype=bool)
+        else:
+            minus = np.array([_is_minus(s) for s in strands], dtype=bool)
+        assert len(chroms) == len(starts) == len(stops) == len(minus)
+
+        if not issubclass(self.record_class, NpyFastaRecord):
+            # read in the order of the records and positions.
+            order = sorted(range(len(starts)),
+                           key=lambda i: (chroms[i], starts[i]))
+            seqs = [None] * len(starts)
+            for i in order:
+                d = _getdata(self[chroms[i]],
+                             slice(max(starts[i], 0), max(stops[i], 0)))
+                if minus[i]:
+                    d = _complement_table[d.view(np.uint8)[::-1]].view('S1')
+                seqs[i] = d
+            if not packed: return [_as_str(d.tostring()) for d in seqs]
+            lens = [len(d) for d in seqs]
+            offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+            np.cumsum(lens, out=offsets[1:])
+            return np.concatenate([np.zeros(0, dtype='S1')] + seqs), offsets
+
+        istarts, istops = self._flat_bounds(chroms, starts, stops)
+        lens = istops - istarts
+        offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+
+        flat = self.prepared.view(np.ndarray)
+        if len(lens) and offsets[-1] > GATHER_MAX_MEAN * len(lens):
+            # long intervals: a copy per interval is cheaper than
+            # building (and fancy-indexing with) an index per base.
+            buf = np.empty(offsets[-1], dtype=flat.dtype)
+            u = buf.view(np.uint8)
+            order = istarts.argsort(kind='mergesort').tolist()
+            istarts, offsets_ = istarts.tolist(), offsets.tolist()
+            lens_, minus_ = lens.tolist(), minus.tolist()
+            for i in order:
+                o, n, s = offsets_[i], lens_[i], istarts[i]
+                buf[o:o + n] = flat[s:s + n]
+                if minus_[i]:
+                    u[o:o + n] = _complement_table[u[o:o + n][::-1]]
+            minus = None
+        elif (np.diff(istarts) >= 0).all():
+            buf = flat[_gather_index(istarts, lens, reverse=minus)]
+        else:
+            # read the file in order and put each interval in its place.
+            order = istarts.argsort(kind='mergesort')
+            buf = np.empty(offsets[-1], dtype=flat.dtype)
+            buf[_gather_index(offsets[order], lens[order])] = \
+                    flat[_gather_index(istarts[order], lens[order],
+                                       reverse=minus[order])]
+        if minus is not None and minus.any():
+            rc = np.repeat(minus, lens)
+            u = buf.view(np.uint8)
+            u[rc] = _complement_table[u[rc]]
+
+        if packed:
+            return buf, offsets
+        s = buf.tostring().decode()
+        return [s[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def fetch_many(self, regions, max_workers=4):
+        """
+        fetch many regions with `max_workers` threads. each region is a
+        tuple of (chrom, start, stop) or (chrom, start, stop, strand) in
+        python (0-based, half-open) coordinates. minus strand regions are
+        reverse complemented. returns a list of strings in the order of
+        `regions`.
 
-        if asstring: return sequence
-        return np.array(sequence, dtype='c')
+            >>> f = Fasta('tests/data/three_chrs.fasta')
+            >>> f.fetch_many([('chr1', 0, 4), ('chr3', 9, 12, -1)], max_workers=2)
+            ['ACTG', 'TGC']
 
-    def _seq_from_keys(self, f, fasta, exon_keys, base='locations', one_based=True):
+        the reads release the GIL (memmap copies, os.pread) so threads
+        overlap i/o, e.g. on a network file system.
+        """
+        regions = list(regions)
+        if max_workers <= 1 or len(regions) < 2:
+            return [self._fetch(r) for r in regions]
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(max_workers, len(regions)))
+        try:
+            return pool.map(self._fetch, regions)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _fetch(self, region):
+        d = self._slice(*region[:3])
+        if len(region) > 3 and _is_minus(region[3]):
+            d = _complement_table[d.view(np.uint8)[::-1]].view('S1')
+        return _as_str(d.tostring())
+
+    def _flat_bounds(self, chroms, starts, stops):
+        """Internal: the positions in the flat file of the (0-based)
+        intervals, clipped to their records."""
+        keys, inv = np.unique(np.asarray(chroms), return_inverse=True)
+        bounds = np.array([self.index[k][:2] for k in keys.tolist()],
+                          dtype=np.int64).reshape(-1, 2)
+        rstarts, rstops = bounds[inv, 0], bounds[inv, 1]
+        istarts = np.clip(rstarts + starts, rstarts, rstops)
+        istops = np.clip(rstarts + stops, istarts, rstops)
+        return istarts, istops
+
+    def gc_index(self, step=None):
+        """
+        the GCIndex (see pyfasta.composition) of the flat file, saved as
+        fasta_name + '.gcx' and created if needed. an existing .gcx is
+        used unless a different `step` is given. only for record classes
+        with a flat memmap (NpyFastaRecord and subclasses).
+        """
+        from composition import GCIndex
+        gcx = self._gc_index
+        if gcx is None or step not in (None, gcx.step):
+            f = self.fasta_name + GCIndex.ext
+            if os.path.exists(f) and not (
+                    is_up_to_date(f, self.fasta_name) and
+                    is_up_to_date(f, self.fasta_name + self.record_class.idx)):
+                os.unlink(f)
+            gcx = self._gc_index = GCIndex(self.prepared, f, step)
+        return gcx
+
+    def gc(self, chrom, start=None, stop=None, counts=False):
+        """
+        the fraction of G + C in the non-N bases of chrom[start:stop]
+        (python coordinates) or, with counts=True, the array of counts
+        (gc, N, lower-case, length). see gc_many().
+
+            >>> f = Fasta('tests/data/three_chrs.fasta')
+            >>> f.gc('chr1'), f.gc('chr1', 0, 3), f.gc('chr2')
+            (0.5, 0.3333333333333333, 0.0)
+            >>> f.gc('chr3', 10, 20, counts=True).tolist()
+            [6, 0, 0, 10]
+        """
+        n = len(self[chrom])
+        start, stop, _ = slice(start, stop).indices(n)
+        res = self.gc_many([chrom], [start], [max(start, stop)], counts)
+        return res[0]
+
+    def gc_many(self, chroms, starts, stops, counts=False):
+        """
+        the GC fraction of many (0-based, half-open) intervals given as
+        parallel sequences, like sequences(). the fraction is of the bases
+        that are not N and is nan where there are none. with counts=True,
+        an array with a row of (gc, N, lower-case, length) counts for each
+        interval.
+
+        for record classes with a flat memmap, this uses the gc_index()
+        so each interval costs the same whatever its length and only a
+        few bases at its ends are read. other record classes read each
+        interval.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        assert len(chroms) == len(starts) == len(stops)
+        if issubclass(self.record_class, NpyFastaRecord):
+            istarts, istops = self._flat_bounds(chroms, starts, stops)
+            gcx = self.gc_index()
+            c = gcx.counts(np.concatenate((istarts, istops)))
+            n = len(istarts)
+            res = np.column_stack((c[n:] - c[:n], istops - istarts))
+        else:
+            from composition import _gcx_table
+            res = np.zeros((len(starts), 4), dtype=np.int64)
+            for i, (chrom, start, stop) in enumerate(zip(chroms, starts,
+                                                         stops)):
+                d = _getdata(self[chrom], slice(max(start, 0), max(stop, 0)))
+                res[i, :3] = _gcx_table[d.view(np.uint8)].sum(axis=0)
+                res[i, 3] = len(d)
+        if counts:
+            return res
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return res[:, 0] / (res[:, 3] - res[:, 1]).astype(float)
+
+    def kmer_counts(self, k, keys=None, canonical=True, workers=1):
+        """
+        count the k-mers (k <= 32) in the records `keys` (default all),
+        skipping any with a base other than ACGT. returns the sorted
+        array of k-mer codes and their counts, see
+        pyfasta.composition.kmer_counts() and decode_kmers(). with
+        `workers` > 1, the records are counted by a process pool.
+
+            >>> from pyfasta.composition import decode_kmers
+            >>> f = Fasta('tests/data/three_chrs.fasta')
+            >>> codes, counts = f.kmer_counts(4, ['chr1'])
+            >>> decode_kmers(codes, 4), counts.tolist()
+            (['ACTG', 'AGTC', 'CTGA', 'GTCA'], [20, 19, 19, 19])
+        """
+        from composition import fasta_kmer_counts
+        return fasta_kmer_counts(self, k, keys, canonical, workers)
+
+    def transcripts(self, features, exon_keys=('exons',), one_based=True,
+                    output='str', workers=1):
+        """
+        the spliced sequence of many features at once. `features` is a
+        dict (or an iterable of (name, feature) pairs) of features as
+        sent to sequence() with `exon_keys`: the exons of each are joined
+        in order and minus strand features are reverse complemented. a
+        feature without any of the exon_keys uses its start and stop.
+        returns a dict of name -> sequence as 'str', 'bytes' or 'array'.
+
+            >>> f = Fasta('tests/data/three_chrs.fasta')
+            >>> exons = [(9, 11), (13, 15), (17, 19)]
+            >>> ts = f.transcripts({'a': dict(chr='chr1', strand=1, exons=exons),
+            ...                     'b': dict(chr='chr1', strand=-1, exons=exons)})
+            >>> print(ts['a'], ts['b'])
+            ACTACTACT AGTAGTAGT
+
+        the exons of all the features on a chromosome are gathered into
+        one buffer by a single call to sequences(), and reverse
+        complemented there, so the time is linear in the number of exons
+        and bases. with `workers` > 1 the chromosomes are read by a pool
+        of threads.
+        """
+        from intervals import spliced_sequences
+        assert output in ('str', 'bytes', 'array'), output
+        items = features.items() if hasattr(features, 'items') else features
+        by_chrom = {}
+        for name, feat in items:
+            fbase = feat.get('locations', feat)
+            locs = next((fbase[ek] for ek in exon_keys if ek in fbase), None)
+            if locs is None:
+                locs = [(feat['start'], feat['stop'])]
+            by_chrom.setdefault(feat['chr'], []).append(
+                (name, feat['chr'], feat.get('strand'),
+                 [start - int(one_based) for start, _ in locs],
+                 [stop for _, stop in locs]))
+
+        def _spliced(regions):
+            buf, offsets = spliced_sequences(self, regions)
+            if output != 'array':
+                buf = buf.tostring()
+                if output == 'str': buf = _as_str(buf)
+            bounds = zip(offsets[:-1].tolist(), offsets[1:].tolist())
+            return [(r[0], buf[a:b]) for r, (a, b) in zip(regions, bounds)]
+
+        groups = list(by_chrom.values())
+        if workers <= 1 or len(groups) < 2:
+            results = [_spliced(g) for g in groups]
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(workers, len(groups)))
+            try:
+                results = pool.map(_spliced, groups)
+            finally:
+                pool.terminate()
+                pool.join()
+        return dict(item for r in results for item in r)
+
+    def _seq_from_keys(self, f, chrom, exon_keys, base='locations', one_based=True):
         """Internal:
         f: a feature dict
-        fasta: a Fasta object
+        chrom: the key of the record in this Fasta
         exon_keys: an iterable of keys, to look for start/stop
                    arrays to get sequence.
         base: if base ('locations') exists, look there fore the
@@ -226,8 +838,7 @@ class Fasta(Mapping):
         for ek in exon_keys:
             if not ek in fbase: continue
             locs = fbase[ek]
-            seq = ""
-            for start, stop in locs:
-                seq += fasta[start - int(one_based):stop]
-            return seq
+            return np.concatenate([np.zeros(0, dtype='S1')] +
+                                  [self._slice(chrom, start - int(one_based), stop)
+                                   for start, stop in locs])
         return None
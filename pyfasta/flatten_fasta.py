@@ -0,0 +1,168 @@
+"""
+flatten a (large) fasta file using multiple processes.
+
+the file is cut into byte ranges at line starts. each range is scanned
+in a separate process for headers and sequence lengths, those are merged
+to lay out the flattened file, then each range is flattened into its
+place in the (preallocated) flat file. the result is identical to
+flattening in a single process.
+"""
+import os
+from multiprocessing import Pool
+
+from fasta import _gen_blocks, DuplicateHeaderException, BLOCKSIZE
+from records import _as_str, _as_bytes
+
+
+class _RangeReader(object):
+    """file-like that reads only bytes start..stop of fh"""
+    def __init__(self, fh, start, stop):
+        fh.seek(start)
+        self.fh = fh
+        self.left = stop - start
+
+    def read(self, n):
+        n = min(n, self.left)
+        self.left -= n
+        return self.fh.read(n)
+
+
+def split_ranges(fasta_name, n, chunk=65536):
+    """
+    return the boundaries of (at most) `n` byte ranges of the file that
+    all start at the start of a line.
+
+        >>> split_ranges('tests/data/key.fasta', 3)
+        [0, 11, 22, 33]
+    """
+    size = os.path.getsize(fasta_name)
+    bounds = [0]
+    with open(fasta_name, 'rb') as fh:
+        for i in range(1, n):
+            pos = max(size * i // n, bounds[-1] + 1)
+            # advance to just after the next newline.
+            fh.seek(pos - 1)
+            while True:
+                data = fh.read(chunk)
+                if not data:
+                    pos = size
+                    break
+                nl = data.find(b"\n")
+                if nl != -1:
+                    pos += nl
+                    break
+                pos += len(data)
+            if pos >= size: break
+            bounds.append(pos)
+    bounds.append(size)
+    return bounds
+
+
+def _scan_range(args):
+    """
+    return a list of [header, nbases] for the range. the first has
+    a header of None and is the sequence continued from the previous
+    range.
+    """
+    fasta_name, start, stop, blocksize = args
+    segments = [[None, 0]]
+    with open(fasta_name, 'rb') as fh:
+        for header, block in _gen_blocks(_RangeReader(fh, start, stop),
+                                         blocksize):
+            if block is None:
+                segments.append([header, 0])
+            else:
+                segments[-1][1] += len(block)
+    return segments
+
+
+def _write_range(args):
+    """
+    write the sequence in the range to the flat file. `positions` has
+    where to write each of the segments found by _scan_range().
+    """
+    fasta_name, flat_name, start, stop, blocksize, positions = args
+    positions = iter(positions)
+    pos = next(positions)
+    skip = pos is None
+    with open(fasta_name, 'rb') as fh:
+        with open(flat_name, 'r+b') as out:
+            if not skip: out.seek(pos)
+            for header, block in _gen_blocks(_RangeReader(fh, start, stop),
+                                             blocksize):
+                if block is None:
+                    out.seek(next(positions))
+                    skip = False
+                elif not skip:
+                    out.write(block)
+
+
+def flatten_parallel(fasta_name, flat_name, key_fn=None,
+                     flatten_inplace=False, workers=2, blocksize=BLOCKSIZE):
+    """
+    flatten `fasta_name` to `flat_name` with `workers` processes.
+    returns the index: a dict of seqid => (start, stop).
+    """
+    # more ranges than workers so a slow range doesnt hold up the rest.
+    bounds = split_ranges(fasta_name, workers * 4)
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    pool = Pool(workers)
+    try:
+        scans = pool.map(_scan_range, [(fasta_name, start, stop, blocksize)
+                                       for start, stop in ranges])
+
+        # merge the segments into records in file order. each segment is
+        # recorded as (record number, offset in that record).
+        records = []
+        seen_headers = set()
+        plans = []
+        for segments in scans:
+            lead = segments[0][1]
+            if records:
+                plan = [(len(records) - 1, records[-1][1])]
+                records[-1][1] += lead
+            else:
+                # sequence before the first header is dropped.
+                plan = [None]
+            for header, nbases in segments[1:]:
+                key = _as_str(header)
+                if key_fn is not None:
+                    key = key_fn(key)
+                if key in seen_headers:
+                    raise DuplicateHeaderException(key)
+                seen_headers.add(key)
+                plan.append((len(records), 0))
+                records.append([key, nbases])
+            plans.append(plan)
+
+        idx = {}
+        starts = []
+        headers = []
+        pos = 0
+        for i, (key, nbases) in enumerate(records):
+            if flatten_inplace:
+                fmt = '>%s\n' if i == 0 else '\n>%s\n'
+                header = _as_bytes(fmt % key)
+                headers.append((pos, header))
+                pos += len(header)
+            starts.append(pos)
+            idx[key] = (pos, pos + nbases)
+            pos += nbases
+
+        with open(flat_name, 'wb') as out:
+            out.truncate(pos)
+            for hpos, header in headers:
+                out.seek(hpos)
+                out.write(header)
+
+        jobs = []
+        for (start, stop), plan in zip(ranges, plans):
+            positions = [None if p is None else starts[p[0]] + p[1]
+                         for p in plan]
+            jobs.append((fasta_name, flat_name, start, stop, blocksize,
+                         positions))
+        pool.map(_write_range, jobs)
+    finally:
+        pool.terminate()
+        pool.join()
+    return idx
@@ -0,0 +1,172 @@
+"""
+read regions from BED and GFF/GTF files and write their sequence in
+batches, for `pyfasta extract --bed/--gff`.
+
+a region is (name, chrom, strand, starts, stops) in python (0-based,
+half-open) coordinates. a region with more than one interval (BED12
+blocks, the exons of a transcript) is spliced: its intervals are joined
+in order along the chromosome and, on the minus strand, the whole is
+reverse complemented.
+"""
+import re
+import numpy as np
+
+from fasta import _is_minus
+from records import _as_bytes
+
+# the number of intervals fetched at a time.
+BATCH = 100000
+
+
+def read_bed(lines):
+    """
+    generate a region for each line of a BED file. the name is the 4th
+    column or, without one, chrom:start-stop. BED12 lines are split
+    into their blocks.
+
+    >>> for r in read_bed(['track name=x', 'chr1\\t10\\t20',
+    ...                    'chr1\\t0\\t30\\tgene\\t0\\t-\\t0\\t30\\t0\\t2\\t5,5,\\t0,25,']):
+    ...     print(r)
+    ('chr1:10-20', 'chr1', '+', [10], [20])
+    ('gene', 'chr1', '-', [0, 25], [5, 30])
+    """
+    for line in lines:
+        if line.startswith(('#', 'track', 'browser')) or not line.strip():
+            continue
+        cols = line.rstrip('\r\n').split('\t')
+        chrom, start, stop = cols[0], int(cols[1]), int(cols[2])
+        name = cols[3] if len(cols) > 3 else "%s:%i-%i" % (chrom, start, stop)
+        strand = cols[5] if len(cols) > 5 else '+'
+        if len(cols) >= 12 and int(cols[9]) > 1:
+            sizes = [int(x) for x in cols[10].rstrip(',').split(',')]
+            offsets = [int(x) for x in cols[11].rstrip(',').split(',')]
+            yield (name, chrom, strand, [start + o for o in offsets],
+                   [start + o + s for o, s in zip(offsets, sizes)])
+        else:
+            yield name, chrom, strand, [start], [stop]
+
+
+_gtf_id = re.compile(r'transcript_id\s+"?([^";]+)"?')
+_gff_parent = re.compile(r'(?:^|;)\s*Parent=([^;]+)')
+
+
+def read_gff(lines, feature='exon'):
+    """
+    the regions of a GFF3 or GTF file: the features of type `feature`
+    grouped by their transcript (the transcript_id of a GTF or the
+    Parent of a GFF3), in the order each transcript is first seen.
+    the whole file is read before the first region is returned.
+
+    >>> gtf = ['chr1\\tx\\texon\\t21\\t30\\t.\\t-\\t.\\ttranscript_id "t1";',
+    ...        'chr1\\tx\\tCDS\\t21\\t30\\t.\\t-\\t.\\ttranscript_id "t1";',
+    ...        'chr1\\tx\\texon\\t1\\t10\\t.\\t-\\t.\\ttranscript_id "t1";']
+    >>> read_gff(gtf)
+    [('t1', 'chr1', '-', [0, 20], [10, 30])]
+    """
+    regions = {}
+    order = []
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        cols = line.rstrip('\r\n').split('\t')
+        if len(cols) < 9 or cols[2] != feature:
+            continue
+        chrom, start, stop, strand = cols[0], int(cols[3]) - 1, int(cols[4]), cols[6]
+        m = _gtf_id.search(cols[8])
+        if m is not None:
+            names = [m.group(1)]
+        else:
+            m = _gff_parent.search(cols[8])
+            names = m.group(1).split(',') if m else \
+                    ["%s:%i-%i" % (chrom, start, stop)]
+        for name in names:
+            if name not in regions:
+                regions[name] = (chrom, strand, [])
+                order.append(name)
+            regions[name][2].append((start, stop))
+    result = []
+    for name in order:
+        chrom, strand, exons = regions[name]
+        exons.sort()
+        result.append((name, chrom, strand, [e[0] for e in exons],
+                       [e[1] for e in exons]))
+    return result
+
+
+def spliced_sequences(f, regions):
+    """
+    the sequence of each of the `regions` of Fasta `f`, all fetched by
+    one call to f.sequences(), as (buf, offsets) where the sequence of
+    region i is buf[offsets[i]:offsets[i + 1]].
+
+    >>> from pyfasta import Fasta
+    >>> f = Fasta('tests/data/three_chrs.fasta')
+    >>> buf, offsets = spliced_sequences(f, [('a', 'chr1', '-', [0, 8], [2, 10])])
+    >>> print(buf.tostring().decode())
+    GTGT
+    >>> offsets.tolist()
+    [0, 4]
+    """
+    regions = list(regions)
+    chroms, starts, stops, strands, counts = [], [], [], [], []
+    for name, chrom, strand, rstarts, rstops in regions:
+        minus = _is_minus(strand)
+        if minus:
+            # the last interval's reverse complement comes first.
+            rstarts, rstops = rstarts[::-1], rstops[::-1]
+        chroms.extend([chrom] * len(rstarts))
+        starts.extend(rstarts)
+        stops.extend(rstops)
+        strands.extend([-1 if minus else 1] * len(rstarts))
+        counts.append(len(rstarts))
+    for chrom in set(chroms):
+        if chrom not in f:
+            name = next(r[0] for r in regions if r[1] == chrom)
+            raise KeyError("%s (of %s) is not a sequence in %s"
+                           % (chrom, name, f.fasta_name))
+    buf, offsets = f.sequences(chroms, starts, stops, strands,
+                               one_based=False, packed=True)
+    ends = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=ends[1:])
+    return buf, offsets[ends]
+
+
+def write_regions(f, regions, out, format='fasta', batch=BATCH):
+    """
+    write the sequence of each of the `regions` to the binary file `out`
+    as fasta ('>name' then the sequence) or tsv (name, tab, sequence).
+    regions are fetched about `batch` intervals at a time, so any number
+    of them can be streamed.
+
+    >>> import sys
+    >>> from pyfasta import Fasta
+    >>> f = Fasta('tests/data/three_chrs.fasta')
+    >>> out = getattr(sys.stdout, 'buffer', sys.stdout)
+    >>> write_regions(f, read_bed(['chr1\\t0\\t4', 'chr1\\t0\\t4\\tr\\t0\\t-']),
+    ...               out, 'tsv') # doctest: +NORMALIZE_WHITESPACE
+    chr1:0-4	ACTG
+    r	CAGT
+    """
+    sep = b"\t" if format == 'tsv' else b"\n"
+    chunk = []
+    n = 0
+    for region in regions:
+        chunk.append(region)
+        n += len(region[3])
+        if n >= batch:
+            _write_chunk(f, chunk, out, format, sep)
+            chunk, n = [], 0
+    if chunk:
+        _write_chunk(f, chunk, out, format, sep)
+    out.flush()
+
+
+def _write_chunk(f, regions, out, format, sep):
+    buf, offsets = spliced_sequences(f, regions)
+    seq = buf.tostring()
+    parts = []
+    start = b">" if format == 'fasta' else b""
+    for region, a, b in zip(regions, offsets[:-1].tolist(),
+                            offsets[1:].tolist()):
+        parts.append(start + _as_bytes(region[0]) + sep + seq[a:b] + b"\n")
+    out.write(b"".join(parts))
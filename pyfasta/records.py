@@ -2,8 +2,20 @@ import cPickle
 import numpy as np
 import sys
 import os
+import gzip
+import zlib
+import warnings
+import threading
+from contextlib import closing
+from itertools import groupby
+from operator import itemgetter
+from collections import Mapping
 
-__all__ = ['FastaRecord', 'NpyFastaRecord', 'MemoryRecord']
+from cache import LRUCache
+from stats import phase
+
+__all__ = ['FastaRecord', 'NpyFastaRecord', 'MemoryRecord', 'FaidxRecord',
+           'TwoBitRecord', 'UcscTwoBitRecord', 'BgzfRecord']
 
 MAGIC = "@flattened@"
 
@@ -11,15 +23,228 @@ def is_up_to_date(a, b):
     return os.path.exists(a) and os.stat(a).st_mtime >= os.stat(b).st_mtime
 
 
+def _as_str(s):
+    # headers and sequence are read as bytes.
+    return s if isinstance(s, str) else s.decode()
+
+def _as_bytes(s):
+    return s if isinstance(s, bytes) else s.encode()
+
+def _as_output(d, output):
+    """
+    an 'S1' array of sequence as a str, bytes or a read-only memoryview.
+    a contiguous slice of a memmap is not copied for 'memoryview'.
+    a single position (0-d) is given as bytes for 'memoryview'.
+    """
+    if output == 'str':
+        return d.tostring().decode()
+    if output == 'bytes' or np.ndim(d) == 0:
+        return d.tostring()
+    if not d.flags.c_contiguous:
+        # a step was given.
+        d = np.ascontiguousarray(d)
+    d = d.view(np.uint8)
+    d.flags.writeable = False
+    return memoryview(d)
+
 def ext_is_flat(ext):
     with open(ext) as fh:
         t = fh.read(len(MAGIC))
     return MAGIC == t
 
+class _MemmapRef(object):
+    """
+    stands in for a read-only np.memmap when pickling so the file is
+    mapped again when unpickled rather than its data being copied.
+    """
+    def __init__(self, mm):
+        self.args = (mm.filename, mm.dtype.str, mm.offset, mm.shape)
+
+    def open(self):
+        filename, dtype, offset, shape = self.args
+        return np.memmap(filename, dtype=dtype, mode="r", offset=offset,
+                         shape=shape)
+
+def _ref(v):
+    return _MemmapRef(v) if isinstance(v, np.memmap) and v.filename else v
+
+def _deref(v):
+    return v.open() if isinstance(v, _MemmapRef) else v
+
+
+class PositionalFile(object):
+    """
+    a file that is read by position with os.pread so one instance can be
+    shared by threads (there is no file position to seek). where there
+    is no os.pread (python 2, windows) a lock is held for seek + read.
+    """
+    _pread = getattr(os, 'pread', None)
+
+    def __init__(self, name):
+        self.name = name
+        self.fd = None
+        self.fd = os.open(name, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.lock = threading.Lock() if self._pread is None else None
+
+    def pread(self, n, offset):
+        """read `n` bytes (fewer at the end of the file) at `offset`"""
+        if self._pread is None:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                return self._read_all(os.read, n)
+        return self._read_all(lambda fd, k: self._pread(fd, k, offset + n - k), n)
+
+    def _read_all(self, read, n):
+        chunks = []
+        while n > 0:
+            data = read(self.fd, n)
+            if not data: break
+            chunks.append(data)
+            n -= len(data)
+        return b"".join(chunks)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __getstate__(self):
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'])
+
+    def __del__(self):
+        self.close()
+
+
+def _key_hash(k):
+    # a 64 bit hash of the bytes `k` that is the same in every process.
+    return (zlib.crc32(k) & 0xffffffff) << 32 | (zlib.adler32(k) & 0xffffffff)
+
+
+class FlatIndex(Mapping):
+    """
+    the index of seqid => (start, stop) written to the .gdx file. the
+    file is memory-mapped rather than loaded so opening it takes the same
+    time for any number of records and the pages are shared between
+    processes. the layout (all integers are little-endian):
+
+        magic (8 bytes), n, length of the key blob,
+        hashes (n, uint64), key offsets (n + 1), starts (n), stops (n),
+        the keys (utf-8) concatenated.
+
+    records are sorted by the hash of their key so a lookup is a binary
+    search (np.searchsorted) of the hashes and a compare of the key.
+
+        >>> FlatIndex.write('/tmp/_pyfasta_test.gdx', {'b': (3, 5), 'a': (0, 3)})
+        >>> idx = FlatIndex('/tmp/_pyfasta_test.gdx')
+        >>> sorted(idx.items()), 'c' in idx
+        ([('a', (0, 3)), ('b', (3, 5))], False)
+        >>> os.unlink('/tmp/_pyfasta_test.gdx')
+    """
+    magic = b"PYFAGDX1"
+
+    def __init__(self, filename):
+        mm = np.memmap(filename, dtype=np.uint8, mode="r")
+        n, nblob = mm[8:24].view('<i8')
+        n, pos = int(n), 24
+        self.hashes = mm[pos:pos + 8 * n].view('<u8')
+        pos += 8 * n
+        self.koffsets = mm[pos:pos + 8 * (n + 1)].view('<i8')
+        pos += 8 * (n + 1)
+        self.starts = mm[pos:pos + 8 * n].view('<i8')
+        pos += 8 * n
+        self.stops = mm[pos:pos + 8 * n].view('<i8')
+        pos += 8 * n
+        self.blob = mm[pos:pos + nblob]
+        self.n = n
+        self.filename = filename
+
+    def __reduce__(self):
+        return (FlatIndex, (self.filename,))
+
+    @classmethod
+    def is_flat_index(klass, filename):
+        with open(filename, 'rb') as fh:
+            return fh.read(len(klass.magic)) == klass.magic
+
+    @classmethod
+    def write(klass, filename, idx):
+        keys = list(idx)
+        bkeys = [_as_bytes(k) for k in keys]
+        hashes = np.array([_key_hash(b) for b in bkeys], dtype='<u8')
+        order = hashes.argsort(kind='mergesort')
+        hashes = hashes[order]
+        bkeys = [bkeys[i] for i in order]
+        koffsets = np.zeros(len(keys) + 1, dtype='<i8')
+        np.cumsum([len(b) for b in bkeys], out=koffsets[1:])
+        bounds = np.array([idx[keys[i]][:2] for i in order],
+                          dtype='<i8').reshape(-1, 2)
+        # write a new file rather than truncate one that may be mapped.
+        tmp = filename + ".tmp%i" % os.getpid()
+        with open(tmp, 'wb') as fh:
+            fh.write(klass.magic)
+            fh.write(np.array([len(keys), koffsets[-1]], dtype='<i8').tostring())
+            fh.write(hashes.tostring())
+            fh.write(koffsets.tostring())
+            fh.write(bounds[:, 0].tostring())
+            fh.write(bounds[:, 1].tostring())
+            fh.write(b"".join(bkeys))
+        os.rename(tmp, filename)
+
+    def _key(self, i):
+        return self.blob[self.koffsets[i]:self.koffsets[i + 1]].tostring()
+
+    def _find(self, key):
+        try:
+            k = _as_bytes(key)
+        except AttributeError:
+            return -1
+        h = np.uint64(_key_hash(k))
+        i = int(self.hashes.searchsorted(h))
+        while i < self.n and self.hashes[i] == h:
+            if self._key(i) == k: return i
+            i += 1
+        return -1
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i == -1:
+            raise KeyError(key)
+        return int(self.starts[i]), int(self.stops[i])
+
+    def __contains__(self, key):
+        return self._find(key) != -1
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield _as_str(self._key(i))
+
+    def __len__(self):
+        return self.n
+
+    def items(self):
+        # all at once rather than a lookup per key.
+        blob = self.blob.tostring()
+        koffsets = self.koffsets.tolist()
+        return [(_as_str(blob[a:b]), (start, stop)) for a, b, start, stop in
+                zip(koffsets[:-1], koffsets[1:], self.starts.tolist(),
+                    self.stops.tolist())]
+
+
 class FastaRecord(object):
     __slots__ = ('fh', 'start', 'stop')
     ext = ".flat"
     idx = ".gdx"
+    # what can be sent as `output` to Fasta().
+    outputs = ('str',)
+    # if True, prepare() gets the full headers rather than the result of
+    # key_fn and write_index() applies the key_fn.
+    full_headers = False
+    # False for the classes that write no index to disk, so there is
+    # nothing to build or load.
+    on_disk = True
 
     @classmethod
     def is_current(klass, fasta_name):
@@ -36,6 +261,19 @@ class FastaRecord(object):
     def __len__(self):
         return self.stop - self.start
 
+    def __getstate__(self):
+        # a memmap is pickled as its filename and mapped again.
+        state = dict(getattr(self, '__dict__', {}))
+        for klass in type(self).__mro__:
+            for k in getattr(klass, '__slots__', ()):
+                if hasattr(self, k):
+                    state[k] = _ref(getattr(self, k))
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, _deref(v))
+
     @classmethod
     def prepare(klass, fasta_obj, seqinfo_generator, flatten_inplace):
         """
@@ -43,37 +281,77 @@ class FastaRecord(object):
         """
         f = fasta_obj.fasta_name
         if klass.is_current(f):
-            with open(f + klass.idx, 'rb') as fh:
-                idx = cPickle.load(fh)
-            if flatten_inplace or ext_is_flat(f + klass.ext): flat = klass.modify_flat(f)
-            else: flat = klass.modify_flat(f + klass.ext)
+            with phase(fasta_obj, 'load_index'):
+                idx = klass.load_index(f + klass.idx)
+            with phase(fasta_obj, 'map'):
+                if flatten_inplace or ext_is_flat(f + klass.ext): flat = klass.modify_flat(f)
+                else: flat = klass.modify_flat(f + klass.ext)
             if flatten_inplace and not ext_is_flat(f + klass.ext):
                 del flat
             else:
                 return idx, flat
 
-        idx = {}
-        with open(f + klass.ext, 'w') as flatfh:
-            for i, (seqid, seq) in enumerate(seqinfo_generator):
-                if flatten_inplace:
-                    if i == 0:
-                        flatfh.write('>%s\n' % seqid)
-                    else:
-                        flatfh.write('\n>%s\n' % seqid)
-                start = flatfh.tell()
-                flatfh.write(seq)
-                stop = flatfh.tell()
-                idx[seqid] = (start, stop)
+        # the fasta is parsed as it's written.
+        with phase(fasta_obj, 'write_flat'):
+            idx = klass.write_flat(fasta_obj, seqinfo_generator,
+                                   f + klass.ext, flatten_inplace)
 
         if flatten_inplace:
-            klass.copy_inplace(flatfh.name, f)
-            with open(f + klass.idx, 'wb') as fh:
-                cPickle.dump(idx, fh, -1)
-            return idx, klass.modify_flat(f)
+            with phase(fasta_obj, 'copy_inplace'):
+                klass.copy_inplace(f + klass.ext, f)
+        with phase(fasta_obj, 'write_index'):
+            klass.write_index(f + klass.idx, idx, fasta_obj.key_fn)
+        with phase(fasta_obj, 'load_index'):
+            idx = klass.load_index(f + klass.idx)
+        with phase(fasta_obj, 'map'):
+            return idx, klass.modify_flat(f if flatten_inplace
+                                          else f + klass.ext)
 
-        with open(f + klass.idx, 'wb') as fh:
-            cPickle.dump(idx, fh, -1)
-        return idx, klass.modify_flat(f + klass.ext)
+    @classmethod
+    def write_index(klass, idx_name, idx, key_fn=None):
+        """save the dict of seqid => (start, stop) as a FlatIndex.
+        the keys already have the key_fn applied."""
+        FlatIndex.write(idx_name, idx)
+
+    @classmethod
+    def load_index(klass, idx_name):
+        """
+        open the FlatIndex in idx_name. a .gdx pickled by an older
+        version is converted (the sequence need not be flattened again).
+        """
+        if not FlatIndex.is_flat_index(idx_name):
+            with open(idx_name, 'rb') as fh:
+                idx = cPickle.load(fh)
+            klass.write_index(idx_name, idx)
+        return FlatIndex(idx_name)
+
+    @classmethod
+    def write_flat(klass, fasta_obj, seqinfo_generator, flat_name,
+                   flatten_inplace):
+        """
+        write the (seqid, block) pairs from the seqinfo_generator to
+        flat_name and return a dict of seqid => (start, stop).
+        if fasta_obj.workers > 1, the fasta is instead split into byte
+        ranges that are flattened by that many processes.
+        """
+        if fasta_obj.workers > 1:
+            from flatten_fasta import flatten_parallel
+            key_fn = None if klass.full_headers else fasta_obj.key_fn
+            return flatten_parallel(fasta_obj.fasta_name, flat_name,
+                                    key_fn, flatten_inplace,
+                                    fasta_obj.workers)
+        idx = {}
+        with open(flat_name, 'wb') as flatfh:
+            for i, (seqid, blocks) in enumerate(groupby(seqinfo_generator,
+                                                        itemgetter(0))):
+                if flatten_inplace:
+                    fmt = '>%s\n' if i == 0 else '\n>%s\n'
+                    flatfh.write(_as_bytes(fmt % seqid))
+                start = flatfh.tell()
+                for _, block in blocks:
+                    flatfh.write(block)
+                idx[seqid] = (start, flatfh.tell())
+        return idx
 
     @classmethod
     def copy_inplace(klass, flat_name, fasta_name):
@@ -92,7 +370,7 @@ class FastaRecord(object):
 
     @classmethod
     def modify_flat(klass, flat_file):
-        return open(flat_file, 'r')
+        return PositionalFile(flat_file)
 
     def _adjust_slice(self, islice):
         l = len(self)
@@ -121,36 +399,33 @@ class FastaRecord(object):
 
     def __getitem__(self, islice):
         fh = self.fh
-        fh.seek(self.start)
-
 
         if isinstance(islice, (int, long)):
             if islice < 0:
                 if -islice > self.stop - self.start:
                     raise IndexError
-                fh.seek(self.stop + islice)
-            else:
-                fh.seek(self.start + islice)
-            return fh.read(1)
+                return _as_str(fh.pread(1, self.stop + islice))
+            if islice >= self.stop - self.start:
+                raise IndexError
+            return _as_str(fh.pread(1, self.start + islice))
 
         # [:]
         if islice.start in (0, None) and islice.stop in (None, sys.maxint):
+            seq = _as_str(fh.pread(self.stop - self.start, self.start))
             if islice.step in (1, None):
-                return fh.read(self.stop - self.start)
-            return fh.read(self.stop - self.start)[::islice.step]
+                return seq
+            return seq[::islice.step]
 
         istart, istop = self._adjust_slice(islice)
         if istart is None: return u""
         l = istop - istart
         if l == 0: return u""
 
-
-        fh.seek(istart)
-
+        seq = _as_str(fh.pread(l, istart))
         if islice.step in (1, None):
-            return fh.read(l)
+            return seq
 
-        return fh.read(l)[::islice.step]
+        return seq[::islice.step]
 
 
     def __str__(self):
@@ -171,13 +446,26 @@ class FastaRecord(object):
 
 
 class NpyFastaRecord(FastaRecord):
-    __slots__ = ('start', 'stop', 'mm', 'as_string')
+    """
+    slices are returned as str by default. with `output` of 'bytes' the
+    decode is skipped and with 'memoryview' a contiguous slice is a
+    read-only view of the memmap (nothing is copied):
+
+        >>> from pyfasta import Fasta
+        >>> f = Fasta('tests/data/three_chrs.fasta', output='memoryview')
+        >>> m = f['chr1'][2:8]
+        >>> m.readonly, m.tobytes() == b'TGACTG'
+        (True, True)
+    """
+    __slots__ = ('start', 'stop', 'mm', 'as_string', 'output')
+    outputs = ('str', 'bytes', 'memoryview')
 
-    def __init__(self, mm, start, stop, as_string=True):
+    def __init__(self, mm, start, stop, as_string=True, output='str'):
         self.mm = mm
         self.start = start
         self.stop = stop
         self.as_string = as_string
+        self.output = output
 
     def __repr__(self):
         return "%s(%i..%i)" % (self.__class__.__name__,
@@ -202,7 +490,7 @@ class NpyFastaRecord(FastaRecord):
 
     def __getitem__(self, islice):
         d = self.getdata(islice)
-        return d.tostring().decode() if self.as_string else d
+        return _as_output(d, self.output) if self.as_string else d
 
     @property
     def __array_interface__(self):
@@ -223,13 +511,14 @@ class MemoryRecord(FastaRecord):
     dont write anything to disk, just read the whole thing
     into memory
     """
+    on_disk = False
+
     @classmethod
     def prepare(klass, fasta_obj, seqinfo_generator, flatten_inplace=False):
         f = fasta_obj.fasta_name
         seqs = {}
-        idx = {}
-        for seqid, seq in seqinfo_generator:
-            seqs[seqid] = (seq, None)
+        for seqid, blocks in groupby(seqinfo_generator, itemgetter(0)):
+            seqs[seqid] = (_as_str(b"".join(b for _, b in blocks)), None)
 
         return seqs, seqs
 
@@ -243,6 +532,748 @@ class MemoryRecord(FastaRecord):
         return len(self.seq)
 
 
+class FaidxRecord(FastaRecord):
+    """
+    read the sequence directly from the original (line-wrapped) fasta
+    file. nothing is flattened. a samtools-compatible .fai index stores
+    the offset, line length and line width of each record so positions
+    in the sequence are mapped to positions in the file arithmetically.
+    an existing .fai (e.g. from `samtools faidx`) is used as-is.
+
+    keys are the header up to the first whitespace (as in samtools)
+    and all lines in a record but the last must be the same length.
+    """
+    __slots__ = ('mm', 'start', 'stop', 'linebases', 'linewidth',
+                 'as_string', 'output')
+    idx = ".fai"
+    outputs = NpyFastaRecord.outputs
+
+    @classmethod
+    def is_current(klass, fasta_name):
+        return is_up_to_date(fasta_name + klass.idx, fasta_name)
+
+    def __init__(self, mm, start, stop, linebases, linewidth,
+                 as_string=True, output='str'):
+        self.mm = mm
+        self.start = start
+        self.stop = stop
+        self.linebases = linebases
+        self.linewidth = linewidth
+        self.as_string = as_string
+        self.output = output
+
+    def __repr__(self):
+        return "%s('%s', %i..%i)" % (self.__class__.__name__,
+                                     self.mm.filename, self.start, self.stop)
+
+    @classmethod
+    def prepare(klass, fasta_obj, seqinfo_generator, flatten_inplace):
+        f = fasta_obj.fasta_name
+        if not klass.is_current(f):
+            # read all the entries first so a bad file doesnt leave
+            # a partial (but current) .fai behind.
+            with phase(fasta_obj, 'write_index'):
+                klass.write_fai(f + klass.idx, list(klass.gen_fai_entries(f)))
+        key_fn = fasta_obj.key_fn
+        idx = {}
+        with phase(fasta_obj, 'load_index'):
+            for name, length, offset, linebases, linewidth in klass.read_fai(
+                                                                f + klass.idx):
+                if key_fn is not None:
+                    name = key_fn(name)
+                    if name in idx:
+                        from fasta import DuplicateHeaderException
+                        raise DuplicateHeaderException(name)
+                idx[name] = (offset, offset + length, linebases, linewidth)
+        with phase(fasta_obj, 'map'):
+            return idx, klass.modify_flat(f)
+
+    @classmethod
+    def modify_flat(klass, fasta_name):
+        return np.memmap(fasta_name, dtype="S1", mode="r")
+
+    @classmethod
+    def open_fasta(klass, fasta_name):
+        return open(fasta_name, 'rb')
+
+    @classmethod
+    def gen_fai_entries(klass, fasta_name):
+        """
+        generate (name, length, offset, linebases, linewidth) for each
+        record in the fasta file.
+        """
+        from fasta import DuplicateHeaderException
+        seen = set()
+        entry = None
+        short = False
+        pos = 0
+        with klass.open_fasta(fasta_name) as fh:
+            for line in fh:
+                lpos, pos = pos, pos + len(line)
+                if line.startswith(b'>'):
+                    if entry is not None:
+                        yield tuple(entry)
+                    name = line[1:].split()[0].decode()
+                    if name in seen:
+                        raise DuplicateHeaderException(name)
+                    seen.add(name)
+                    entry = [name, 0, pos, 0, 0]
+                    short = False
+                    continue
+                nbases = len(line.rstrip())
+                if entry is None or (nbases == 0 and not entry[1]):
+                    continue
+                if entry[1] == 0:
+                    entry[2], entry[3], entry[4] = lpos, nbases, len(line)
+                elif nbases and (short or nbases > entry[3]):
+                    raise ValueError("different line length in sequence '%s'"
+                                     % entry[0])
+                short = nbases < entry[3]
+                entry[1] += nbases
+        if entry is not None:
+            yield tuple(entry)
+
+    @classmethod
+    def read_fai(klass, fai_name):
+        with open(fai_name) as fh:
+            for line in fh:
+                toks = line.rstrip("\r\n").split("\t")
+                yield (toks[0],) + tuple(int(t) for t in toks[1:5])
+
+    @classmethod
+    def write_fai(klass, fai_name, entries):
+        with open(fai_name, 'w') as fh:
+            for entry in entries:
+                fh.write("%s\t%i\t%i\t%i\t%i\n" % entry)
+
+    def _file_pos(self, i):
+        # position in the file of base `i` (relative to self.start)
+        return self.start + (i // self.linebases) * self.linewidth \
+                          + i % self.linebases
+
+    def getdata(self, islice):
+        if isinstance(islice, (int, long)):
+            if islice < 0:
+                islice += self.stop - self.start
+                if islice < 0: raise IndexError
+            elif islice >= self.stop - self.start:
+                raise IndexError
+            return self.mm[self._file_pos(islice)]
+
+        start, stop = self._adjust_slice(islice)
+        if stop <= start:
+            return self.mm[0:0]
+        fstart = self._file_pos(start - self.start)
+        fstop = self._file_pos(stop - self.start - 1) + 1
+        d = self.mm[fstart:fstop]
+        if fstop - fstart != stop - start:
+            # drop the line-endings.
+            inline = (np.arange(fstart, fstop) - self.start) % self.linewidth
+            d = d[inline < self.linebases]
+        return d[::islice.step]
+
+    def __getitem__(self, islice):
+        d = self.getdata(islice)
+        return _as_output(d, self.output) if self.as_string else d
+
+    @property
+    def __array_interface__(self):
+        return {
+            'shape': (len(self), ),
+            'typestr': '|S1',
+            'version': 3,
+            'data': self.getdata(slice(None)),
+        }
+
+
+
+class BgzfReader(object):
+    """
+    random access to the uncompressed bytes of a BGZF file (as written
+    by `bgzip`). the start of each block (compressed and uncompressed
+    offset) is kept in a .gzi index as used by samtools. only the blocks
+    that cover a request are inflated and the last `cache_blocks` of
+    those are kept.
+
+    slicing with uncompressed positions gives a numpy array like a
+    memmap of the uncompressed file.
+    """
+    def __init__(self, filename, gzi_name, cache_blocks=64):
+        self.filename = filename
+        self.mm = np.memmap(filename, dtype=np.uint8, mode="r")
+        if is_up_to_date(gzi_name, filename):
+            coffsets, uoffsets = self.read_gzi(gzi_name)
+        else:
+            coffsets, uoffsets = self.scan_blocks(self.mm)
+            self.write_gzi(gzi_name, coffsets, uoffsets)
+        self.coffsets = np.append(coffsets, len(self.mm))
+        self.uoffsets = uoffsets
+        self.gzi_name = gzi_name
+        self.cache = LRUCache(cache_blocks)
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'gzi_name': self.gzi_name,
+                'cache_blocks': self.cache.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'], state['gzi_name'],
+                      state['cache_blocks'])
+
+    @classmethod
+    def scan_blocks(klass, mm):
+        """
+        return the compressed and uncompressed offset of each block.
+        only the block headers and sizes are read, nothing is inflated.
+        """
+        coffsets, uoffsets = [], []
+        cpos = upos = 0
+        while cpos < len(mm):
+            header = mm[cpos:cpos + 12]
+            if len(header) < 12 or header[0] != 31 or header[1] != 139 \
+                    or not header[3] & 4:
+                raise ValueError("%s is not in BGZF format (use bgzip)"
+                                 % mm.filename)
+            xlen = int(header[10]) | int(header[11]) << 8
+            extra = mm[cpos + 12: cpos + 12 + xlen].tostring()
+            bc = extra.find(b"BC\x02\x00")
+            if bc == -1:
+                raise ValueError("%s is not in BGZF format (use bgzip)"
+                                 % mm.filename)
+            bsize = int(mm[cpos + 12 + bc + 4]) \
+                  | int(mm[cpos + 12 + bc + 5]) << 8
+            end = cpos + bsize + 1
+            coffsets.append(cpos)
+            uoffsets.append(upos)
+            upos += int(mm[end - 4:end].view('<u4')[0])
+            cpos = end
+        return (np.array(coffsets, dtype=np.int64),
+                np.array(uoffsets, dtype=np.int64))
+
+    @classmethod
+    def read_gzi(klass, gzi_name):
+        # a count then pairs of (compressed, uncompressed) offsets for
+        # every block except the first.
+        offsets = np.fromfile(gzi_name, dtype='<u8')[1:].astype(np.int64)
+        offsets = np.concatenate(([0, 0], offsets)).reshape(-1, 2)
+        return offsets[:, 0].copy(), offsets[:, 1].copy()
+
+    @classmethod
+    def write_gzi(klass, gzi_name, coffsets, uoffsets):
+        offsets = np.column_stack((coffsets, uoffsets))[1:]
+        with open(gzi_name, 'wb') as fh:
+            fh.write(np.array([len(offsets)], dtype='<u8').tostring())
+            fh.write(offsets.astype('<u8').tostring())
+
+    def block(self, i):
+        data = self.cache.get(i)
+        if data is None:
+            data = zlib.decompress(
+                self.mm[self.coffsets[i]:self.coffsets[i + 1]].tostring(),
+                16 + zlib.MAX_WBITS)
+            self.cache[i] = data
+        return data
+
+    def read(self, start, stop):
+        if stop <= start:
+            return np.zeros(0, dtype='S1')
+        first = np.searchsorted(self.uoffsets, start, side='right') - 1
+        last = np.searchsorted(self.uoffsets, stop - 1, side='right') - 1
+        data = b"".join(self.block(i) for i in range(first, last + 1))
+        offset = start - self.uoffsets[first]
+        return np.frombuffer(data, dtype='S1')[offset:offset + stop - start]
+
+    def __getitem__(self, islice):
+        if isinstance(islice, (int, long)):
+            return self.read(islice, islice + 1)[0]
+        return self.read(islice.start, islice.stop)
+
+
+class BgzfRecord(FaidxRecord):
+    """
+    read a fasta compressed with `bgzip` (e.g. some.fa.gz) without
+    decompressing it to disk. as with FaidxRecord, a .fai index of the
+    uncompressed file is used and a .gzi index locates the compressed
+    blocks, both are created if needed and are compatible with samtools.
+    the number of inflated blocks kept in memory is `cache_blocks`.
+
+        >>> from pyfasta import Fasta
+        >>> f = Fasta('tests/data/wrapped.fasta.gz', record_class=BgzfRecord)
+        >>> print(f['seq2'][3:12])
+        NNTTGACCA
+        >>> import os
+        >>> for ext in ('.fai', '.gzi'):
+        ...     os.unlink('tests/data/wrapped.fasta.gz' + ext)
+    """
+    __slots__ = ()
+    gzi = ".gzi"
+    cache_blocks = 64
+
+    @classmethod
+    def modify_flat(klass, fasta_name):
+        return BgzfReader(fasta_name, fasta_name + klass.gzi,
+                          klass.cache_blocks)
+
+    @classmethod
+    def open_fasta(klass, fasta_name):
+        return closing(gzip.open(fasta_name, 'rb'))
+
+
+TWOBIT_SIGNATURE = 0x1A412743
+
+# 2-bit codes in the same order as UCSC's .2bit format, 4 bases per byte
+# with the first base in the high bits.
+_TWOBIT_BASES = np.frombuffer(b"TCAG", dtype=np.uint8)
+_twobit_encode = np.zeros(256, dtype=np.uint8)
+_twobit_acgt = np.zeros(256, dtype=bool)
+for _code, _base in enumerate(b"TCAG".decode()):
+    for _b in (ord(_base), ord(_base.lower())):
+        _twobit_encode[_b] = _code
+        _twobit_acgt[_b] = True
+_twobit_lower = np.zeros(256, dtype=bool)
+_twobit_lower[ord('a'):ord('z') + 1] = True
+_byte = np.arange(256, dtype=np.uint8)
+_twobit_decode = _TWOBIT_BASES[np.column_stack([(_byte >> s) & 3
+                                                for s in (6, 4, 2, 0)])]
+
+def _runs(mask, offset=0):
+    """
+    the (start, stop) of each run of True in mask.
+
+        >>> _runs(np.array([1, 1, 0, 0, 1], dtype=bool), 10).tolist()
+        [[10, 12], [14, 15]]
+    """
+    d = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    return np.column_stack((np.flatnonzero(d == 1),
+                            np.flatnonzero(d == -1))).astype(np.int64) + offset
+
+def _merge_runs(runs):
+    """
+    concatenate lists of runs, joining those that touch.
+
+        >>> _merge_runs([np.array([[0, 2]]), np.array([[2, 3], [5, 6]])]).tolist()
+        [[0, 3], [5, 6]]
+    """
+    runs = [r for r in runs if len(r)]
+    if not runs:
+        return np.zeros((0, 2), dtype=np.int64)
+    runs = np.concatenate(runs)
+    joined = runs[1:, 0] == runs[:-1, 1]
+    return np.column_stack((runs[np.r_[True, ~joined], 0],
+                            runs[np.r_[~joined, True], 1]))
+
+def _runs_mask(runs, start, stop):
+    """
+    boolean mask of the positions in start..stop covered by the (sorted,
+    non-overlapping) runs.
+
+        >>> _runs_mask(np.array([[0, 2], [5, 9]]), 1, 7).astype(int).tolist()
+        [1, 0, 0, 0, 1, 1]
+    """
+    lo = np.searchsorted(runs[:, 1], start, side='right')
+    hi = np.searchsorted(runs[:, 0], stop, side='left')
+    delta = np.zeros(stop - start + 1, dtype=np.int32)
+    if hi > lo:
+        runs = np.clip(runs[lo:hi], start, stop) - start
+        np.add.at(delta, runs[:, 0], 1)
+        np.add.at(delta, runs[:, 1], -1)
+    return np.cumsum(delta[:-1]) > 0
+
+
+class TwoBitRecord(FastaRecord):
+    """
+    store the sequence packed 4 bases per byte so the file that is
+    memory-mapped is 1/4 the size of the .flat file. runs of N and of
+    lower-case (soft-masked) bases are kept as sorted arrays of
+    intervals in the index and applied when a slice is decoded.
+    any base other than ACGT (e.g. IUPAC codes) is stored as N.
+    there is no inplace option, the original file is never changed.
+    """
+    __slots__ = ('mm', 'start', 'stop', 'nruns', 'mruns', 'as_string',
+                 'output')
+    ext = ".2bp"
+    idx = ".2bx"
+    outputs = NpyFastaRecord.outputs
+
+    def __init__(self, mm, start, stop, nruns, mruns, as_string=True,
+                 output='str'):
+        self.mm = mm
+        self.start = start
+        self.stop = stop
+        self.nruns = nruns
+        self.mruns = mruns
+        self.as_string = as_string
+        self.output = output
+
+    def __repr__(self):
+        return "%s(%i..%i)" % (self.__class__.__name__,
+                                   self.start, self.stop)
+
+    @classmethod
+    def prepare(klass, fasta_obj, seqinfo_generator, flatten_inplace):
+        f = fasta_obj.fasta_name
+        if klass.is_current(f):
+            with phase(fasta_obj, 'load_index'), open(f + klass.idx, 'rb') as fh:
+                idx = cPickle.load(fh)
+            with phase(fasta_obj, 'map'):
+                return idx, klass.modify_flat(f + klass.ext)
+
+        idx = {}
+        with phase(fasta_obj, 'write_flat'), open(f + klass.ext, 'wb') as packfh:
+            for seqid, blocks in groupby(seqinfo_generator, itemgetter(0)):
+                # each record starts on a byte boundary.
+                start = packfh.tell() * 4
+                idx[seqid] = (start,) + klass.write_packed(packfh,
+                                            (b for _, b in blocks), start)
+
+        with phase(fasta_obj, 'write_index'), open(f + klass.idx, 'wb') as fh:
+            cPickle.dump(idx, fh, -1)
+        with phase(fasta_obj, 'map'):
+            return idx, klass.modify_flat(f + klass.ext)
+
+    @classmethod
+    def write_packed(klass, packfh, blocks, start):
+        """
+        pack the sequence in `blocks` to packfh. returns the stop and
+        the N and lower-case runs.
+        """
+        nruns, mruns = [], []
+        carry = np.zeros(0, dtype=np.uint8)
+        pos = start
+        for block in blocks:
+            seq = np.frombuffer(block, dtype=np.uint8)
+            nruns.append(_runs(~_twobit_acgt[seq], pos))
+            mruns.append(_runs(_twobit_lower[seq], pos))
+            pos += len(seq)
+            codes = np.concatenate((carry, _twobit_encode[seq]))
+            full = len(codes) - len(codes) % 4
+            packfh.write(klass._pack(codes[:full]).tostring())
+            carry = codes[full:]
+        if len(carry):
+            codes = np.zeros(4, dtype=np.uint8)
+            codes[:len(carry)] = carry
+            packfh.write(klass._pack(codes).tostring())
+        return pos, _merge_runs(nruns), _merge_runs(mruns)
+
+    @classmethod
+    def _pack(klass, codes):
+        c = codes.reshape(-1, 4)
+        return (c[:, 0] << 6) | (c[:, 1] << 4) | (c[:, 2] << 2) | c[:, 3]
+
+    @classmethod
+    def modify_flat(klass, flat_file):
+        if os.path.getsize(flat_file) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(flat_file, dtype=np.uint8, mode="r")
+
+    def _decode(self, start, stop):
+        # start, stop are absolute positions.
+        if stop <= start:
+            return np.zeros(0, dtype='S1')
+        bstart, bstop = start // 4, (stop - 1) // 4 + 1
+        seq = _twobit_decode[self.mm[bstart:bstop]].ravel()
+        seq = seq[start - bstart * 4: stop - bstart * 4]
+        if len(self.nruns):
+            seq[_runs_mask(self.nruns, start, stop)] = ord('N')
+        if len(self.mruns):
+            seq[_runs_mask(self.mruns, start, stop)] |= 0x20
+        return seq.view('S1')
+
+    def getdata(self, islice):
+        if isinstance(islice, (int, long)):
+            if islice < 0:
+                islice += self.stop - self.start
+                if islice < 0: raise IndexError
+            elif islice >= self.stop - self.start:
+                raise IndexError
+            return self._decode(self.start + islice,
+                                self.start + islice + 1)[0]
+
+        start, stop = self._adjust_slice(islice)
+        return self._decode(start, stop)[::islice.step]
+
+    def __getitem__(self, islice):
+        d = self.getdata(islice)
+        return _as_output(d, self.output) if self.as_string else d
+
+    @property
+    def __array_interface__(self):
+        return {
+            'shape': (len(self), ),
+            'typestr': '|S1',
+            'version': 3,
+            'data': self.getdata(slice(None)),
+        }
+
+
+class UcscTwoBitIndex(Mapping):
+    """
+    the index of a UCSC .2bit file. the names and offsets of the records
+    are read up front, the header of a record (its size and N and mask
+    blocks) is read the first time that record is requested.
+    """
+    def __init__(self, mm, key_fn=None):
+        self.mm = mm
+        if mm[:4].view('<u4')[0] == TWOBIT_SIGNATURE:
+            self.endian = '<'
+        elif mm[:4].view('>u4')[0] == TWOBIT_SIGNATURE:
+            self.endian = '>'
+        else:
+            raise ValueError("not a .2bit file: bad signature")
+        version, nseqs = self._uint32(4, 2)
+        if version not in (0, 1):
+            raise ValueError("unknown .2bit version: %i" % version)
+        offset_dtype = np.dtype(self.endian + ('u8' if version else 'u4'))
+
+        self.offsets = {}
+        pos = 16
+        for _ in range(nseqs):
+            size = int(mm[pos])
+            name = _as_str(mm[pos + 1: pos + 1 + size].tostring())
+            pos += 1 + size
+            offset = int(mm[pos: pos + offset_dtype.itemsize].view(
+                                                            offset_dtype)[0])
+            pos += offset_dtype.itemsize
+            if key_fn is not None:
+                name = key_fn(name)
+            self.offsets[name] = offset
+        self.entries = {}
+
+    def _uint32(self, pos, n):
+        return self.mm[pos: pos + 4 * n].view(self.endian + 'u4').astype(
+                                                                np.int64)
+
+    def _blocks(self, pos):
+        # a block list is a count then the starts and then the sizes.
+        n = int(self._uint32(pos, 1)[0])
+        a = self._uint32(pos + 4, 2 * n).reshape(2, n)
+        return pos + 4 + 8 * n, np.column_stack((a[0], a[0] + a[1]))
+
+    def __getitem__(self, key):
+        if key not in self.entries:
+            pos = self.offsets[key]
+            size = int(self._uint32(pos, 1)[0])
+            # positions are in bases, so are the byte offset * 4.
+            pos, nruns = self._blocks(pos + 4)
+            pos, mruns = self._blocks(pos)
+            # skip the reserved word.
+            start = (pos + 4) * 4
+            self.entries[key] = (start, start + size, nruns + start,
+                                 mruns + start)
+        return self.entries[key]
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['mm'] = _ref(self.mm)
+        return state
+
+    def __setstate__(self, state):
+        state['mm'] = _deref(state['mm'])
+        self.__dict__.update(state)
+
+
+class UcscTwoBitRecord(TwoBitRecord):
+    """
+    read a UCSC .2bit file (e.g. hg19.2bit) directly. the file is
+    memory-mapped and nothing is written to disk.
+
+        >>> from pyfasta import Fasta
+        >>> f = Fasta('tests/data/wrapped.2bit', record_class=UcscTwoBitRecord)
+        >>> sorted(f.keys())
+        ['seq1', 'seq2', 'seq3', 'seq4']
+        >>> print(f['seq2'][:12])
+        NNNNNTTGACCA
+        >>> print(f['seq1'][-5:])
+        GTacg
+    """
+    __slots__ = ()
+    on_disk = False
+
+    @classmethod
+    def is_current(klass, fasta_name):
+        return True
+
+    @classmethod
+    def prepare(klass, fasta_obj, seqinfo_generator, flatten_inplace):
+        mm = np.memmap(fasta_obj.fasta_name, dtype=np.uint8, mode="r")
+        return UcscTwoBitIndex(mm, fasta_obj.key_fn), mm
+
+
+try:
+    import sqlite3
+
+    def _glob_escape(s):
+        return "".join("[%s]" % c if c in "*?[" else c for c in s)
+
+    def _glob_prefix(pattern):
+        # the literal start of a glob pattern.
+        for i, c in enumerate(pattern):
+            if c in "*?[":
+                return pattern[:i]
+        return pattern
+
+    class SqliteIndex(Mapping):
+        """
+        the index of a SqliteRecord. each record is stored once with its
+        name (the header, or key_fn(header)), the full header and its
+        start, stop. the name, the full header, the first word of the
+        header (if no other record has the same first word) and any
+        aliases are all keys that can be used to get the record.
+        iteration gives the names in the order of the fasta file.
+        nothing is read into memory.
+        """
+        def __init__(self, db_name):
+            self.db_name = db_name
+            self.db = sqlite3.connect(db_name, check_same_thread=False)
+            self.db.text_factory = str
+
+        def __reduce__(self):
+            return (SqliteIndex, (self.db_name,))
+
+        @classmethod
+        def write(klass, db_name, idx, key_fn=None):
+            """
+            idx is a dict of full header => (start, stop). the file is
+            written to a temporary name and renamed when complete.
+            """
+            from fasta import DuplicateHeaderException
+            tmp = db_name + ".tmp%i" % os.getpid()
+            if os.path.exists(tmp): os.unlink(tmp)
+            db = sqlite3.connect(tmp)
+            db.text_factory = str
+            db.execute("PRAGMA synchronous = OFF")
+            db.execute("PRAGMA journal_mode = OFF")
+            db.execute("CREATE TABLE records (id INTEGER PRIMARY KEY, "
+                       "name TEXT, header TEXT, start INTEGER, stop INTEGER)")
+            db.execute("CREATE TABLE keys (key TEXT PRIMARY KEY, "
+                       "id INTEGER NOT NULL) WITHOUT ROWID")
+            db.execute("CREATE TEMP TABLE tokens (key TEXT, id INTEGER)")
+            # the records in order of the file.
+            headers = sorted(idx, key=lambda h: idx[h][0])
+            db.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?)",
+                           ((i + 1, h if key_fn is None else key_fn(h), h,
+                             idx[h][0], idx[h][1])
+                            for i, h in enumerate(headers)))
+            try:
+                db.execute("INSERT INTO keys SELECT name, id FROM records")
+            except sqlite3.IntegrityError:
+                name, = db.execute("SELECT name FROM records GROUP BY name "
+                                   "HAVING count(*) > 1 LIMIT 1").fetchone()
+                db.close()
+                os.unlink(tmp)
+                raise DuplicateHeaderException(name)
+            db.execute("INSERT OR IGNORE INTO keys SELECT header, id "
+                       "FROM records")
+            db.executemany("INSERT INTO tokens VALUES (?, ?)",
+                           ((h.split()[0], i + 1)
+                            for i, h in enumerate(headers) if h.split()))
+            db.execute("INSERT OR IGNORE INTO keys SELECT key, min(id) "
+                       "FROM tokens GROUP BY key HAVING count(*) = 1")
+            db.commit()
+            db.close()
+            os.rename(tmp, db_name)
+
+        def add_aliases(self, aliases):
+            """
+            add (alias, key) pairs where key is any existing key of a
+            record. the aliases are saved in the index.
+            """
+            try:
+                for alias, key in aliases:
+                    row = self.db.execute("SELECT id FROM keys WHERE key = ?",
+                                          (key,)).fetchone()
+                    if row is None:
+                        raise KeyError(key)
+                    try:
+                        self.db.execute("INSERT INTO keys VALUES (?, ?)",
+                                        (alias, row[0]))
+                    except sqlite3.IntegrityError:
+                        raise ValueError("%s is already a key" % alias)
+            except:
+                self.db.rollback()
+                raise
+            self.db.commit()
+
+        def glob(self, pattern):
+            """names of the records with any key matching the (unix
+            style, case-sensitive) pattern, e.g. 'chr*_random'"""
+            # limit the search to the range of keys that start with the
+            # literal part of the pattern so the key index is used.
+            lo = _glob_prefix(pattern)
+            if lo and ord(lo[-1]) < 127:
+                hi = lo[:-1] + chr(ord(lo[-1]) + 1)
+                where, args = "key >= ? AND key < ? AND ", (lo, hi, pattern)
+            else:
+                where, args = "", (pattern,)
+            return [r[0] for r in self.db.execute(
+                "SELECT name FROM records WHERE id IN "
+                "(SELECT id FROM keys WHERE %skey GLOB ?) ORDER BY id"
+                % where, args)]
+
+        def prefix(self, prefix):
+            """names of the records with any key that starts with `prefix`"""
+            return self.glob(_glob_escape(prefix) + "*")
+
+        def __getitem__(self, key):
+            row = self.db.execute("SELECT start, stop FROM records WHERE id = "
+                                  "(SELECT id FROM keys WHERE key = ?)",
+                                  (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            return row
+
+        def __contains__(self, key):
+            return self.db.execute("SELECT 1 FROM keys WHERE key = ?",
+                                   (key,)).fetchone() is not None
+
+        def __iter__(self):
+            for row in self.db.execute("SELECT name FROM records ORDER BY id"):
+                yield row[0]
+
+        def __len__(self):
+            return self.db.execute("SELECT max(id) FROM records"
+                                   ).fetchone()[0] or 0
+
+    class SqliteRecord(NpyFastaRecord):
+        """
+        same as NpyFastaRecord except that the index is a sqlite
+        database so it is not loaded into memory and can be searched:
+
+            >>> from pyfasta import Fasta
+            >>> f = Fasta('tests/data/key.fasta', record_class=SqliteRecord)
+            >>> f.index.prefix('a'), f.index.glob('*c*')
+            (['a extra'], ['c extra'])
+            >>> f['a'][:] == f['a extra'][:]
+            True
+            >>> f.index.add_aliases([('seqA', 'a')])
+            >>> print(f['seqA'][:])
+            a
+            >>> import os
+            >>> os.unlink('tests/data/key.fasta.sqlite')
+        """
+        __slots__ = ()
+        idx = ".sqlite"
+        full_headers = True
+
+        @classmethod
+        def write_index(klass, idx_name, idx, key_fn=None):
+            SqliteIndex.write(idx_name, idx, key_fn)
+
+        @classmethod
+        def load_index(klass, idx_name):
+            return SqliteIndex(idx_name)
+
+    __all__.append('SqliteRecord')
+except ImportError:
+    pass
 
 try:
     import tc
@@ -255,10 +1286,13 @@ try:
             tc.HDB.close(self)
 
     class TCRecord(NpyFastaRecord):
+        """deprecated: use SqliteRecord."""
         idx = ".tct"
 
         @classmethod
         def prepare(klass, fasta_obj, seqinfo_generator, flatten_inplace):
+            warnings.warn("TCRecord is deprecated, use SqliteRecord",
+                          DeprecationWarning)
             f = fasta_obj.fasta_name
             if klass.is_current(f):
                 idx = HDB()
@@ -269,23 +1303,15 @@ try:
 
 
             db = HDB(f + klass.idx, tc.HDBOWRITER | tc.HDBOCREAT)
-            flatfh = open(f + klass.ext, 'w')
-            for i, (seqid, seq) in enumerate(seqinfo_generator):
-                if flatten_inplace:
-                    if i == 0:
-                        flatfh.write('>%s\n' % seqid)
-                    else:
-                        flatfh.write('\n>%s\n' % seqid)
-                start = flatfh.tell()
-                flatfh.write(seq)
-                stop = flatfh.tell() 
-                db[seqid] = (start, stop)
+            idx = klass.write_flat(fasta_obj, seqinfo_generator, f + klass.ext,
+                                   flatten_inplace)
+            for seqid, start_stop in idx.iteritems():
+                db[seqid] = start_stop
 
             db.sync()
-            flatfh.close()
 
             if flatten_inplace:
-                klass.copy_inplace(flatfh.name, f)
+                klass.copy_inplace(f + klass.ext, f)
                 return db, klass.modify_flat(f)
             return db, klass.modify_flat(f + klass.ext)
 
@@ -1,11 +1,17 @@
 from __future__ import print_function
 from pyfasta import Fasta
-import operator
-import collections
+import heapq
+import os
 import string
 import sys
 import optparse
 from cStringIO import StringIO
+import numpy as np
+
+from fasta import _getdata, BLOCKSIZE as CHUNK
+from records import NpyFastaRecord, _as_bytes
+
+_sendfile = getattr(os, 'sendfile', None)
 
 
 def newnames(oldname, n, kmers=None, overlap=None, header=None):
@@ -53,13 +59,118 @@ def newnames(oldname, n, kmers=None, overlap=None, header=None):
     return names
 
 
-def print_to_fh(fh, fasta, lens, seqinfo):
-    key, seqlen = seqinfo
-    lens[fh.name] += seqlen
-    f = fasta
-    assert len(str(f[key])) == seqlen, (key, seqlen, len(str(f[key])))
-    print(">%s" % key, file=fh)
-    print(str(f[key]), file=fh)
+def _write_seq(fh, get, n, width=None, chunk=CHUNK):
+    """Internal: write the n bases given by get(start, stop) to `fh` a
+    chunk at a time, on one line or wrapped to lines of `width`."""
+    if width is None:
+        for start in range(0, n, chunk):
+            fh.write(get(start, min(start + chunk, n)).tostring())
+        fh.write(b"\n")
+        return
+    chunk = max(chunk // width, 1) * width
+    for start in range(0, n, chunk):
+        d = get(start, min(start + chunk, n)).view(np.uint8)
+        rows = len(d) // width
+        lines = np.empty((rows, width + 1), dtype=np.uint8)
+        lines[:, :width] = d[:rows * width].reshape(rows, width)
+        lines[:, width] = ord("\n")
+        fh.write(lines.tostring())
+        if len(d) > rows * width:
+            fh.write(d[rows * width:].tostring() + b"\n")
+
+
+def _send(fh, src, pos, n):
+    """Internal: copy n bytes of the file `src` at `pos` to `fh`."""
+    fh.flush()
+    end = pos + n
+    while pos < end:
+        sent = _sendfile(fh.fileno(), src.fileno(), pos, end - pos)
+        if sent == 0:
+            raise IOError("unexpected end of %s" % src.name)
+        pos += sent
+
+
+def write_records(f, keys, name, width=None, bounds=None):
+    """
+    write the records `keys` of Fasta `f` to a new fasta file `name` with
+    each sequence on one line or, with `width`, wrapped to lines of that
+    many bases. the sequence is copied a chunk at a time so it is never
+    held in memory as a string. for the memmap record classes, it's
+    copied straight from the flat file (by os.sendfile where that's
+    available and there's no wrapping), using `bounds`, a dict of key =>
+    (start, stop) in the flat file, if given.
+    """
+    memmap = issubclass(f.record_class, NpyFastaRecord)
+    src = None
+    if memmap and width is None and _sendfile is not None \
+            and getattr(f.prepared, 'filename', None):
+        src = open(f.prepared.filename, 'rb')
+    try:
+        with open(name, 'wb') as fh:
+            for key in keys:
+                fh.write(b">" + _as_bytes(key) + b"\n")
+                if not memmap:
+                    rec = f[key]
+                    _write_seq(fh, lambda a, b: _getdata(rec, slice(a, b)),
+                               len(rec), width)
+                    continue
+                start, stop = bounds[key] if bounds else f.index[key][:2]
+                if src is not None:
+                    _send(fh, src, f.prepared.offset + start, stop - start)
+                    fh.write(b"\n")
+                else:
+                    mm = f.prepared
+                    _write_seq(fh, lambda a, b: mm[start + a:start + b],
+                               stop - start, width)
+    finally:
+        if src is not None:
+            src.close()
+
+
+def record_sizes(f):
+    """
+    the (key, length) of each record of `f` (in the order of the file
+    for the memmap record classes) and, for the memmap record
+    classes, a dict of key => (start, stop) in the flat file (else None)
+    so that write_records() doesn't look each record up again.
+
+    >>> record_sizes(Fasta('tests/data/three_chrs.fasta'))[0]
+    [('chr1', 80), ('chr2', 80), ('chr3', 3600)]
+    """
+    if not issubclass(f.record_class, NpyFastaRecord):
+        return [(key, len(f[key])) for key in f.iterkeys()], None
+    bounds = sorted(((k, tuple(v[:2])) for k, v in f.index.items()),
+                    key=lambda kv: kv[1])
+    return [(k, stop - start) for k, (start, stop) in bounds], dict(bounds)
+
+
+def balance(sizes, n=None, target=None):
+    """
+    assign the (key, size) items to `n` shards (or, with `target`, to as
+    many shards as needed for each to hold about `target` bases) so the
+    shards have similar totals (there are never more target shards than
+    items). each item in turn, largest first, goes to
+    the shard with the smallest total so far (LPT scheduling), so the
+    largest shard is at most 4/3 of the best possible. returns a list of
+    the keys of each shard, in the order of `sizes`.
+
+    >>> balance([('a', 10), ('b', 7), ('c', 5), ('d', 4), ('e', 3)], 2)
+    [['a', 'd'], ['b', 'c', 'e']]
+    >>> balance([('a', 10), ('b', 7), ('c', 5), ('d', 4), ('e', 3)], target=10)
+    [['a'], ['b', 'e'], ['c', 'd']]
+    """
+    sizes = list(sizes)
+    if target:
+        total = sum(size for _, size in sizes)
+        n = max(1, min((total + target - 1) // target, len(sizes)))
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    heap = [(0, i) for i in range(n)]
+    shards = [[] for i in range(n)]
+    for i in order:
+        total, shard = heapq.heappop(heap)
+        shards[shard].append(i)
+        heapq.heappush(heap, (total + sizes[i][1], shard))
+    return [[sizes[i][0] for i in sorted(shard)] for shard in shards]
 
 
 def format_kmer(seqid, start):
@@ -88,6 +199,14 @@ def split(args):
 
     parser.add_option("-n", "--n", type="int", dest="nsplits", 
                             help="number of new files to create")
+    parser.add_option("-s", "--size", type="int", dest="size", default=None,
+                      help="create as many files as needed for each to hold"
+                      " about this many basepairs (instead of -n)")
+    parser.add_option("-w", "--width", type="int", dest="width", default=None,
+                      help="wrap the sequence to lines of this many"
+                      " basepairs. default is one line per record")
+    parser.add_option("-j", "--jobs", type="int", dest="workers", default=1,
+                      help="number of files to write at once")
     parser.add_option("-o", "--overlap", type="int", dest="overlap", 
                             help="overlap in basepairs", default=0)
     parser.add_option("-k", "--kmers", type="int", dest="kmers", default=-1,
@@ -96,7 +215,8 @@ def split(args):
     default of -1 means do not split the sequence up into k-mers, just
     split based on the headers. a reasonable value would be 10Kbp""")
     options, fasta = parser.parse_args(args)
-    if not (fasta and (options.nsplits or options.header)):
+    if not (fasta and (options.nsplits or options.header or
+                       (options.size and options.kmers == -1))):
         sys.exit(parser.print_help())
 
     if isinstance(fasta, (tuple, list)):
@@ -116,116 +236,205 @@ def split(args):
         fhs = dict([(seqid, open(fn, 'wb')) for seqid, fn in names[:200]])
         fhs.extend([(seqid, StringIO(), fn) for seqid, fn in names[200:]])
         """
-        return with_header_names(f, names)
-    else:
-        names = newnames(fasta, options.nsplits, kmers=kmer, overlap=overlap, 
+        return with_header_names(f, names, options.width)
+
+    shards = None
+    if options.kmers == -1 and options.size:
+        shards = balance(record_sizes(f)[0], target=options.size)
+        options.nsplits = len(shards)
+    names = newnames(fasta, options.nsplits, kmers=kmer, overlap=overlap,
                      header=options.header)
 
-        #fhs = [open(n, 'wb') for n in names]
     if options.kmers == -1:
-        return without_kmers(f, names)
+        return without_kmers(f, names, options.width, options.workers, shards)
     else: 
-        return with_kmers(f, names, options.kmers, options.overlap)
+        return with_kmers(f, names, options.kmers, options.overlap,
+                          options.workers)
 
-def with_header_names(f, names):
+def with_header_names(f, names, width=None):
     """
     split the fasta into the files in fhs by headers.
     """
     for seqid, name in names.iteritems():
-        with open(name, 'w') as fh:
-            print(">%s" % seqid, file=fh)
-            print(str(f[seqid]), file=fh)
-
-def with_kmers(f, names, k, overlap):
+        write_records(f, [seqid], name, width)
+
+def _format_kmers(seqid, starts, k, data, base):
+    """Internal: the fasta records, with headers of format_kmer(), of
+    the pieces of length `k` at the evenly spaced `starts` of the uint8
+    sequence `data` (which starts at `base` in the record) as bytes.
+    the pieces are a strided view of `data` and each run of pieces with
+    the same number of digits in their header is filled in as the rows
+    of one array, so there's no python call per piece.
+
+    >>> _format_kmers(b'c', np.array([0, 5, 10]), 3,
+    ...               np.frombuffer(b'ACGTACGTACGTA', np.uint8), 0) == \\
+    ...     b'>c_1\\nACG\\n>c_6\\nCGT\\n>c_11\\nGTA\\n'
+    True
     """
-    split the sequences in Fasta object `f` into pieces of length `k`
-    with the given `overlap` the results are written to the array of files
-    `fhs`
-    """
-    fhs = [open(name, 'w') for name in names]
-    i = 0
-    for seqid in f.iterkeys():
-        seq = f[seqid]
-        for (start0, subseq) in Fasta.as_kmers(seq, k, overlap=overlap):
-
-            fh = fhs[i % len(fhs)]
-            print(">%s" % format_kmer(seqid, start0), file=fh)
-            print(subseq, file=fh)
-            i += 1
-    for fh in fhs:
-        fh.close()
-
-def without_kmers(f, names):
-    """
-    long crappy function that does not solve the bin-packing problem.
-    but attempts to distribute the sequences in Fasta object `f` evenly
-    among the file handles in fhs.
-    """
-    fhs = [open(name, 'w') for name in names]
-    name2fh = dict([(fh.name, fh) for fh in fhs])
-    items = sorted([(key, len(f[key])) for key in f.iterkeys()],
-                   key=operator.itemgetter(1))
-
-    l1 = len(items) - 1
-    l0 = 0
-    lens = collections.defaultdict(int)
-
-    n_added = 0
-    while l0 < l1:
-        fh = fhs[n_added % len(fhs)]
-        added = False
-        if n_added >= len(fhs):
-
-            while l1 > l0:
-                lmin = min(lens.itervalues())
-                lmax = max(lens.itervalues())
-                if float(lmin) / lmax < 0.80:
-                    # it's way off, so add a large (l1)
-                    name = find_name_from_len(lmin, lens)
-                    fh = name2fh[name]
-                    print_to_fh(fh, f, lens, items[l1])
-                    l1 -= 1
-                    added = True
-                    n_added += 1
-
-                elif float(lmin) / lmax < 0.94:
-                    # it's just a little off so add a small (l0)
-                    name = find_name_from_len(lmin, lens)
-                    fh = name2fh[name]
-                    print_to_fh(fh, f, lens, items[l0])
-                    l0 += 1
-                    added = True
-                    n_added += 1
+    from numpy.lib.stride_tricks import as_strided
+    prefix = np.frombuffer(b">" + seqid + b"_", dtype=np.uint8)
+    np_ = len(prefix)
+    nums = (starts + 1).astype('S%i' % len(str(int(starts[-1]) + 1)))
+    digits = nums.view(np.uint8).reshape(len(nums), -1)
+    ndigits = (digits != 0).sum(axis=1)
+    stride = int(starts[1] - starts[0]) if len(starts) > 1 else 1
+    seqs = as_strided(data[int(starts[0]) - base:], shape=(len(starts), k),
+                      strides=(stride * data.strides[0], data.strides[0]))
+    # the starts only grow, so do the number of digits.
+    runs = [0] + (np.flatnonzero(np.diff(ndigits)) + 1).tolist() + [len(starts)]
+    parts = []
+    for a, b in zip(runs[:-1], runs[1:]):
+        nd = int(ndigits[a])
+        rows = np.empty((b - a, np_ + nd + k + 2), dtype=np.uint8)
+        rows[:, :np_] = prefix
+        rows[:, np_:np_ + nd] = digits[a:b, :nd]
+        rows[:, np_ + nd] = ord("\n")
+        rows[:, np_ + nd + 1:-1] = seqs[a:b]
+        rows[:, -1] = ord("\n")
+        parts.append(rows.tostring())
+    return b"".join(parts)
+
+
+# records with at least this many pieces shorter than this are written
+# with _format_kmers() a batch at a time, others with a python call per
+# piece (which costs little next to copying a long piece).
+SHORT_KMER = 256
+
+
+def write_kmers(f, names, k, overlap=0, files=None, chunk=CHUNK):
+    """
+    write the pieces of the records of `f` made by Fasta.as_kmers() to
+    the files `names` in turn, as with_kmers(). only the files at the
+    indexes in `files` (default all) are written, so that processes can
+    each write some of them. the sequence is copied from the record (the
+    memmap for NpyFastaRecord) about `chunk` bases at a time, so memory
+    use doesn't depend on the number or size of the pieces.
+    """
+    nfiles = len(names)
+    files = list(range(nfiles)) if files is None else sorted(files)
+    wanted = np.zeros(nfiles, dtype=bool)
+    wanted[files] = True
+    fhs = dict((i, open(names[i], 'wb', 1 << 20)) for i in files)
+    assert overlap < k, ('overlap must be < kmer length')
+    step = k - overlap
+    try:
+        i = 0
+        for seqid, n, get in _record_readers(f):
+            bseqid = _as_bytes(seqid)
+            npieces = (n + step - 1) // step
+            if k < SHORT_KMER and npieces >= SHORT_KMER:
+                # all but the last few pieces are k long.
+                nfull = (n - k) // step + 1
+                _write_short_kmers(fhs, wanted, get, bseqid, i, k, step,
+                                   nfull, chunk)
+            else:
+                nfull = 0
+            seq = None
+            for j in range(nfull, npieces):
+                fid = (i + j) % nfiles
+                if not wanted[fid]: continue
+                start = j * step
+                if n <= chunk:
+                    # a short record is read at once, a long one by piece.
+                    if seq is None: seq = get(0, n).tostring()
+                    d = seq[start:start + k]
                 else:
-                    break
+                    d = get(start, min(start + k, n)).tostring()
+                fhs[fid].write(b">" + _as_bytes(format_kmer(seqid, start))
+                               + b"\n" + d + b"\n")
+            i += npieces
+    finally:
+        for fh in fhs.values():
+            fh.close()
+
+
+def _record_readers(f):
+    """Internal: generate (key, length, get) for each record of `f` in
+    the order of f.keys(), where get(start, stop) is that part of the
+    record as an array. for the memmap record classes the positions come
+    from the index and get() slices the flat file (never past the end of
+    the record), without a record."""
+    if issubclass(f.record_class, NpyFastaRecord):
+        flat = f.prepared.view(np.ndarray)
+        for key in f.iterkeys():
+            start, stop = f.index[key][:2]
+            yield key, stop - start, \
+                    (lambda a, b, start=start, stop=stop:
+                     flat[start + a:min(start + b, stop)])
+    else:
+        for key in f.iterkeys():
+            rec = f[key]
+            yield key, len(rec), \
+                    (lambda a, b, rec=rec: _getdata(rec, slice(a, b)))
+
+
+def _write_short_kmers(fhs, wanted, get, seqid, i, k, step, nfull, chunk):
+    """Internal: write the first `nfull` pieces (numbered from `i`) of the
+    record read by get(), which are all `k` long, to the wanted files a
+    batch at a time."""
+    nfiles = len(wanted)
+    batch = max(1, chunk // k)
+    for b in range(0, nfull, batch):
+        e = min(b + batch, nfull)
+        base = b * step
+        data = get(base, (e - 1) * step + k).view(np.uint8)
+        for r in range(min(nfiles, e - b)):
+            fid = (i + b + r) % nfiles
+            if not wanted[fid]: continue
+            starts = np.arange(b + r, e, nfiles, dtype=np.int64) * step
+            fhs[fid].write(_format_kmers(seqid, starts, k, data, base))
 
-                if not added:
-                    break
-                # TODO: test this on glycine
-                #added = False
-        if added:
-            continue
 
-        print_to_fh(fh, f, lens, items[l1])
-        l1 -= 1
-        n_added += 1
+_fasta = None
 
-    if l0 == l1:
-        fh = fhs[l0 % len(fhs)]
-        print_to_fh(fh, f, lens, items[l0])
+def _init_worker(fasta):
+    global _fasta
+    _fasta = fasta
 
-    for fh in fhs:
-        fh.close()
+def _worker_kmers(args):
+    write_kmers(_fasta, *args)
 
 
-def find_name_from_len(lmin, lens):
+def with_kmers(f, names, k, overlap, workers=1):
+    """
+    split the sequences in Fasta object `f` into pieces of length `k`
+    with the given `overlap` the results are written to the files
+    `names` in turn. with `workers` > 1, that many processes each write
+    some of the files.
+    """
+    if workers <= 1 or len(names) < 2:
+        return write_kmers(f, names, k, overlap)
+    from multiprocessing import Pool
+    workers = min(workers, len(names))
+    pool = Pool(workers, _init_worker, (f,))
+    try:
+        pool.map(_worker_kmers, [(names, k, overlap,
+                                  list(range(w, len(names), workers)))
+                                 for w in range(workers)])
+    finally:
+        pool.terminate()
+        pool.join()
+
+def without_kmers(f, names, width=None, workers=1, shards=None):
     """
-    reverse lookup, get name from dict
-    >>> lens = {'chr1': 4, 'chr2': 5, 'chr3': 4}
-    >>> find_name_from_len(5, lens)
-    'chr2'
+    distribute the records of Fasta `f` among the files `names` so the
+    files have about the same number of bases (see balance()), writing
+    the files with `workers` threads. `shards` is the keys for each file
+    if they have already been balanced.
     """
-    for fname, l in lens.iteritems():
-        if l == lmin: 
-            return fname
-    raise Exception('name not found')
+    sizes, bounds = record_sizes(f)
+    if shards is None:
+        shards = balance(sizes, len(names))
+    jobs = list(zip(shards, names))
+    if workers <= 1 or len(jobs) < 2:
+        for keys, name in jobs:
+            write_records(f, keys, name, width, bounds)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        pool.map(lambda job: write_records(f, job[0], job[1], width, bounds),
+                 jobs)
+    finally:
+        pool.terminate()
+        pool.join()
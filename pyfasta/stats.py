@@ -0,0 +1,193 @@
+"""
+opt-in counters and timings for a Fasta, to see where the time goes:
+building or loading the index, reading slices from the records, or
+sequence().
+
+    >>> from pyfasta import Fasta
+    >>> f = Fasta('tests/data/three_chrs.fasta', stats=True)
+    >>> s = f['chr1'][:10]
+    >>> s = f.sequence({'chr': 'chr3', 'start': 1, 'stop': 4, 'strand': '-'})
+    >>> info = f.stats_info()
+    >>> info['slices'], info['bytes']
+    ({'NpyFastaRecord': 2}, {'NpyFastaRecord': 14})
+    >>> sorted(info['timings'])
+    ['Fasta.sequence', 'NpyFastaRecord.getdata', 'NpyFastaRecord.prepare']
+
+with stats off (the default) nothing is counted or timed and there is no
+cost per call: Fasta only wraps its records and sequence() when it has a
+Stats. a `callback` is called with (name, seconds) for each timed call,
+e.g. to observe a histogram of a metrics exporter:
+
+    >>> calls = []
+    >>> f = Fasta('tests/data/three_chrs.fasta',
+    ...           stats=Stats(lambda name, t: calls.append(name)))
+    >>> s = f['chr2'][:5]
+    >>> calls
+    ['NpyFastaRecord.prepare', 'NpyFastaRecord.getdata']
+"""
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_now = getattr(time, 'perf_counter', time.time)
+
+
+class _NoPhase(object):
+    "Internal: the context manager for a phase when there are no stats."
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_no_phase = _NoPhase()
+
+
+def phase(fasta_obj, name):
+    """
+    a context manager that times the prepare() phase `name` into the
+    stats of `fasta_obj`, or does nothing if it has none.
+    """
+    stats = getattr(fasta_obj, 'stats', None)
+    return _no_phase if stats is None else stats.phase(name)
+
+
+def _restore(klass, state):
+    "Internal: unpickle an instrumented record as its record class."
+    rec = klass.__new__(klass)
+    rec.__setstate__(state)
+    return rec
+
+
+def _page_faults():
+    if resource is None: return None
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_minflt, r.ru_majflt
+
+
+class _Phase(object):
+    def __init__(self, stats, name):
+        self.stats, self.name = stats, name
+
+    def __enter__(self):
+        self.t = _now()
+        return self
+
+    def __exit__(self, *exc):
+        t = _now() - self.t
+        with self.stats.lock:
+            self.stats.phases[self.name] = \
+                    self.stats.phases.get(self.name, 0.0) + t
+        return False
+
+
+class Stats(object):
+    """
+    counters of the slices and bytes served by each record class, the
+    calls and seconds of each timed call ('Fasta.sequence',
+    '<record class>.prepare' and '<record class>.getdata', or .__getitem__
+    for classes without getdata), the seconds of each phase of prepare()
+    and whether the index was built or loaded (None for the record
+    classes with no index on disk). see info().
+    counts can be updated from many threads.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self._classes = {}
+        self.reset()
+
+    def reset(self):
+        "set all the counters to 0."
+        with self.lock:
+            self.slices = {}
+            self.bytes = {}
+            self.timings = {}
+            self.phases = {}
+            self.index = None
+            self._faults = _page_faults()
+
+    def add_time(self, name, seconds):
+        "count a call of `name` that took `seconds` and pass it to callback."
+        with self.lock:
+            t = self.timings.get(name)
+            if t is None:
+                t = self.timings[name] = [0, 0.0]
+            t[0] += 1
+            t[1] += seconds
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    def served(self, klass_name, nbytes):
+        "count a slice of `nbytes` served by the record class `klass_name`."
+        with self.lock:
+            self.slices[klass_name] = self.slices.get(klass_name, 0) + 1
+            self.bytes[klass_name] = self.bytes.get(klass_name, 0) + nbytes
+
+    def phase(self, name):
+        "a context manager that adds the time in it to phases[name]."
+        return _Phase(self, name)
+
+    def timed(self, name, fn):
+        "fn wrapped so that each call is counted and timed as `name`."
+        def timed(*args, **kwargs):
+            t = _now()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add_time(name, _now() - t)
+        timed.__doc__ = fn.__doc__
+        return timed
+
+    def instrument(self, klass):
+        """
+        a subclass of the record class `klass` (with the same name) whose
+        getdata(), or __getitem__() if it has none, is counted and timed.
+        its records pickle as plain `klass` records.
+        """
+        sub = self._classes.get(klass)
+        if sub is not None:
+            return sub
+        method = 'getdata' if hasattr(klass, 'getdata') else '__getitem__'
+        fn = getattr(klass, method)
+        name = "%s.%s" % (klass.__name__, method)
+        klass_name = klass.__name__
+        stats = self
+
+        def served(rec, islice):
+            t = _now()
+            d = fn(rec, islice)
+            stats.add_time(name, _now() - t)
+            stats.served(klass_name, len(d))
+            return d
+
+        def __reduce__(rec):
+            return _restore, (klass, rec.__getstate__())
+
+        sub = self._classes[klass] = type(klass.__name__, (klass,), {
+            '__slots__': (), method: served, '__reduce__': __reduce__,
+            '__module__': klass.__module__, '__doc__': klass.__doc__})
+        return sub
+
+    def info(self):
+        """
+        the counters as a dict of plain values. 'timings' has
+        (calls, seconds) of each name and 'page_faults' the (minor, major)
+        page faults of the process since the stats were made or reset
+        (None where the resource module is missing).
+        """
+        with self.lock:
+            info = {'slices': dict(self.slices),
+                    'bytes': dict(self.bytes),
+                    'timings': dict((k, tuple(v))
+                                    for k, v in self.timings.items()),
+                    'phases': dict(self.phases),
+                    'index': self.index}
+        faults = _page_faults()
+        info['page_faults'] = None if faults is None else \
+                tuple(b - a for a, b in zip(self._faults, faults))
+        return info
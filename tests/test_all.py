@@ -1,6 +1,8 @@
-from pyfasta import Fasta
+from pyfasta import Fasta, complement
 from pyfasta.records import NpyFastaRecord, MemoryRecord, FastaRecord
-record_classes = [NpyFastaRecord, MemoryRecord, FastaRecord]
+from pyfasta.records import FaidxRecord, TwoBitRecord, UcscTwoBitRecord
+from pyfasta.records import BgzfRecord, BgzfReader, FlatIndex
+record_classes = [NpyFastaRecord, MemoryRecord, FastaRecord, TwoBitRecord]
 from pyfasta import DuplicateHeaderException
 
 try:
@@ -9,9 +11,22 @@ try:
 except ImportError:
     pass
 
+try:
+    from pyfasta.records import SqliteRecord
+    record_classes.append(SqliteRecord)
+except ImportError:
+    SqliteRecord = None
+
+try:
+    import asyncio
+    from pyfasta.aio import AsyncFasta
+except ImportError:
+    AsyncFasta = None
+
 import os
 import shutil
 from nose.tools import assert_raises
+from unittest import SkipTest
 import numpy as np
 import glob
 
@@ -41,6 +56,8 @@ def test_classes():
             yield check_array_copy, f
             yield check_array, f
             yield check_one_based, f
+            yield check_sequences, f
+            yield check_sequence_output, f
 
             fasta_name = f.fasta_name
 
@@ -70,7 +87,7 @@ def check_keys(f):
 def fix(path):
     import os.path as op
 
-    for ext in (".gdx", ".flat"):
+    for ext in (".gdx", ".flat", ".2bp", ".2bx", ".sqlite", ".gcx"):
         if op.exists(path + ext):
             os.unlink(path + ext)
 
@@ -250,6 +267,943 @@ def check_one_based(f):
     assert f.sequence({'chr': 'chr1', 'start': 2, 'stop': 9})  == 'CTGACTGA'
     assert f.sequence({'chr': 'chr1', 'start': 2, 'stop': 9}, one_based=False) == 'TGACTGA'
 
+def check_sequences(f):
+    feats = [{'chr': 'chr1', 'start': 2, 'stop': 9, 'strand': 1},
+             {'chr': 'chr3', 'start': 3590, 'stop': 3700, 'strand': -1},
+             {'chr': 'chr2', 'start': 70, 'stop': 75, 'strand': '-'},
+             {'chr': 'chr1', 'start': 20, 'stop': 19, 'strand': 1}]
+    seqs = f.sequences([x['chr'] for x in feats], [x['start'] for x in feats],
+                       [x['stop'] for x in feats], [x['strand'] for x in feats])
+    assert seqs == [f.sequence(x) for x in feats], seqs
+
+    buf, offsets = f.sequences(['chr2', 'chr3'], [0, 0], [3, 4],
+                               one_based=False, packed=True)
+    assert buf.tostring().decode() == 'TAAACGC'
+    assert offsets.tolist() == [0, 3, 7]
+
+    # a start before the record is clipped to 0 rather than counted
+    # from the end as sequence() (a python slice) does.
+    assert f.sequences(['chr1', 'chr1', 'chr2'], [-1, -5, 70], [3, 0, 200],
+                       one_based=False) == ['ACT', '', f['chr2'][70:]]
+    assert f.sequence({'chr': 'chr1', 'start': -5, 'stop': 80},
+                      one_based=False) == f['chr1'][75:]
+
+def check_sequence_output(f):
+    for strand in (1, -1):
+        feat = {'chr': 'chr3', 'start': 3590, 'stop': 3700, 'strand': strand}
+        seq = f['chr3'][3589:3600]
+        if strand == -1:
+            seq = complement(seq)[::-1]
+        assert f.sequence(feat) == seq
+        assert f.sequence(feat, output='bytes') == seq.encode()
+        a = f.sequence(feat, asstring=False)
+        assert a.dtype == np.dtype('S1') and a.tostring().decode() == seq
+        # the array is a copy.
+        a[:] = b'N'
+        assert f.sequence(feat) == seq
+
+    feat = dict(chr='chr1', start=9, stop=19, strand=-1,
+                exons=[(9, 11), (13, 15), (17, 19)])
+    assert f.sequence(feat, exon_keys=('exons',), output='bytes') == \
+            b'AGTAGTAGT'
+
+def _naive_seqs(path):
+    seqs = []
+    for line in open(path):
+        line = line.rstrip()
+        if line.startswith('>'):
+            seqs.append([line[1:].strip(), ''])
+        elif seqs:
+            seqs[-1][1] += line
+    return [tuple(s) for s in seqs]
+
+def test_gen_blocks():
+    for path in ('tests/data/three_chrs.fasta', 'tests/data/key.fasta',
+                 'tests/data/wrapped.fasta'):
+        expected = _naive_seqs(path)
+        f = Fasta(path, record_class=MemoryRecord)
+        for blocksize in (1, 2, 3, 7, 64, 1 << 20):
+            seqs = list(f.gen_seqs_with_headers(blocksize=blocksize))
+            assert seqs == expected, (path, blocksize, seqs)
+            blocks = list(f.gen_blocks_with_headers(blocksize=blocksize))
+            assert all(len(b) <= blocksize for _, b in blocks)
+    _cleanup()
+
+def test_flatten_parallel():
+    from pyfasta.flatten_fasta import flatten_parallel
+    for path in ('tests/data/three_chrs.fasta', 'tests/data/key.fasta',
+                 'tests/data/wrapped.fasta'):
+        for inplace in (False, True):
+            f = Fasta(path, record_class=MemoryRecord)
+            serial_idx = FastaRecord.write_flat(f, f.gen_blocks_with_headers(),
+                                                path + '.serial', inplace)
+            serial = open(path + '.serial', 'rb').read()
+            for workers, blocksize in ((2, 3), (3, 7), (5, 1 << 20)):
+                idx = flatten_parallel(path, path + '.parallel',
+                                       flatten_inplace=inplace,
+                                       workers=workers, blocksize=blocksize)
+                assert idx == serial_idx, (path, idx, serial_idx)
+                assert open(path + '.parallel', 'rb').read() == serial
+            os.unlink(path + '.serial')
+            os.unlink(path + '.parallel')
+
+    f = Fasta('tests/data/three_chrs.fasta', workers=2)
+    assert f['chr3'][-12:] == 'TACGCACGCTAC'
+    _cleanup()
+    assert_raises(DuplicateHeaderException,
+                  lambda: Fasta('tests/data/dups.fasta', workers=2))
+    _cleanup()
+
+def check_all_slices(f, m):
+    # compare every slice of the records in `f` to the MemoryRecords in `m`
+    for k in m.keys():
+        seq = str(m[k])
+        assert str(f[k]) == seq
+        assert len(f[k]) == len(seq)
+        for i in range(-len(seq), len(seq)):
+            assert f[k][i] == seq[i]
+        for start in range(-3, len(seq) + 2):
+            for stop in (start + 1, start + 9, start + 25, None):
+                assert f[k][start:stop] == seq[start:stop]
+                assert f[k][start:stop:3] == seq[start:stop:3]
+
+def test_twobit():
+    path = 'tests/data/wrapped.fasta'
+    m = Fasta(path, record_class=MemoryRecord)
+    # small blocks so runs and packed bytes cross block boundaries.
+    idx, packed = TwoBitRecord.prepare(m, m.gen_blocks_with_headers(
+                                                blocksize=3), False)
+    assert packed.nbytes == 10 + 10 + 2 + 10
+    assert idx['seq2'][2].tolist() == [[40, 45]]
+    assert idx['seq1 some description'][3].tolist() == [[36, 39]]
+
+    f = Fasta(path, record_class=TwoBitRecord)
+    check_all_slices(f, m)
+    assert f['seq1 some description'][35:] == 'Tacg'
+    assert f.sequence({'chr': 'seq2', 'start': 4, 'stop': 7,
+                       'strand': -1}) == 'AANN'
+    for ext in ('.2bp', '.2bx'):
+        os.unlink(path + ext)
+
+def test_ucsc_twobit():
+    # wrapped.2bit has the sequences of wrapped.fasta in UCSC .2bit format.
+    f = Fasta('tests/data/wrapped.2bit', record_class=UcscTwoBitRecord)
+    m = Fasta('tests/data/wrapped.fasta', record_class=MemoryRecord,
+              key_fn=lambda k: k.split()[0])
+    assert len(f) == 4
+    assert 'seq3' in f and not 'seq5' in f
+    check_all_slices(f, m)
+    assert_raises(KeyError, lambda: f['seq5'])
+
+    f = Fasta('tests/data/wrapped.2bit', record_class=UcscTwoBitRecord,
+              key_fn=lambda k: 'chr' + k)
+    assert f['chrseq3'][:] == 'GATTACA'
+    assert_raises(ValueError, lambda: Fasta('tests/data/wrapped.fasta',
+                                            record_class=UcscTwoBitRecord))
+
+def test_faidx():
+    path = 'tests/data/wrapped.fasta'
+    f = Fasta(path, record_class=FaidxRecord)
+    m = Fasta(path, record_class=MemoryRecord,
+              key_fn=lambda k: k.split()[0])
+    try:
+        assert sorted(f.keys()) == ['seq1', 'seq2', 'seq3', 'seq4']
+        assert open(path + '.fai').read() == \
+            "seq1\t39\t23\t10\t11\nseq2\t40\t72\t10\t11\n" \
+            "seq3\t7\t122\t7\t8\nseq4\t40\t136\t10\t11\n"
+
+        check_all_slices(f, m)
+        assert_raises(IndexError, lambda: f['seq3'][7])
+        assert np.array(f['seq3']).tostring().decode() == 'GATTACA'
+        assert f.sequence({'chr': 'seq2', 'start': 9, 'stop': 12,
+                           'strand': -1}) == 'TGGT'
+
+        # an existing .fai is used as-is, and key_fn is applied to it.
+        with open(path + '.fai', 'w') as fh:
+            fh.write("chrA\t7\t122\t7\t8\n")
+        f = Fasta(path, record_class=FaidxRecord, key_fn=str.lower)
+        assert list(f.keys()) == ['chra']
+        assert f['chra'][:] == 'GATTACA'
+
+        # as for the other record classes, a key_fn can't merge records.
+        with open(path + '.fai', 'a') as fh:
+            fh.write("CHRA\t7\t122\t7\t8\n")
+        assert_raises(DuplicateHeaderException, lambda: Fasta(path,
+                      record_class=FaidxRecord, key_fn=str.lower))
+    finally:
+        os.unlink(path + '.fai')
+
+def test_faidx_line_length():
+    assert_raises(ValueError, lambda: Fasta('tests/data/three_chrs.fasta',
+                                            record_class=FaidxRecord))
+    assert not os.path.exists('tests/data/three_chrs.fasta.fai')
+
+def test_bgzf():
+    path = 'tests/data/wrapped.fasta.gz'
+    f = Fasta(path, record_class=BgzfRecord)
+    m = Fasta('tests/data/wrapped.fasta', record_class=MemoryRecord,
+              key_fn=lambda k: k.split()[0])
+    try:
+        assert sorted(f.keys()) == ['seq1', 'seq2', 'seq3', 'seq4']
+        assert os.path.exists(path + '.gzi')
+        check_all_slices(f, m)
+        assert f.sequence({'chr': 'seq2', 'start': 9, 'stop': 12,
+                           'strand': -1}) == 'TGGT'
+
+        reader = f.prepared
+        assert len(reader.uoffsets) > 1
+        assert reader.cache.hits > 0
+
+        # the .gzi is read back rather than rebuilt.
+        coffsets, uoffsets = BgzfReader.read_gzi(path + '.gzi')
+        assert (coffsets == reader.coffsets[:-1]).all()
+        assert (uoffsets == reader.uoffsets).all()
+        f = Fasta(path, record_class=BgzfRecord)
+        assert f['seq3'][:] == 'GATTACA'
+    finally:
+        for ext in ('.fai', '.gzi'):
+            os.unlink(path + ext)
+
+def test_bgzf_plain_gzip():
+    import gzip
+    path = 'tests/data/plain.fasta.gz'
+    with gzip.open(path, 'wb') as fh:
+        fh.write(open('tests/data/wrapped.fasta', 'rb').read())
+    try:
+        assert_raises(ValueError, lambda: Fasta(path, record_class=BgzfRecord))
+    finally:
+        for ext in ('', '.fai', '.gzi'):
+            if os.path.exists(path + ext):
+                os.unlink(path + ext)
+
+def test_caches():
+    f = Fasta('tests/data/three_chrs.fasta', record_cache=2,
+              slice_cache_bytes=10)
+    for k in ('chr1', 'chr2', 'chr3', 'chr1'):
+        f[k]
+    assert sorted(f.chr.keys()) == ['chr1', 'chr3']
+    assert f['chr3'] is f['chr3']
+
+    a = f.sequence({'chr': 'chr3', 'start': 1, 'stop': 8})
+    b = f.sequence({'chr': 'chr3', 'start': 1, 'stop': 8, 'strand': -1})
+    assert b == complement(a)[::-1]
+    info = f.cache_info()
+    assert info['slice_hits'] == 1 and info['slice_misses'] == 1
+    assert info['slice_bytes'] == 8
+
+    # over budget, the oldest slices are dropped.
+    f.sequence({'chr': 'chr1', 'start': 1, 'stop': 4})
+    assert f.cache_info()['slice_bytes'] == 4
+    # slices larger than the whole budget are not kept.
+    f.sequence({'chr': 'chr3', 'start': 1, 'stop': 100})
+    assert f.cache_info()['slice_bytes'] == 4
+
+    # exons go through the same cache.
+    feat = dict(chr='chr1', start=1, stop=10, exons=[(1, 4), (6, 9)])
+    assert f.sequence(feat, exon_keys=('exons',)) == 'ACTGCTGA'
+    assert f.cache_info()['slice_hits'] == 2
+
+def test_windows():
+    path = 'tests/data/three_chrs.fasta'
+    for klass in record_classes:
+        f = Fasta(path, record_class=klass)
+        seq = f['chr3'][:]
+        for size, step in ((10, 10), (7, 3), (100, 1), (3600, 5), (4000, 1)):
+            expected = [seq[i:i + size]
+                        for i in range(0, len(seq) - size + 1, step)]
+            w = f.windows('chr3', size, step)
+            assert w.shape == (len(expected), size)
+            assert [r.tostring().decode() for r in w] == expected
+            assert not w.flags.writeable
+            chunks = list(f.windows('chr3', size, step, chunk=50))
+            assert [start for start, _ in chunks] == \
+                    [i * step for i in range(0, len(expected), 50)]
+            assert [r.tostring().decode() for _, c in chunks for r in c] == expected
+        fix(path)
+    f = Fasta(path)
+    assert np.may_share_memory(f.windows('chr1', 8, 2), f.prepared)
+    assert_raises(ValueError, f.windows, 'chr1', 0)
+
+def test_output():
+    for klass in (NpyFastaRecord, TwoBitRecord):
+        fs = Fasta('tests/data/three_chrs.fasta', record_class=klass)
+        fb = Fasta('tests/data/three_chrs.fasta', record_class=klass,
+                   output='bytes')
+        fm = Fasta('tests/data/three_chrs.fasta', record_class=klass,
+                   output='memoryview')
+        for sl in (slice(2, 9), slice(None), slice(5, 60, 3),
+                   slice(None, None, -1), slice(20, 10)):
+            s = fs['chr1'][sl]
+            assert fb['chr1'][sl] == s.encode()
+            m = fm['chr1'][sl]
+            assert isinstance(m, memoryview) and m.readonly
+            assert m.tobytes() == s.encode()
+        assert fb['chr1'][1] == fm['chr1'][1] == b'C'
+        # sequence() is not changed by output.
+        assert fm.sequence({'chr': 'chr1', 'start': 2, 'stop': 9}) == \
+                'CTGACTGA'
+
+    # a contiguous slice is a view of the memmap.
+    f = Fasta('tests/data/three_chrs.fasta', output='memoryview')
+    m = f['chr3'][10:20]
+    assert np.may_share_memory(np.asarray(m), f.prepared)
+
+    assert_raises(ValueError, lambda: Fasta('tests/data/three_chrs.fasta',
+                                            record_class=FastaRecord,
+                                            output='bytes'))
+
+def test_flat_index():
+    import cPickle
+    path = 'tests/data/three_chrs.fasta'
+    f = Fasta(path)
+    assert FlatIndex.is_flat_index(path + '.gdx')
+    assert isinstance(f.index, FlatIndex)
+    assert sorted(f.index.items()) == \
+        [('chr1', (0, 80)), ('chr2', (80, 160)), ('chr3', (160, 3760))]
+    assert 'chr4' not in f and 'chr' not in f and 1 not in f.index
+
+    # a .gdx pickled by an older version is converted.
+    idx = dict(f.index.items())
+    del f
+    with open(path + '.gdx', 'wb') as fh:
+        cPickle.dump(idx, fh, -1)
+    f = Fasta(path)
+    assert FlatIndex.is_flat_index(path + '.gdx')
+    assert f['chr3'][:3] == 'ACG'
+
+    idx = dict(('s%i' % i, (i * 10, i * 10 + i)) for i in range(1000))
+    FlatIndex.write(path + '.test.gdx', idx)
+    try:
+        fi = FlatIndex(path + '.test.gdx')
+        assert len(fi) == 1000 and sorted(fi) == sorted(idx)
+        for k, v in idx.items():
+            assert fi[k] == v
+        assert_raises(KeyError, lambda: fi['s1000'])
+        FlatIndex.write(path + '.test.gdx', {})
+        assert len(FlatIndex(path + '.test.gdx')) == 0
+    finally:
+        os.unlink(path + '.test.gdx')
+
+def test_sqlite():
+    if SqliteRecord is None:
+        raise SkipTest("SqliteRecord needs the sqlite3 module")
+    path = 'tests/data/wrapped.fasta'
+    f = Fasta(path, record_class=SqliteRecord)
+    try:
+        assert list(f.keys()) == ['seq1 some description', 'seq2', 'seq3',
+                                  'seq4']
+        # the first word and the full header both work.
+        assert f['seq1'][:] == f['seq1 some description'][:] == \
+                'ACGT' * 9 + 'acg'
+        assert 'seq1' in f and 'seq5' not in f
+        assert len(f) == 4
+
+        assert f.index.prefix('seq') == list(f.keys())
+        assert f.index.prefix('seq1 ') == ['seq1 some description']
+        assert f.index.glob('seq[34]') == ['seq3', 'seq4']
+        assert f.index.glob('*description') == ['seq1 some description']
+        assert f.index.prefix('[') == []
+
+        f.index.add_aliases([('chrA', 'seq3'), ('chrB', 'seq4')])
+        assert_raises(KeyError, f.index.add_aliases, [('chrC', 'seq9')])
+        assert_raises(ValueError, f.index.add_aliases, [('seq2', 'seq3')])
+        assert f.index.prefix('chr') == ['seq3', 'seq4']
+
+        # aliases are kept when the index is opened again.
+        del f
+        f = Fasta(path, record_class=SqliteRecord, key_fn=str.upper)
+        assert f['chrA'][:] == 'GATTACA'
+        assert f.sequence({'chr': 'chrB', 'start': 1, 'stop': 3}) == 'CCG'
+        os.unlink(path + '.sqlite')
+
+        # the key_fn gives the names when the index is built.
+        f = Fasta(path, record_class=SqliteRecord, key_fn=str.upper)
+        assert list(f.keys())[1:] == ['SEQ2', 'SEQ3', 'SEQ4']
+        assert f['seq2'][:] == f['SEQ2'][:]
+        os.unlink(path + '.sqlite')
+
+        assert_raises(DuplicateHeaderException, lambda: Fasta(path,
+                      record_class=SqliteRecord, key_fn=lambda k: 'x'))
+        assert not os.path.exists(path + '.sqlite')
+    finally:
+        for ext in ('.sqlite', '.flat'):
+            if os.path.exists(path + ext):
+                os.unlink(path + ext)
+
+def test_threads():
+    from multiprocessing.pool import ThreadPool
+    path = 'tests/data/three_chrs.fasta'
+    expected = Fasta(path, record_class=MemoryRecord)
+    rng = np.random.RandomState(42)
+    regions = []
+    for i in range(2000):
+        chrom = ('chr1', 'chr2', 'chr3')[rng.randint(3)]
+        start = rng.randint(len(expected[chrom]))
+        regions.append((chrom, start, start + rng.randint(1, 200),
+                        rng.choice([1, -1])))
+    truth = [expected[c][a:b] if s == 1 else complement(expected[c][a:b])[::-1]
+             for c, a, b, s in regions]
+
+    for klass in (FastaRecord, NpyFastaRecord, TwoBitRecord):
+        f = Fasta(path, record_class=klass, slice_cache_bytes=1000)
+        assert f.fetch_many(regions, max_workers=8) == truth
+        assert f.fetch_many(regions, max_workers=1) == truth
+        # the records share one file handle, reads must not interleave.
+        pool = ThreadPool(8)
+        seqs = pool.map(lambda r: f[r[0]][r[1]:r[2]], regions)
+        pool.terminate()
+        assert seqs == [expected[c][a:b] for c, a, b, _ in regions]
+    assert f.fetch_many([]) == []
+
+def test_async_merge():
+    # the grouping of requests into reads doesn't need asyncio.
+    from pyfasta.aio import _merge
+    rng = np.random.RandomState(2)
+    starts = rng.randint(0, 1000, 200)
+    reqs = [(s, s + rng.randint(1, 20), i) for i, s in enumerate(starts)]
+    groups = _merge(reqs)
+    assert sorted(r for _, _, g in groups for r in g) == sorted(reqs)
+    for (start, stop, g), nxt in zip(groups, groups[1:] + [None]):
+        assert start == min(r[0] for r in g) and stop == max(r[1] for r in g)
+        if nxt is not None:
+            assert stop < nxt[0]
+
+def test_async():
+    if AsyncFasta is None:
+        raise SkipTest("AsyncFasta needs asyncio (python 3)")
+    f = Fasta('tests/data/three_chrs.fasta')
+    regions = [('chr1', 0, 4), ('chr1', 2, 8, '-'), ('chr3', 9, 12, -1),
+               ('chr1', 8, 12), ('chr2', 70, 90)]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    fa = AsyncFasta(f, max_workers=2)
+    try:
+        seqs = loop.run_until_complete(fa.fetch_many(regions))
+        assert seqs == f.fetch_many(regions)
+        # the overlapping chr1 regions were merged into one read.
+        assert fa.nreads == 3
+
+        # cancelling one request leaves the read for the others.
+        whole = fa.fetch('chr3', 0, 3600)
+        part = fa.fetch('chr3', 10, 20)
+        part.cancel()
+        assert loop.run_until_complete(whole) == f['chr3'][:]
+        assert part.cancelled() and not fa._reads
+
+        # a request cancelled before it is read is never read.
+        nreads = fa.nreads
+        fa.fetch('chr2', 0, 10).cancel()
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert fa.nreads == nreads
+
+        assert_raises(KeyError, loop.run_until_complete,
+                      fa.fetch('chrX', 0, 10))
+        fb = AsyncFasta(f, output='bytes')
+        assert loop.run_until_complete(fb.fetch('chr1', 0, 4)) == b'ACTG'
+        fb.close()
+    finally:
+        fa.close()
+        asyncio.set_event_loop(None)
+        loop.close()
+
+def _pickled_fetch(args):
+    f, chrom, start, stop = args
+    return f[chrom][start:stop]
+
+def test_pickle():
+    import pickle
+    from multiprocessing import Pool
+    path = 'tests/data/three_chrs.fasta'
+    classes = [FastaRecord, NpyFastaRecord, MemoryRecord, TwoBitRecord]
+    if SqliteRecord is not None:
+        classes.append(SqliteRecord)
+    for klass in classes:
+        for inplace in (False, True):
+            if inplace and klass in (MemoryRecord, TwoBitRecord): continue
+            f = Fasta(path, record_class=klass, flatten_inplace=inplace,
+                      record_cache=10, key_fn=lambda k: k)
+            for protocol in (0, 2, -1):
+                data = pickle.dumps(f, protocol)
+                if klass is not MemoryRecord:
+                    # the sequence is not in the pickle.
+                    assert len(data) < 2000, (klass, len(data))
+                g = pickle.loads(data)
+                assert sorted(g.keys()) == sorted(f.keys())
+                assert g['chr3'][:] == f['chr3'][:]
+                assert g.chr.maxsize == 10
+                assert g.sequence({'chr': 'chr2', 'start': 3, 'stop': 9,
+                                   'strand': -1}) == \
+                       f.sequence({'chr': 'chr2', 'start': 3, 'stop': 9,
+                                   'strand': -1})
+
+                r = pickle.loads(pickle.dumps(f['chr1'], protocol))
+                assert r[:] == f['chr1'][:] and len(r) == len(f['chr1'])
+            fix(path)
+
+    for path, klass in (('tests/data/wrapped.fasta', FaidxRecord),
+                        ('tests/data/wrapped.fasta.gz', BgzfRecord),
+                        ('tests/data/wrapped.2bit', UcscTwoBitRecord)):
+        f = Fasta(path, record_class=klass)
+        g = pickle.loads(pickle.dumps(f, -1))
+        assert [g[k][:] for k in sorted(g)] == [f[k][:] for k in sorted(f)]
+        for ext in ('.fai', '.gzi'):
+            if os.path.exists(path + ext):
+                os.unlink(path + ext)
+
+    f = Fasta('tests/data/three_chrs.fasta')
+    pool = Pool(2)
+    try:
+        seqs = pool.map(_pickled_fetch, [(f, 'chr3', i, i + 10)
+                                         for i in range(0, 100, 10)])
+    finally:
+        pool.terminate()
+        pool.join()
+    assert "".join(seqs) == f['chr3'][:100]
+
+def test_composition():
+    from pyfasta.composition import fasta_composition, byte_counts
+    path = 'tests/data/wrapped.fasta'
+    m = Fasta(path, record_class=MemoryRecord, key_fn=lambda k: k.split()[0])
+    for klass in (NpyFastaRecord, FastaRecord, TwoBitRecord, FaidxRecord):
+        f = Fasta(path, record_class=klass)
+        comps = dict(fasta_composition(f, chunk=7))
+        assert comps == dict(fasta_composition(f, workers=2))
+        for k, comp in comps.items():
+            seq = m[k.split()[0]][:]
+            assert comp['length'] == len(seq)
+            for base in 'ACGTN':
+                assert comp[base] == seq.upper().count(base)
+            assert comp['lower'] == sum(c.islower() for c in seq)
+        s1 = comps['seq1' if klass is FaidxRecord else 'seq1 some description']
+        assert s1['lower'] == 3 and s1['gc'] == 20 / 39.
+        assert comps['seq2']['N'] == 5
+        for ext in ('.fai', '.flat', '.gdx', '.2bp', '.2bx'):
+            if os.path.exists(path + ext): os.unlink(path + ext)
+
+    f = Fasta('tests/data/three_chrs.fasta')
+    assert byte_counts(f['chr3'], chunk=1000).sum() == 3600
+
+def test_split():
+    from pyfasta.split_fasta import split, balance
+    path = 'tests/data/three_chrs.fasta'
+    m = Fasta(path, record_class=MemoryRecord)
+    expected = dict((k, m[k][:]) for k in m.keys())
+    for klass in (NpyFastaRecord, FastaRecord):
+        fix(path)
+        Fasta(path, record_class=klass)
+        for args, nfiles in ((['-n', '2'], 2),
+                             (['-n', '3', '-w', '7', '-j', '3'], 3),
+                             (['-s', '1000', '-w', '60'], 3)):
+            split(args + [path])
+            names = sorted(glob.glob('tests/data/three_chrs.*.fasta'))
+            assert len(names) == nfiles, (args, names)
+            seqs = {}
+            for name in names:
+                s = Fasta(name, record_class=MemoryRecord)
+                seqs.update((k, s[k][:]) for k in s.keys())
+                if '-w' in args:
+                    width = int(args[args.index('-w') + 1])
+                    lines = [l for l in open(name).read().split() if l[0] != '>']
+                    assert max(len(l) for l in lines) == width
+                for f in glob.glob(name + '*'):
+                    os.unlink(f)
+            assert seqs == expected, args
+    fix(path)
+
+    # unwrapped memmap records are copied by sendfile. where os.sendfile
+    # is missing (py2) a stand-in that copies a few bytes a call is used.
+    import pyfasta.split_fasta as split_fasta
+    def copy_some(out, src, pos, n):
+        os.lseek(src, pos, os.SEEK_SET)
+        return os.write(out, os.read(src, min(n, 5)))
+    sendfile = split_fasta._sendfile
+    for send in (sendfile, copy_some):
+        if send is None: continue
+        calls = []
+        split_fasta._sendfile = lambda *a: calls.append(a) or send(*a)
+        try:
+            split(['-n', '2', path])
+        finally:
+            split_fasta._sendfile = sendfile
+        assert calls
+        seqs = {}
+        for name in sorted(glob.glob('tests/data/three_chrs.*.fasta')):
+            s = Fasta(name, record_class=MemoryRecord)
+            seqs.update((k, s[k][:]) for k in s.keys())
+            for f in glob.glob(name + '*'):
+                os.unlink(f)
+        assert seqs == expected
+    fix(path)
+
+    sizes = [('s%i' % i, i * 7 % 23 + 1) for i in range(100)]
+    shards = balance(sizes, 7)
+    assert sorted(sum(shards, [])) == sorted(k for k, _ in sizes)
+    totals = [sum(dict(sizes)[k] for k in shard) for shard in shards]
+    assert max(totals) - min(totals) <= 23
+
+def test_split_kmers():
+    from pyfasta.split_fasta import with_kmers, write_kmers, format_kmer
+    path = 'tests/data/three_chrs.fasta'
+    for klass in (NpyFastaRecord, TwoBitRecord):
+        f = Fasta(path, record_class=klass)
+        for nfiles, k, overlap, workers in ((1, 1000, 0, 1), (3, 7, 2, 1),
+                                            (4, 100, 99, 2), (2, 5000, 0, 2),
+                                            (3, 10, 0, 0)):
+            expected = [[] for _ in range(nfiles)]
+            i = 0
+            for seqid in f.iterkeys():
+                for start, seq in Fasta.as_kmers(f[seqid], k, overlap):
+                    expected[i % nfiles].append(">%s\n%s\n"
+                                                % (format_kmer(seqid, start), seq))
+                    i += 1
+            names = ['tests/data/kmers.%i.fasta' % j for j in range(nfiles)]
+            if workers:
+                with_kmers(f, names, k, overlap, workers)
+            else:
+                # many small batches.
+                write_kmers(f, names, k, overlap, chunk=64)
+            for name, recs in zip(names, expected):
+                assert open(name).read() == "".join(recs), (k, overlap)
+                os.unlink(name)
+        _unlink_sidecars(path)
+
+    # records longer than the chunk, followed by others in the flat file
+    # (or, inplace, by their headers): no piece may run into the next.
+    path = 'tests/data/kmers_multi.fasta'
+    rng = np.random.RandomState(11)
+    with open(path, 'w') as fh:
+        for i, n in enumerate((10, 10, 37, 3, 64, 9, 25)):
+            fh.write(">r%i\n%s\n" % (i, "".join(rng.choice(list("ACGTN"), n))))
+    try:
+        for klass, inplace in ((NpyFastaRecord, False), (NpyFastaRecord, True),
+                               (TwoBitRecord, False)):
+            f = Fasta(path, record_class=klass, flatten_inplace=inplace)
+            for nfiles, k, overlap, chunk in ((1, 4, 0, 8), (3, 7, 2, 8),
+                                              (2, 5, 4, 16), (4, 12, 3, 5)):
+                expected = [[] for _ in range(nfiles)]
+                i = 0
+                for seqid in f.iterkeys():
+                    for start, seq in Fasta.as_kmers(f[seqid], k, overlap):
+                        expected[i % nfiles].append(
+                            ">%s\n%s\n" % (format_kmer(seqid, start), seq))
+                        i += 1
+                names = ['tests/data/kmers.%i.fasta' % j for j in range(nfiles)]
+                write_kmers(f, names, k, overlap, chunk=chunk)
+                for name, recs in zip(names, expected):
+                    assert open(name).read() == "".join(recs), (k, chunk)
+                    os.unlink(name)
+            _unlink_sidecars(path)
+    finally:
+        os.unlink(path)
+
+def _naive_kmers(seqs, k, canonical):
+    counts = {}
+    for seq in seqs:
+        seq = seq.upper()
+        for i in range(len(seq) - k + 1):
+            kmer = seq[i:i + k]
+            if set(kmer) - set('ACGT'): continue
+            if canonical:
+                kmer = min(kmer, complement(kmer)[::-1])
+            counts[kmer] = counts.get(kmer, 0) + 1
+    return sorted(counts.items())
+
+def test_kmer_counts():
+    from pyfasta.composition import fasta_kmer_counts, decode_kmers
+    path = 'tests/data/wrapped.fasta'
+    m = Fasta(path, record_class=MemoryRecord)
+    seqs = [m[k][:] for k in m.keys()]
+    for klass in (NpyFastaRecord, TwoBitRecord):
+        f = Fasta(path, record_class=klass)
+        for k in (1, 2, 5, 16, 31, 32):
+            for canonical in (True, False):
+                codes, counts = fasta_kmer_counts(f, k, canonical=canonical,
+                                                  chunk=7)
+                assert list(zip(decode_kmers(codes, k), counts.tolist())) \
+                        == _naive_kmers(seqs, k, canonical)
+        codes, counts = f.kmer_counts(5, workers=2)
+        assert (codes == fasta_kmer_counts(f, 5)[0]).all()
+        assert counts.sum() == sum(c for _, c in _naive_kmers(seqs, 5, True))
+        _unlink_sidecars(path)
+    assert_raises(ValueError, f.kmer_counts, 33)
+
+def test_info_json():
+    import json
+    import pyfasta
+    from StringIO import StringIO
+    import sys
+    out, sys.stdout = sys.stdout, StringIO()
+    try:
+        pyfasta.info(['--format', 'json', '-j', '2',
+                      'tests/data/three_chrs.fasta'])
+        data = json.loads(sys.stdout.getvalue())
+    finally:
+        sys.stdout = out
+    assert data['file'] == 'tests/data/three_chrs.fasta'
+    assert [r['seqid'] for r in data['records']] == ['chr1', 'chr2', 'chr3']
+    assert data['records'][1]['T'] == 2
+
+    # the index of wrapped.fasta hashes in a different order.
+    in_file = ['seq1 some description', 'seq2', 'seq3', 'seq4']
+    assert list(Fasta('tests/data/wrapped.fasta').keys()) != in_file
+    out, sys.stdout = sys.stdout, StringIO()
+    try:
+        pyfasta.info(['--format', 'tsv', 'tests/data/wrapped.fasta'])
+        lines = sys.stdout.getvalue().splitlines()
+    finally:
+        sys.stdout = out
+    assert [l.split('\t')[1] for l in lines[1:]] == in_file
+
+def test_extract_regions():
+    import pyfasta
+    from pyfasta.intervals import read_bed, read_gff, write_regions
+    from StringIO import StringIO
+    import sys
+    path = 'tests/data/three_chrs.fasta'
+    m = Fasta(path, record_class=MemoryRecord)
+    rng = np.random.RandomState(3)
+    bed, expected = [], []
+    for i in range(500):
+        chrom = ('chr1', 'chr2', 'chr3')[rng.randint(3)]
+        start = rng.randint(len(m[chrom]))
+        stop = start + rng.randint(1, 100)
+        strand = '+-'[rng.randint(2)]
+        seq = m[chrom][start:stop]
+        if strand == '-': seq = complement(seq)[::-1]
+        bed.append("%s\t%i\t%i\tr%i\t0\t%s" % (chrom, start, stop, i, strand))
+        expected.append((">r%i" % i, seq))
+    # 3 exons of a spliced transcript on each strand.
+    gtf = []
+    for t, strand in (('tp', '+'), ('tm', '-')):
+        for start in (2000, 100, 1000):
+            gtf.append('chr3\tx\texon\t%i\t%i\t.\t%s\t.\tgene_id "g"; '
+                       'transcript_id "%s";' % (start + 1, start + 50, strand, t))
+    exons = "".join(m['chr3'][a:a + 50] for a in (100, 1000, 2000))
+    spliced = [('>tp', exons), ('>tm', complement(exons)[::-1])]
+
+    for klass in (NpyFastaRecord, FastaRecord):
+        f = Fasta(path, record_class=klass)
+        for batch in (7, 100000):
+            out = StringIO()
+            write_regions(f, read_bed(bed), out, batch=batch)
+            lines = out.getvalue().split()
+            assert list(zip(lines[::2], lines[1::2])) == expected
+        out = StringIO()
+        write_regions(f, read_gff(gtf), out, 'tsv', batch=2)
+        assert out.getvalue().split() == [x for n, s in spliced
+                                          for x in (n[1:], s)]
+        _unlink_sidecars(path)
+
+    with open('tests/data/regions.bed', 'w') as fh:
+        fh.write("\n".join(bed[:5]) + "\n")
+    out, sys.stdout = sys.stdout, StringIO()
+    try:
+        pyfasta.extract(['--fasta', path, '--bed', 'tests/data/regions.bed'])
+        lines = sys.stdout.getvalue().split()
+    finally:
+        sys.stdout = out
+        os.unlink('tests/data/regions.bed')
+    assert list(zip(lines[::2], lines[1::2])) == expected[:5]
+
+    # --bed and --gff together is an error, not --gff ignored.
+    err, sys.stderr = sys.stderr, StringIO()
+    try:
+        pyfasta.extract(['--fasta', path, '--bed', 'x.bed', '--gff', 'x.gff'])
+        assert False, "no error for --bed and --gff"
+    except SystemExit as e:
+        assert e.code == 2
+        assert "only one of --bed and --gff" in sys.stderr.getvalue()
+    finally:
+        sys.stderr = err
+
+    # --space matches headers with descriptions, others are reported.
+    wrapped = 'tests/data/wrapped.fasta'
+    with open('tests/data/regions.bed', 'w') as fh:
+        fh.write("seq1\t0\t4\ta\t0\t-\n")
+    _unlink_sidecars(wrapped)
+    out, sys.stdout = sys.stdout, StringIO()
+    try:
+        pyfasta.extract(['--fasta', wrapped, '--space', '--bed',
+                         'tests/data/regions.bed'])
+        lines = sys.stdout.getvalue().split()
+        _unlink_sidecars(wrapped)
+        try:
+            pyfasta.extract(['--fasta', wrapped, '--bed',
+                             'tests/data/regions.bed'])
+            assert False, "no error for an unknown chrom"
+        except SystemExit as e:
+            assert str(e.code).startswith("pyfasta extract: seq1 (of a) is"
+                                          " not a sequence in " + wrapped)
+    finally:
+        sys.stdout = out
+        os.unlink('tests/data/regions.bed')
+        _unlink_sidecars(wrapped)
+    assert lines == ['>a', 'ACGT']
+
+def _unlink_sidecars(path):
+    for ext in (".gdx", ".flat", ".2bp", ".2bx", ".gcx"):
+        if os.path.exists(path + ext):
+            os.unlink(path + ext)
+
+def _naive_gc(seq):
+    return [sum(c in 'GCgc' for c in seq), sum(c in 'Nn' for c in seq),
+            sum(c.islower() for c in seq), len(seq)]
+
+def test_gc():
+    from pyfasta.composition import GCIndex
+    rng = np.random.RandomState(1)
+    for path in ('tests/data/wrapped.fasta', 'tests/data/three_chrs.fasta'):
+        m = Fasta(path, record_class=MemoryRecord)
+        keys = sorted(m.keys())
+        chroms = [keys[i] for i in rng.randint(len(keys), size=300)]
+        starts = rng.randint(-5, 100, size=300)
+        stops = starts + rng.randint(-3, 3000, size=300)
+        expected = [_naive_gc(m[c][max(a, 0):max(b, 0)])
+                    for c, a, b in zip(chroms, starts, stops)]
+        for klass, inplace in ((NpyFastaRecord, False), (NpyFastaRecord, True),
+                               (FastaRecord, False), (TwoBitRecord, False)):
+            if inplace and not os.path.exists(path + '.orig'): continue
+            f = Fasta(path, record_class=klass, flatten_inplace=inplace)
+            if klass is NpyFastaRecord:
+                for step in (1, 3, 64, 256):
+                    f._gc_index = None
+                    f.gc_index(step)
+                    assert f.gc_index(step).step == step
+                    assert f.gc_many(chroms, starts, stops, counts=True
+                                     ).tolist() == expected, (klass, step)
+                assert os.path.exists(path + '.gcx')
+            else:
+                assert f.gc_many(chroms, starts, stops, counts=True
+                                 ).tolist() == expected, klass
+            _unlink_sidecars(path)
+            if inplace: fix(path)
+
+    f = Fasta('tests/data/wrapped.fasta')
+    assert f.gc('seq2', 0, 5) != f.gc('seq2', 0, 5)  # nan: all N
+    assert f.gc('seq2') == 15 / 35.
+    assert f.gc('seq1 some description', -3, counts=True).tolist() == \
+            [2, 0, 3, 3]
+    # a .gcx older than the fasta is rebuilt.
+    os.utime('tests/data/wrapped.fasta.gcx', (0, 0))
+    f = Fasta('tests/data/wrapped.fasta')
+    f.gc('seq3')
+    assert os.path.getmtime('tests/data/wrapped.fasta.gcx') > 0
+    _unlink_sidecars('tests/data/wrapped.fasta')
+
+def test_transcripts():
+    path = 'tests/data/three_chrs.fasta'
+    rng = np.random.RandomState(5)
+    feats = {}
+    for i in range(200):
+        chrom = ('chr1', 'chr2', 'chr3')[rng.randint(3)]
+        n = 80 if chrom != 'chr3' else 3600
+        bounds = np.sort(rng.choice(n, 2 * rng.randint(1, 20), replace=False))
+        feat = dict(chr=chrom, strand=(1, -1, '-', '+')[rng.randint(4)],
+                    exons=[(a + 1, b) for a, b in bounds.reshape(-1, 2)])
+        if i % 10 == 0:
+            feat = dict(chr=chrom, strand=1, start=5, stop=20)
+        feats['t%i' % i] = feat
+
+    for klass in (NpyFastaRecord, FastaRecord):
+        f = Fasta(path, record_class=klass)
+        expected = dict((name, f.sequence(feat, exon_keys=('exons',)))
+                        for name, feat in feats.items())
+        for workers in (1, 3):
+            assert f.transcripts(feats, workers=workers) == expected
+        b = f.transcripts(list(feats.items()), output='bytes')
+        assert b == dict((k, v.encode()) for k, v in expected.items())
+        a = f.transcripts(feats, output='array')
+        assert a['t1'].tostring() == expected['t1'].encode()
+        _unlink_sidecars(path)
+
+def test_bench():
+    import json
+    import tempfile
+    from pyfasta import bench
+    d = tempfile.mkdtemp()
+    try:
+        path = os.path.join(d, 'g.fa')
+        recs = bench.make_genome(path, 'contigs', 20000, ncontigs=50)
+        f = Fasta(path)
+        assert sorted((k, len(f[k])) for k in f.keys()) == sorted(recs)
+        assert sum(n for _, n in recs) == len(f.prepared)
+
+        out = os.path.join(d, 'results.json')
+        bench.main(['--shape', 'chroms', '--records', 'NpyFastaRecord',
+                    '--size', '20000', '--reads', '20', '--repeat', '1',
+                    '--dir', d, '-o', out])
+        results = json.load(open(out))['results']
+        assert sorted(results) == sorted(
+                ['chroms/info', 'chroms/split'] +
+                ['chroms/NpyFastaRecord/' + b for b in ('build', 'open_cold',
+                 'open_warm', 'random', 'sequential', 'revcomp', 'sequences')])
+        # the stored baseline has every benchmark.
+        with open('tests/bench_baseline.json') as fh:
+            assert set(results) < set(json.load(fh)['results'])
+        # a second run reuses the genome and is compared to the first.
+        bench.main(['--shape', 'chroms', '--records', 'NpyFastaRecord',
+                    '--size', '20000', '--reads', '20', '--repeat', '1',
+                    '--dir', d, '-o', out + '.2', '--baseline', out,
+                    '--threshold', '1000'])
+        slower = bench.compare(dict((k, 2 * v + 1) for k, v in results.items()),
+                               results)
+        assert len(slower) == len(results)
+    finally:
+        shutil.rmtree(d)
+
+def test_stats():
+    import pickle
+    from pyfasta.stats import Stats
+    path = 'tests/data/three_chrs.fasta'
+    f = Fasta(path)
+    assert f.stats is None and f.stats_info() is None
+    assert type(f['chr1']) is NpyFastaRecord
+    _unlink_sidecars(path)
+
+    for klass in (NpyFastaRecord, MemoryRecord, FastaRecord, TwoBitRecord):
+        calls = []
+        built = Fasta(path, record_class=klass,
+                      stats=Stats(lambda name, t: calls.append(name)))
+        assert built.stats_info()['index']['built'] is \
+                (None if klass is MemoryRecord else True)
+        f = Fasta(path, record_class=klass, stats=True, slice_cache_bytes=100)
+        rec = f['chr3']
+        assert isinstance(rec, klass) and type(rec).__name__ == klass.__name__
+        assert rec[10:20] == Fasta(path, record_class=klass)['chr3'][10:20]
+        feat = {'chr': 'chr1', 'start': 1, 'stop': 4, 'strand': '-'}
+        assert f.sequence(feat) == f.sequence(feat) == 'CAGT'
+        f.fetch_many([('chr1', i, i + 4) for i in range(1, 21)], max_workers=4)
+
+        info = f.stats_info()
+        assert info['slices'] == {klass.__name__: 22}
+        assert info['bytes'] == {klass.__name__: 10 + 4 + 80}
+        assert info['timings']['Fasta.sequence'][0] == 2
+        assert info['slice_hit_ratio'] == 1 / 22.
+        assert info['record_hit_ratio'] > 0.5
+        if klass is MemoryRecord:
+            assert info['index']['built'] is None
+        else:
+            assert info['index']['built'] is False
+            assert 'load_index' in info['phases']
+        assert calls[0] == klass.__name__ + '.prepare'
+        if klass is NpyFastaRecord:
+            assert 'write_flat' in built.stats_info()['phases']
+
+        # the stats are not pickled, the records pickle as the record class.
+        g = pickle.loads(pickle.dumps(f, -1))
+        assert g.stats is None and g['chr1'][:4] == 'ACTG'
+        if klass is not MemoryRecord:
+            r = pickle.loads(pickle.dumps(rec, -1))
+            assert type(r) is klass and r[10:20] == rec[10:20]
+        f.stats.reset()
+        assert f.stats_info()['slices'] == {}
+        _unlink_sidecars(path)
+
+    # a .2bit is read as is, there's no index to build.
+    f = Fasta('tests/data/wrapped.2bit', record_class=UcscTwoBitRecord,
+              stats=True)
+    assert f.stats_info()['index']['built'] is None
+
 if __name__ == "__main__":
     import nose
     nose.main()